@@ -0,0 +1,249 @@
+"""Animated GIF pipeline: frames are decoded, processed and written one at a time.
+
+Pillow only ever shows :func:`app.process_image_data` the frame an image is
+currently on, so a plain render keeps the first frame of an animation.  For
+animated GIF output the frames go through three lazy stages instead:
+
+* :func:`iter_frames` decodes one frame at a time, as displayed (Pillow
+  composites each frame onto the canvas, honouring the source's disposal);
+* the caller maps its usual resize and filters over each frame;
+* :func:`write_gif` maps every frame onto one shared palette and appends it
+  to the output straight away, keeping each frame's duration and disposal.
+
+Only the current frame (and the previous one, for delta cropping) is ever in
+memory, whatever the length of the animation.  What grows with the length is
+work, which :func:`check_budget` bounds by frames x pixels.
+
+Computing an adaptive palette is the expensive part of GIF encoding (median
+cut is several times slower than everything else per pixel), so the palette
+of the first frame is reused for all frames that it still fits; mapping a
+frame onto a fixed palette costs a fraction of that.  A frame that the shared
+palette no longer fits (a scene change) gets its own, which later frames
+then share.  Frames are written as full canvases, cropped to the region that
+changed when the previous frame stays on screen (disposal 0 or 1).
+"""
+from collections.abc import Iterable, Iterator
+from typing import IO, NamedTuple
+
+import numpy as np
+from PIL import GifImagePlugin, Image, ImageChops
+
+from encoding import DEFAULT_PROFILE, encoder_settings
+from metrics import NULL_TIMER, StageTimer
+
+# Colours per palette; one more entry is kept for transparent pixels.
+PALETTE_COLOURS = 255
+
+# Whether the current palette still fits a frame is judged on a thumbnail of
+# at most PALETTE_SAMPLE pixels a side: if more than PALETTE_REFIT_SHARE of
+# its pixels land over PALETTE_REFIT_ERROR (0-255) away from their colour,
+# the frame gets a palette of its own.  A share rather than a mean, so a small
+# object in a new colour is not lost in a large static background.
+PALETTE_SAMPLE = 64
+PALETTE_REFIT_ERROR = 24
+PALETTE_REFIT_SHARE = 0.005
+
+# Disposal methods, as stored in the GIF graphic control extension.
+DISPOSE_NONE, DISPOSE_KEEP, DISPOSE_BACKGROUND, DISPOSE_PREVIOUS = range(4)
+
+
+class Frame(NamedTuple):
+    """One displayed frame and how long (ms) and how it is shown."""
+
+    image: Image.Image
+    duration: int
+    disposal: int
+
+
+class AnimationTooLarge(ValueError):
+    """An animation with more frames x pixels than the budget allows."""
+
+
+def is_animated(img: Image.Image) -> bool:
+    """Whether *img* is a GIF with more than one frame (header scan only)."""
+    return img.format == "GIF" and getattr(img, "n_frames", 1) > 1
+
+
+def check_budget(img: Image.Image, max_frame_pixels: int | None) -> None:
+    """Raise :class:`AnimationTooLarge` if *img*'s frames x pixels exceed
+    *max_frame_pixels* (None or 0: no limit)."""
+    frames = getattr(img, "n_frames", 1)
+    if max_frame_pixels and frames * img.width * img.height > max_frame_pixels:
+        raise AnimationTooLarge(
+            f"Animation is too large ({frames} frames of {img.width}x{img.height}); "
+            f"the limit is {max_frame_pixels} frame pixels"
+        )
+
+
+def iter_frames(img: Image.Image, timer: StageTimer = NULL_TIMER) -> Iterator[Frame]:
+    """Yield the frames of the animated *img* one at a time, as RGB (RGBA if
+    transparent) copies of the full canvas.  Decoding is timed as ``decode``."""
+    for index in range(img.n_frames):
+        with timer.stage("decode"):
+            img.seek(index)
+            transparent = img.mode == "RGBA" or "transparency" in img.info
+            image = img.convert("RGBA" if transparent else "RGB")
+        yield Frame(image, int(img.info.get("duration", 0)), img.disposal_method)
+
+
+def write_gif(
+    frames: Iterable[Frame],
+    fp: IO[bytes],
+    loop: int | None = None,
+    profile: str = DEFAULT_PROFILE,
+    timer: StageTimer = NULL_TIMER,
+) -> int:
+    """Encode *frames* (all the same size) as an animated GIF into *fp* and
+    return the number of frames written.
+
+    Frames are consumed and written one by one.  *loop* is the NETSCAPE loop
+    count (0 forever, None play once); *profile* picks the palette method
+    (see :mod:`encoding`).  Quantizing and writing are timed as ``encode``.
+    """
+    writer = _GifWriter(fp, loop, encoder_settings("GIF", profile).get("quantize"))
+    for frame in frames:
+        with timer.stage("encode"):
+            writer.add(frame)
+    with timer.stage("encode"):
+        return writer.close()
+
+
+class _Palette:
+    """Up to :data:`PALETTE_COLOURS` colours, plus a transparent entry after
+    them that copies the first colour (colour matching takes the first of
+    equal candidates, so it never picks the copy)."""
+
+    def __init__(self, colours: np.ndarray) -> None:
+        self.colours = colours  # (n, 3) uint8
+        self.transparent = len(colours)
+        self.image = Image.new("P", (1, 1))
+        self.image.putpalette(np.concatenate([colours, colours[:1]]).tobytes())
+
+    @classmethod
+    def fit(cls, rgb: Image.Image, method) -> "_Palette":
+        quantized = rgb.quantize(PALETTE_COLOURS, method=method)
+        return cls(np.frombuffer(bytes(quantized.getpalette()), np.uint8).reshape(-1, 3))
+
+    def extended(self, rgb: Image.Image, method) -> "_Palette":
+        """This palette plus the colours of *rgb* it lacks, or a palette of
+        *rgb* alone if they do not fit.  Existing indices keep their colours."""
+        fresh = self.fit(rgb, method)
+        distance = np.abs(
+            fresh.colours[:, None, :].astype(np.int16) - self.colours[None, :, :]
+        ).max(axis=2).min(axis=1)
+        missing = fresh.colours[distance > PALETTE_REFIT_ERROR]
+        if len(self.colours) + len(missing) > PALETTE_COLOURS:
+            return fresh
+        return _Palette(np.concatenate([self.colours, missing]))
+
+    def extends(self, other: "_Palette") -> bool:
+        """Whether indices into *other* mean the same colours here."""
+        n = len(other.colours)
+        return len(self.colours) >= n and np.array_equal(self.colours[:n], other.colours)
+
+    def index(self, image: Image.Image) -> Image.Image:
+        """*image* (RGB or RGBA) mapped onto this palette, undithered (dither
+        noise would differ from frame to frame)."""
+        rgb = image.convert("RGB") if image.mode == "RGBA" else image
+        indexed = rgb.quantize(palette=self.image, dither=Image.Dither.NONE)
+        if image.mode == "RGBA":
+            clear = image.getchannel("A").point(lambda a: 255 if a < 128 else 0)
+            indexed.paste(self.transparent, None, clear)
+        return indexed
+
+    def fits(self, image: Image.Image) -> bool:
+        """Whether *image* maps onto this palette closely enough, judged on a
+        thumbnail."""
+        sample = image.convert("RGB")
+        sample.thumbnail((PALETTE_SAMPLE, PALETTE_SAMPLE), Image.Resampling.BOX)
+        mapped = sample.quantize(palette=self.image, dither=Image.Dither.NONE).convert("RGB")
+        histogram = ImageChops.difference(sample, mapped).convert("L").histogram()
+        return sum(histogram[PALETTE_REFIT_ERROR + 1 :]) <= PALETTE_REFIT_SHARE * sum(histogram)
+
+
+class _GifWriter:
+    """Holds back one frame, because whether a frame may stay on screen
+    depends on the transparency of the next."""
+
+    def __init__(self, fp: IO[bytes], loop: int | None, method) -> None:
+        self.fp = fp
+        self.loop = loop
+        self.method = Image.Quantize.MEDIANCUT if method is None else method
+        self.palette: _Palette | None = None  # current shared palette
+        self.global_palette: _Palette | None = None  # the one in the header
+        self.previous: tuple[Image.Image, _Palette | None] | None = None  # on screen
+        self.pending: tuple | None = None
+        self.count = 0
+        self.palettes = 0
+
+    def add(self, frame: Frame) -> None:
+        image = frame.image
+        palette = None
+        if image.mode == "L":
+            indexed = image  # GIF's implicit grayscale table; nothing to fit
+        else:
+            if self.palette is None:
+                self.palette = _Palette.fit(image.convert("RGB"), self.method)
+                self.palettes += 1
+            elif not self.palette.fits(image):
+                self.palette = self.palette.extended(image.convert("RGB"), self.method)
+                self.palettes += 1
+            palette = self.palette
+            indexed = palette.index(image)
+        transparent = image.mode == "RGBA"
+        if self.pending is not None:
+            self._write(*self.pending, next_transparent=transparent)
+        self.pending = (indexed, palette, frame, transparent)
+
+    def close(self) -> int:
+        if self.pending is not None:
+            self._write(*self.pending, next_transparent=False)
+            self.pending = None
+        if self.count:
+            self.fp.write(b";")  # trailer
+        return self.count
+
+    def _write(
+        self,
+        indexed: Image.Image,
+        palette: _Palette | None,
+        frame: Frame,
+        transparent: bool,
+        next_transparent: bool,
+    ) -> None:
+        if self.count == 0:
+            self.global_palette = palette
+            header_image = indexed.copy()
+            header_image.info["version"] = b"89a"  # frames carry extensions
+            info = {} if self.loop is None else {"loop": self.loop}
+            header, _ = GifImagePlugin.getheader(header_image, None, info)
+            self.fp.write(b"".join(header))
+
+        region, offset = indexed, (0, 0)
+        if self.previous is not None and not transparent:
+            # Only the pixels that changed since the frame on screen.
+            before, before_palette = self.previous
+            if palette is None or palette.extends(before_palette):
+                bbox = _changed_box(before, indexed) or (0, 0, 1, 1)  # frames cannot be empty
+                region, offset = indexed.crop(bbox), bbox[:2]
+
+        # Frames are full canvases, so the next one may only be drawn over
+        # this one if it has no holes; otherwise clear to the background.
+        disposal = DISPOSE_BACKGROUND if next_transparent else frame.disposal
+        params = {"duration": frame.duration, "disposal": disposal}
+        if transparent:
+            params["transparency"] = palette.transparent
+        if palette is not self.global_palette:
+            params["include_color_table"] = True
+        for chunk in GifImagePlugin.getdata(region, offset, **params):
+            self.fp.write(chunk)
+        keep = disposal in (DISPOSE_NONE, DISPOSE_KEEP)
+        self.previous = (indexed, palette) if keep else None
+        self.count += 1
+
+
+def _changed_box(before: Image.Image, after: Image.Image) -> tuple[int, int, int, int] | None:
+    """Bounding box of the pixels whose palette index differs, or None."""
+    a = Image.frombytes("L", before.size, before.tobytes())
+    b = Image.frombytes("L", after.size, after.tobytes())
+    return ImageChops.difference(a, b).getbbox()
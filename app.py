@@ -1,21 +1,269 @@
-import sys
-import os
-print("Python version:", sys.version)
-print("Current working directory:", os.getcwd())
-print("Static folder exists:", os.path.exists("static"))
-print("Templates folder exists:", os.path.exists("templates"))
 import io
+import itertools
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
 import uuid
-from flask import Flask, request, render_template, send_file, flash, redirect, url_for
+from time import perf_counter, sleep
+from collections.abc import Callable, Iterator
+from functools import partial
+from typing import NamedTuple
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from contextlib import ExitStack
+from werkzeug.exceptions import RequestEntityTooLarge
+from flask import Flask, Response, request, render_template, send_file, flash, redirect, url_for, jsonify
 from PIL import Image, ImageOps, UnidentifiedImageError
 
+from animation import AnimationTooLarge, Frame, check_budget, is_animated, iter_frames, write_gif
+from archive import stream_multipart, stream_zip
+from cache import ResultCache, make_key
+from coalesce import Coalescer
+from costs import ClientBudget, CostModel, RenderFeatures
+from encoding import DEFAULT_PROFILE, OUTPUT_FORMATS, PROFILES, negotiate_format, save_image
+from filters import chain_signature, compile_chain, parse_chain, tone_chain
+from jobs import JobSpool, public_status, run_job
+from metrics import NULL_TIMER, Metrics, StageTimer
+from pipeline import Plan, plan_operations
+from profiling import ProfileStore, profile_call, profile_trigger
+from sharedimage import SharedImage, SharedPixels, call_with_image, can_share, remove_stale
+from startup import configure_pillow, log_diagnostics
+from store import ImageStore
+from streaming import POLL_SECONDS, buffer_response, follow_file, set_download_name
+from tone import SEPIA_WARM, apply_color_matrix
+from uploads import (
+    EXTENSION_FORMATS, SpooledRequest, UploadInfo, UploadRejected, inspect_upload, keep_upload,
+    upload_size, upload_source, verify_upload,
+)
+from workers import PoolSaturated, WorkerPool
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Configuration
+# ──────────────────────────────────────────────────────────────────────────────
+def load_config(environ=os.environ) -> dict:
+    """Settings from the environment *environ*, with their defaults.
+
+    Reading them has no side effects; :func:`create_app` applies them.
+    """
+    config = {}
+    config["SECRET_KEY"] = environ.get("FLASK_SECRET_KEY", "a-default-very-secret-key")
+    # Uploads: bodies over MAX_CONTENT_LENGTH bytes are refused (413) before they
+    # are read, bodies over UPLOAD_SPOOL_BYTES are parsed to disk (UPLOAD_SPOOL_DIR)
+    # instead of memory and workers read them from there, and images of more
+    # than MAX_IMAGE_PIXELS pixels are refused from their header (0 = no limit).  That limit is Pillow's too, so
+    # every other decode (stored originals, worker processes) enforces it as well.
+    config["MAX_CONTENT_LENGTH"] = int(environ.get("MAX_CONTENT_LENGTH", 64 * 1024 * 1024))
+    config["UPLOAD_SPOOL_BYTES"] = int(environ.get("UPLOAD_SPOOL_BYTES", 1024 * 1024))
+    config["UPLOAD_SPOOL_DIR"] = environ.get("UPLOAD_SPOOL_DIR") or None
+    config["MAX_IMAGE_PIXELS"] = int(environ.get("MAX_IMAGE_PIXELS", Image.MAX_IMAGE_PIXELS))
+    # Animated GIFs are processed frame by frame; MAX_ANIMATION_PIXELS bounds
+    # frames x pixels per animation (0 = no limit).
+    config["MAX_ANIMATION_PIXELS"] = int(environ.get("MAX_ANIMATION_PIXELS", 100_000_000))
+    # Worker processes for CPU-bound image work (default: one per core; 0 = inline),
+    # how many more tasks may wait for a worker before requests are turned away
+    # with 503, and the Retry-After (seconds) sent when that happens.
+    config["IMAGE_WORKERS"] = int(environ.get("IMAGE_WORKERS", os.cpu_count() or 1))
+    config["IMAGE_QUEUE_LIMIT"] = int(
+        environ.get("IMAGE_QUEUE_LIMIT", 2 * max(1, config["IMAGE_WORKERS"]))
+    )
+    config["RETRY_AFTER_SECONDS"] = int(environ.get("RETRY_AFTER_SECONDS", 1))
+    # Served over ASGI (see :mod:`asgi`), requests are received and answered on
+    # the event loop and only handled on ASGI_APP_THREADS threads, however many
+    # connections are open.  Handling includes waiting for a worker or for an
+    # identical render, so there should be more threads than workers.
+    config["ASGI_APP_THREADS"] = int(environ.get("ASGI_APP_THREADS", 64))
+    # Waiting renders run cheapest-first by estimated cost (see :mod:`costs`);
+    # SCHEDULER_AGING is the seconds of estimated cost a task is forgiven per
+    # second it waits, so big renders cannot starve.  Each client may spend
+    # CLIENT_BUDGET_SECONDS of estimated worker time per CLIENT_BUDGET_WINDOW
+    # seconds on /process (per Gunicorn worker) before getting 429; 0 disables.
+    # Clients are told apart by CLIENT_ID_HEADER (e.g. X-Real-IP set by Nginx)
+    # or, if unset, by peer address.
+    config["SCHEDULER_AGING"] = float(environ.get("SCHEDULER_AGING", 1.0))
+    config["CLIENT_BUDGET_SECONDS"] = float(environ.get("CLIENT_BUDGET_SECONDS", 60))
+    config["CLIENT_BUDGET_WINDOW"] = float(environ.get("CLIENT_BUDGET_WINDOW", 60))
+    config["CLIENT_ID_HEADER"] = environ.get("CLIENT_ID_HEADER") or None
+    # Result cache: in-memory LRU budget, plus an optional directory shared by all
+    # workers on the host (bounded separately).
+    config["RESULT_CACHE_BYTES"] = int(environ.get("RESULT_CACHE_BYTES", 64 * 1024 * 1024))
+    config["RESULT_CACHE_DIR"] = environ.get("RESULT_CACHE_DIR") or None
+    config["RESULT_CACHE_DIR_BYTES"] = int(environ.get("RESULT_CACHE_DIR_BYTES", 1024 * 1024 * 1024))
+    # Identical /process misses in flight at once (same upload, same options)
+    # are rendered once: duplicates wait up to COALESCE_TIMEOUT seconds for the
+    # first and share its output (0 disables).  Workers on the host coordinate
+    # through lock files in COALESCE_DIR (empty = within a process only).
+    config["COALESCE_TIMEOUT"] = float(environ.get("COALESCE_TIMEOUT", 60))
+    config["COALESCE_DIR"] = environ.get(
+        "COALESCE_DIR", os.path.join(tempfile.gettempdir(), "imageprocessor-coalesce")
+    ) or None
+
+    # Async jobs: spool directory (shared by all workers on the host) and how long
+    # finished jobs and their results are kept.
+    config["JOB_SPOOL_DIR"] = environ.get(
+        "JOB_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "imageprocessor-jobs")
+    )
+    config["JOB_TTL_SECONDS"] = int(environ.get("JOB_TTL_SECONDS", 3600))
+
+    # Image store: originals on disk, plus an LRU budget for decoded images.
+    config["IMAGE_STORE_DIR"] = environ.get(
+        "IMAGE_STORE_DIR", os.path.join(tempfile.gettempdir(), "imageprocessor-store")
+    )
+    config["IMAGE_STORE_DECODED_BYTES"] = int(
+        environ.get("IMAGE_STORE_DECODED_BYTES", 256 * 1024 * 1024)
+    )
+    # Stored images are rendered by the worker processes, which read the decoded
+    # pixels from memory-mapped files in SHARED_PIXELS_DIR (see :mod:`sharedimage`)
+    # instead of having them pickled.  The default is on the RAM-backed /dev/shm
+    # where there is one; empty = render stored images in the web process.  The
+    # files of recently rendered images are kept for the next render, up to
+    # SHARED_PIXELS_BYTES per Gunicorn worker.
+    config["SHARED_PIXELS_DIR"] = environ.get(
+        "SHARED_PIXELS_DIR",
+        os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                     "imageprocessor-pixels"),
+    ) or None
+    config["SHARED_PIXELS_BYTES"] = int(environ.get("SHARED_PIXELS_BYTES", 48 * 1024 * 1024))
+
+    # Encoding profile (see :mod:`encoding`) for requests that do not name one:
+    # fast, balanced or smallest.
+    config["ENCODING_PROFILE"] = environ.get("ENCODING_PROFILE", "balanced")
+
+    # Images whose strips would not fit in TILE_BUDGET_BYTES of working memory
+    # are processed strip by strip (see :mod:`tiles`); 0 disables tiling.
+    config["TILE_BUDGET_BYTES"] = int(environ.get("TILE_BUDGET_BYTES", 64 * 1024 * 1024))
+
+    # /process misses whose output has at least STREAM_MIN_PIXELS pixels are
+    # streamed: the worker encodes into a spool file in STREAM_SPOOL_DIR that is
+    # sent (chunked) while it is still being written, then moved into the result
+    # cache.  Defaults to RESULT_CACHE_DIR so that move is a rename; 0 disables.
+    config["STREAM_MIN_PIXELS"] = int(environ.get("STREAM_MIN_PIXELS", 4_000_000))
+    config["STREAM_SPOOL_DIR"] = (
+        environ.get("STREAM_SPOOL_DIR")
+        or config["RESULT_CACHE_DIR"]
+        or os.path.join(tempfile.gettempdir(), "imageprocessor-stream")
+    )
+
+    # Metrics: per-stage /process timings exported at /metrics (Prometheus text)
+    # and in Server-Timing headers.  With several Gunicorn workers, point
+    # METRICS_DIR at a directory they share (emptied on deploy) so every scrape
+    # reports the totals of all of them.
+    config["METRICS_ENABLED"] = (
+        environ.get("METRICS_ENABLED", "1").strip().lower() not in {"", "0", "false", "off", "no"}
+    )
+    config["METRICS_DIR"] = environ.get("METRICS_DIR") or None
+
+    # Profiling: /process requests carrying ``X-Profile: <PROFILE_SECRET>`` are
+    # always profiled; a PROFILE_SAMPLE_RATE fraction of the rest is profiled and
+    # kept only if slower than PROFILE_THRESHOLD_MS.  The newest PROFILE_MAX_DUMPS
+    # dumps are kept in PROFILE_DIR and served by the (secret-guarded) admin API.
+    config["PROFILE_SECRET"] = environ.get("PROFILE_SECRET") or None
+    config["PROFILE_SAMPLE_RATE"] = float(environ.get("PROFILE_SAMPLE_RATE", 0))
+    config["PROFILE_THRESHOLD_MS"] = float(environ.get("PROFILE_THRESHOLD_MS", 1000))
+    config["PROFILE_DIR"] = environ.get(
+        "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "imageprocessor-profiles")
+    )
+    config["PROFILE_MAX_DUMPS"] = int(environ.get("PROFILE_MAX_DUMPS", 50))
+
+    # Log the interpreter and the static and template folders at start-up
+    # (always on with the dev server).
+    config["STARTUP_DIAGNOSTICS"] = (
+        environ.get("STARTUP_DIAGNOSTICS", "0").strip().lower() not in {"", "0", "false", "off", "no"}
+    )
+    return config
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Flask setup
 # ──────────────────────────────────────────────────────────────────────────────
 app = Flask(__name__)
-app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "a-default-very-secret-key")
+app.config.update(load_config())
+app.request_class = SpooledRequest
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
+UPLOAD_FORMATS = {EXTENSION_FORMATS[ext] for ext in ALLOWED_EXTENSIONS}
+
+# Service objects.  Importing this module builds none of them (nor touches
+# the filesystem); create_app() does, once per process.  Reading one as a
+# module attribute (``app.result_cache``) builds them too, and so does the
+# first request, for servers pointed at ``app:app``.
+_SERVICES = (
+    "result_cache", "coalescer", "metrics", "worker_pool", "cost_model", "client_budget",
+    "job_spool", "image_store", "shared_pixels", "profile_store",
+)
+_created = False
+_create_lock = threading.Lock()
+
+
+def create_app(config: dict | None = None) -> Flask:
+    """Configure the application and build its services; return it.
+
+    *config* overrides settings read from the environment (see
+    :func:`load_config`).  The application is one per process: the first
+    call applies the pixel budget and Pillow plugins (see :mod:`startup`) and
+    builds the caches, stores and worker pool; later calls return it as is,
+    unless *config* is given, which shuts down the current worker pool and
+    rebuilds the services with the new settings.  An invalid *config* raises
+    :class:`ValueError` and leaves the settings unchanged.  For Gunicorn: ``gunicorn 'app:create_app()'``.
+    """
+    global _created
+    with _create_lock:
+        if not config and _created:
+            return app
+        profile = (config or {}).get("ENCODING_PROFILE", app.config["ENCODING_PROFILE"])
+        if profile not in PROFILES:
+            raise ValueError(f"ENCODING_PROFILE must be one of {', '.join(PROFILES)}")
+        if config:
+            app.config.update(config)
+        configure_pillow(app.config["MAX_IMAGE_PIXELS"], UPLOAD_FORMATS | set(OUTPUT_FORMATS))
+        _create_services(app.config)
+        if app.config["STARTUP_DIAGNOSTICS"]:
+            log_diagnostics(
+                app.logger, app.static_folder, os.path.join(app.root_path, app.template_folder)
+            )
+        _created = True
+    return app
+
+
+def _create_services(config) -> None:
+    global result_cache, coalescer, metrics, worker_pool, cost_model, client_budget
+    global job_spool, image_store, shared_pixels, profile_store
+    if _created:  # rebuilding: stop the previous pool's processes and threads
+        worker_pool.shutdown(wait=False)
+        metrics.close()
+        if shared_pixels is not None:
+            shared_pixels.close()
+    result_cache = ResultCache(
+        config["RESULT_CACHE_BYTES"],
+        disk_dir=config["RESULT_CACHE_DIR"],
+        disk_max_bytes=config["RESULT_CACHE_DIR_BYTES"],
+    )
+    coalescer = Coalescer(config["COALESCE_DIR"], config["COALESCE_TIMEOUT"])
+    metrics = Metrics(config["METRICS_ENABLED"], config["METRICS_DIR"])
+    metrics.histogram("imageprocessor_stage_seconds", "Time spent in each stage of /process.")
+    metrics.histogram("imageprocessor_request_seconds", "Time to produce a /process response.")
+    metrics.counter("imageprocessor_requests_total", "/process responses by cache outcome.")
+    metrics.counter("imageprocessor_bytes_in_total", "Uploaded image bytes received by /process.")
+    metrics.counter("imageprocessor_bytes_out_total", "Encoded image bytes returned by /process.")
+    metrics.counter("imageprocessor_pixels_processed_total", "Decoded source pixels processed by /process.")
+    worker_pool = WorkerPool(config["IMAGE_WORKERS"], config["IMAGE_QUEUE_LIMIT"], config["SCHEDULER_AGING"])
+    cost_model = CostModel()
+    client_budget = ClientBudget(config["CLIENT_BUDGET_SECONDS"], config["CLIENT_BUDGET_WINDOW"])
+    job_spool = JobSpool(config["JOB_SPOOL_DIR"], config["JOB_TTL_SECONDS"])
+    image_store = ImageStore(config["IMAGE_STORE_DIR"], config["IMAGE_STORE_DECODED_BYTES"])
+    shared_pixels = None
+    if config["SHARED_PIXELS_DIR"]:
+        remove_stale(config["SHARED_PIXELS_DIR"])  # left by workers that died
+        shared_pixels = SharedPixels(config["SHARED_PIXELS_DIR"], config["SHARED_PIXELS_BYTES"])
+    profile_store = ProfileStore(config["PROFILE_DIR"], config["PROFILE_MAX_DUMPS"])
+
+
+def __getattr__(name: str):
+    if name in _SERVICES:
+        create_app()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def allowed_file(filename: str) -> bool:
@@ -23,9 +271,42 @@ def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def check_upload(file) -> UploadInfo:
+    """Vet *file* from its magic bytes and image header, then check that its
+    body decodes; return its format and size.
+
+    Raises :class:`uploads.UploadRejected` (see :func:`uploads.inspect_upload`
+    and :func:`uploads.verify_upload`).
+    """
+    info = inspect_upload(
+        file.stream,
+        UPLOAD_FORMATS,
+        app.config["MAX_IMAGE_PIXELS"],
+        app.config["MAX_ANIMATION_PIXELS"],
+    )
+    verify_upload(file.stream, info.format)
+    return info
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Routes
 # ──────────────────────────────────────────────────────────────────────────────
+@app.before_request
+def _ensure_created():
+    if not _created:
+        create_app()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(exc):
+    """Bodies over MAX_CONTENT_LENGTH: flash on the form, JSON 413 elsewhere."""
+    message = f"Upload too large; the limit is {app.config['MAX_CONTENT_LENGTH']} bytes"
+    if request.endpoint == "process_image":
+        flash(message)
+        return redirect(url_for("index"))
+    return jsonify(error=message), 413
+
+
 @app.route("/", methods=["GET"])
 def index():
     """Render the upload/processing form."""
@@ -35,12 +316,17 @@ def index():
 @app.route("/process", methods=["POST"])
 def process_image():
     """Handle an upload, perform processing, and stream the result back."""
+    started = perf_counter()
+    timer = StageTimer() if metrics.enabled else NULL_TIMER
+    with timer.stage("upload"):
+        files = request.files  # parses (and so receives) the multipart body
+
     # ---------- File sanity checks ----------
-    if "file" not in request.files:
+    if "file" not in files:
         flash("No file part")
         return redirect(url_for("index"))
 
-    file = request.files["file"]
+    file = files["file"]
 
     if file.filename == "":
         flash("No selected file")
@@ -49,67 +335,123 @@ def process_image():
     if not allowed_file(file.filename):
         flash("Invalid file type. Allowed types: png, jpg, jpeg, gif")
         return redirect(url_for("index"))
-
-    # ---------- Pull form controls ----------
-    try:
-        target_width = request.form.get("width", type=int)
-        resize_option = request.form.get("resize_option", "width")  # width • percent • none
-        percentage = request.form.get("percentage", 100, type=int)
-        apply_grayscale = "grayscale" in request.form
-        apply_sepia = "sepia" in request.form
-        output_format = request.form.get("format", "JPEG").upper()
-        if output_format not in {"JPEG", "PNG", "GIF"}:
-            output_format = "JPEG"
-    except ValueError:  # never really triggered but kept as guard-rail
-        flash("Invalid input for dimensions or percentage.")
+    try:
+        info = check_upload(file)
+    except UploadRejected as exc:
+        flash(str(exc))
         return redirect(url_for("index"))
 
-    # ---------- Validate width / percent ----------
-    if resize_option == "width":
-        if target_width is None or target_width <= 0:
-            flash("Invalid input for dimensions")
-            return redirect(url_for("index"))
+    # ---------- Pull & validate form controls ----------
+    try:
+        options = options_from_form(request.form, request.accept_mimetypes)
+    except ValueError as exc:
+        flash(str(exc))
+        return redirect(url_for("index"))
+    negotiated = format_negotiated(request.form)
 
-    if resize_option == "percent":
-        if percentage is None or percentage <= 0:
+    if request.form.get("resize_option") == "percent":
+        if _int_field(request.form, "percentage", 100) <= 0:
             flash(
                 "Percentage resulted in zero or negative image dimension, original size kept."
             )
-            resize_option = "none"  # fall back to original size
-
-    # ---------- Perform processing ----------
-    try:
-        img = Image.open(file.stream)
-        processed_img = process_image_data(
-            img,
-            resize_option=resize_option,
-            target_width=target_width,
-            percentage=percentage,
-            apply_grayscale=apply_grayscale,
-            apply_sepia=apply_sepia,
-        )
-
-        # ---------- Stream the file back ----------
-        img_io = io.BytesIO()
-        save_kwargs = {"format": output_format}
-        if output_format == "JPEG":
-            # JPEG must be RGB
-            if processed_img.mode in {"RGBA", "P"}:
-                processed_img = processed_img.convert("RGB")
-            save_kwargs["quality"] = 90
+    output_format = options["format"]
 
-        processed_img.save(img_io, **save_kwargs)
-        img_io.seek(0)
+    # ---------- Perform processing (or serve a cached result) ----------
+    try:
+        # Hashed in chunks and handed to workers by path once spooled to
+        # disk, so a large upload is never held in memory whole.
+        source = upload_source(file.stream)
+        upload_bytes = upload_size(file.stream)
+        key = make_key(file.stream, options)
+        if key in request.if_none_match:
+            # The client already holds this exact result.  Werkzeug only
+            # evaluates preconditions for GET/HEAD, so answer it here.
+            response = app.response_class(status=304)
+            response.set_etag(key)
+            if negotiated:
+                response.vary.add("Accept")
+            _record_process(timer, response, started, "not_modified", upload_bytes, 0)
+            return response
 
+        with timer.stage("cache"):
+            encoded = result_cache.get(key)
+        cache_status = "HIT"
+        capture = None
         original_stem, _ = os.path.splitext(file.filename)
         safe_name = f"{original_stem}_{uuid.uuid4().hex[:8]}.{output_format.lower()}"
+        if encoded is None:
+            cache_status = "MISS"
+            trigger = profile_trigger(
+                request.headers.get("X-Profile"),
+                app.config["PROFILE_SECRET"],
+                app.config["PROFILE_SAMPLE_RATE"],
+            )
+            # Price the render from the header and options; clients over
+            # their budget are turned away, the rest queue cheapest-first.
+            features = render_features(info, options)
+            cost = cost_model.estimate(features)
+            client = _client_id()
+            retry_after = client_budget.charge(client, cost)
+            if retry_after:
+                return _over_budget_response(retry_after)
 
-        return send_file(
-            img_io,
-            mimetype=f"image/{output_format.lower()}",
-            as_attachment=True,
-            download_name=safe_name,
-        )
+            def calibrate(worker_timer: StageTimer) -> None:
+                cost_model.observe(features, worker_timer.stages)
+                client_budget.settle(client, cost, worker_timer.total)
+
+            try:
+                threshold = app.config["STREAM_MIN_PIXELS"]
+                if threshold and features.output_pixels >= threshold:
+                    response = _stream_render(
+                        source, upload_bytes, options, key, safe_name, trigger, timer, started,
+                        cost, calibrate, client,
+                    )
+                    if negotiated:
+                        response.vary.add("Accept")
+                    return response
+
+                def render() -> bytes:
+                    nonlocal capture
+                    future = worker_pool.submit(
+                        render_image_timed, source, options, profile=trigger is not None,
+                        block=False, cost=cost,
+                    )
+                    submitted = perf_counter()
+                    encoded, worker_timer, capture = future.result()
+                    calibrate(worker_timer)
+                    timer.merge(worker_timer)
+                    # Whatever the worker did not account for was queueing and IPC.
+                    timer.add("queue", max(0.0, perf_counter() - submitted - worker_timer.total))
+                    result_cache.put(key, encoded)
+                    return encoded
+
+                # Identical requests already in flight share one render.
+                waiting = perf_counter()
+                encoded, shared = coalescer.run(key, render)
+            except PoolSaturated:
+                client_budget.settle(client, cost, 0.0)  # refund
+                return _busy_response()
+            if shared:
+                client_budget.settle(client, cost, 0.0)  # someone else paid
+                cache_status = "COALESCED"
+                timer.add("coalesce", perf_counter() - waiting)
+
+        # ---------- Send the result back (the buffer itself, no copy) ----------
+        with timer.stage("send_file"):
+            response = buffer_response(
+                encoded,
+                f"image/{output_format.lower()}",
+                download_name=safe_name,
+                etag=key,
+            )
+            response.cache_control.no_cache = True
+            if negotiated:
+                response.vary.add("Accept")
+        response.headers["X-Cache"] = cache_status
+        _record_process(timer, response, started, cache_status.lower(), upload_bytes, len(encoded))
+        if capture is not None:
+            _keep_profile(capture, trigger, options, timer, perf_counter() - started)
+        return response
 
     except UnidentifiedImageError:
         flash("Cannot identify image file. It might be corrupted or an unsupported format.")
@@ -120,9 +462,803 @@ def process_image():
         return redirect(url_for("index"))
 
 
+def _stream_render(
+    source: bytes | str,
+    upload_bytes: int,
+    options: dict,
+    key: str,
+    download_name: str,
+    trigger: str | None,
+    timer: StageTimer,
+    started: float,
+    cost: float,
+    calibrate: Callable[[StageTimer], None],
+    client: str,
+) -> Response:
+    """Answer a /process miss by streaming the encoder's output as it is written.
+
+    The worker encodes into a spool file; once that file appears (decoding and
+    processing succeeded) it is sent with chunked transfer encoding while the
+    worker is still writing it.  Identical requests arriving meanwhile follow
+    the same file instead of rendering again (see :meth:`Coalescer.stream`).
+    When the leader's response closes the finished file is handed to the
+    result cache, and the metrics and profile are recorded.  Raises
+    :class:`workers.PoolSaturated` if the pool is full.
+    """
+    def start() -> tuple[str, Future]:
+        spool_dir = app.config["STREAM_SPOOL_DIR"]
+        os.makedirs(spool_dir, exist_ok=True)
+        path = os.path.join(spool_dir, f".tmp-stream-{uuid.uuid4().hex}")
+        future = worker_pool.submit(
+            render_image_timed, source, options, profile=trigger is not None, path=path,
+            block=False, cost=cost,
+        )
+        while not (future.done() or os.path.exists(path)):
+            sleep(POLL_SECONDS)
+        if future.done() and future.exception() is not None:
+            raise future.exception()  # before any byte is sent: the usual error handling applies
+        return path, future
+
+    waiting = perf_counter()
+    (path, future), shared = coalescer.stream(key, start)
+    if shared:
+        client_budget.settle(client, cost, 0.0)  # someone else paid
+        timer.add("coalesce", perf_counter() - waiting)
+        try:
+            body = follow_file(path, future)
+        except FileNotFoundError:  # finished and adopted by the cache just now
+            encoded = result_cache.get(key)
+            if encoded is None:
+                return _stream_render(
+                    source, upload_bytes, options, key, download_name, trigger, timer, started,
+                    cost, calibrate, client,
+                )
+            body, future = [encoded], None
+    else:
+        timer.add("first_byte", perf_counter() - waiting)
+        body = follow_file(path, future)
+
+    output_format = options["format"]
+    # Not direct_passthrough: that would skip Response.close() and so the
+    # call_on_close hook below.  Chunks are bytes, which pass through as-is.
+    response = Response(body, mimetype=f"image/{output_format.lower()}")
+    set_download_name(response.headers, download_name)
+    response.set_etag(key)
+    response.cache_control.no_cache = True
+    response.headers["X-Cache"] = "COALESCED" if shared else "MISS"
+    response.headers["X-Accel-Buffering"] = "no"  # let Nginx pass chunks on as they come
+    if metrics.enabled:
+        # Only what happened before the first byte; the rest is still running.
+        response.headers["Server-Timing"] = timer.server_timing()
+
+    def finished(future) -> None:
+        if shared:
+            if not future.cancelled() and future.exception() is None:
+                elapsed = perf_counter() - started
+                _observe_process(timer, elapsed, "coalesced", upload_bytes, future.result()[0])
+            return
+        coalescer.end_stream(key)  # the file goes next: later duplicates hit the cache
+        if future.cancelled() or future.exception() is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        size, worker_timer, capture = future.result()
+        result_cache.put_file(key, path)
+        calibrate(worker_timer)
+        timer.merge(worker_timer)
+        elapsed = perf_counter() - started
+        _observe_process(timer, elapsed, "miss", upload_bytes, size)
+        if capture is not None:
+            _keep_profile(capture, trigger, options, timer, elapsed)
+
+    if future is not None:
+        response.call_on_close(lambda: future.add_done_callback(finished))
+    return response
+
+
+def _record_process(
+    timer: StageTimer,
+    response: Response,
+    started: float,
+    outcome: str,
+    bytes_in: int,
+    bytes_out: int,
+) -> None:
+    """Export one /process request's timings and sizes.
+
+    Adds a ``Server-Timing`` header, and times the body transfer (which
+    happens after the view returns) as the ``transfer`` stage on close.
+    """
+    if not metrics.enabled:
+        return
+    elapsed = perf_counter() - started
+    response.headers["Server-Timing"] = ", ".join(
+        filter(None, [timer.server_timing(), f"total;dur={elapsed * 1000:.3f}"])
+    )
+    _observe_process(timer, elapsed, outcome, bytes_in, bytes_out)
+
+    sent = perf_counter()
+    response.call_on_close(
+        lambda: metrics.observe(
+            "imageprocessor_stage_seconds", perf_counter() - sent, stage="transfer"
+        )
+    )
+
+
+def _observe_process(
+    timer: StageTimer, elapsed: float, outcome: str, bytes_in: int, bytes_out: int
+) -> None:
+    if not metrics.enabled:
+        return
+    for stage, seconds in timer.stages.items():
+        metrics.observe("imageprocessor_stage_seconds", seconds, stage=stage)
+    metrics.observe("imageprocessor_request_seconds", elapsed, cache=outcome)
+    metrics.inc("imageprocessor_requests_total", cache=outcome)
+    metrics.inc("imageprocessor_bytes_in_total", bytes_in)
+    metrics.inc("imageprocessor_bytes_out_total", bytes_out)
+    if timer.pixels:
+        metrics.inc("imageprocessor_pixels_processed_total", timer.pixels)
+
+
+def _keep_profile(
+    capture: dict, trigger: str, options: dict, timer: StageTimer, elapsed: float
+) -> None:
+    """Store a /process profile if it was asked for or the request was slow."""
+    threshold = app.config["PROFILE_THRESHOLD_MS"] / 1000
+    if trigger != "header" and elapsed < threshold:
+        return
+    stats = capture.pop("stats")
+    dump_id = profile_store.save(
+        stats,
+        {
+            **capture,
+            "trigger": trigger,
+            "elapsed_ms": round(elapsed * 1000, 3),
+            "threshold_ms": app.config["PROFILE_THRESHOLD_MS"],
+            "options": options,
+            "stages_ms": {name: round(s * 1000, 3) for name, s in timer.stages.items()},
+        },
+    )
+    app.logger.info("Saved profile %s for a %.0f ms /process request", dump_id, elapsed * 1000)
+
+
+def _profile_admin_denied() -> tuple[Response, int] | None:
+    """404 unless profiling has a secret, 403 unless the request presents it."""
+    secret = app.config["PROFILE_SECRET"]
+    if not secret:
+        return jsonify(error="Profiling is not configured"), 404
+    if profile_trigger(request.headers.get("X-Profile"), secret, 0) != "header":
+        return jsonify(error="Missing or wrong X-Profile secret"), 403
+    return None
+
+
+@app.route("/admin/profiles", methods=["GET"])
+def list_profiles():
+    """List stored profile dumps (metadata and hottest functions), newest first."""
+    denied = _profile_admin_denied()
+    if denied:
+        return denied
+    return jsonify(profiles=profile_store.list())
+
+
+@app.route("/admin/profiles/<dump_id>", methods=["GET"])
+def download_profile(dump_id: str):
+    """Download one dump as a ``.prof`` file (open with ``pstats`` or snakeviz)."""
+    denied = _profile_admin_denied()
+    if denied:
+        return denied
+    path = profile_store.path(dump_id)
+    if path is None:
+        return jsonify(error="Unknown profile"), 404
+    return send_file(
+        path,
+        mimetype="application/octet-stream",
+        as_attachment=True,
+        download_name=f"{dump_id}.prof",
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Expose /process stage latencies, byte and pixel counters for Prometheus."""
+    if not metrics.enabled:
+        return Response("Metrics are disabled.\n", status=404, mimetype="text/plain")
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    """Report result-cache hit/miss/eviction counters as JSON."""
+    return jsonify(result_cache.stats())
+
+
+@app.route("/costs/stats", methods=["GET"])
+def cost_stats():
+    """Report the cost model's learned correction factors and budget rejections."""
+    return jsonify(**cost_model.stats(), budget_rejected=client_budget.rejected)
+
+
+@app.route("/coalesce/stats", methods=["GET"])
+def coalesce_stats():
+    """Report how many /process renders were run and how many were shared."""
+    return jsonify(coalescer.stats())
+
+
+@app.route("/workers/stats", methods=["GET"])
+def worker_stats():
+    """Report worker-pool queue depth and utilisation as JSON."""
+    return jsonify(worker_pool.stats())
+
+
+def _client_id() -> str:
+    """Who a request is charged to: ``CLIENT_ID_HEADER`` (set by a trusted
+    proxy) if configured, else the peer address."""
+    header = app.config["CLIENT_ID_HEADER"]
+    return (header and request.headers.get(header)) or request.remote_addr or "unknown"
+
+
+def _charge(cost: float) -> Response | None:
+    """Charge *cost* estimated seconds to the requesting client; return the
+    response refusing the request if that is over its budget, else None."""
+    retry_after = client_budget.charge(_client_id(), cost)
+    return _over_budget_response(retry_after) if retry_after else None
+
+
+def _refund(cost: float) -> None:
+    """Give back a :func:`_charge` for work that was not done."""
+    client_budget.settle(_client_id(), cost, 0.0)
+
+
+def _over_budget_response(retry_after: float) -> Response:
+    """429 for a client that has used up its budget of estimated work; 413
+    for a request that costs more than the whole budget (``inf``)."""
+    if math.isinf(retry_after):
+        return Response(
+            "This request needs more image processing than the per-client budget allows.\n",
+            status=413,
+            mimetype="text/plain",
+        )
+    return Response(
+        "Too much image processing requested recently; please retry later.\n",
+        status=429,
+        mimetype="text/plain",
+        headers={"Retry-After": str(max(1, math.ceil(min(retry_after, 3600))))},
+    )
+
+
+def _busy_response() -> Response:
+    """Fast 503 telling the client to back off while the pool is saturated."""
+    return Response(
+        "Server is busy processing other images; please retry shortly.\n",
+        status=503,
+        mimetype="text/plain",
+        headers={"Retry-After": str(app.config["RETRY_AFTER_SECONDS"])},
+    )
+
+
+@app.route("/process/batch", methods=["POST"])
+def process_batch():
+    """Process many uploads in parallel and stream the results back as a ZIP.
+
+    Form fields apply to every file; an optional ``options`` field holds a
+    JSON list (in upload order) of per-file overrides.  The archive ends with
+    a ``manifest.json`` recording the outcome of every input.
+    """
+    files = request.files.getlist("files")
+    if not files:
+        return jsonify(error="No files uploaded (expected one or more 'files' parts)"), 400
+
+    try:
+        overrides = json.loads(request.form.get("options") or "[]")
+        if not isinstance(overrides, list) or not all(isinstance(o, dict) for o in overrides):
+            raise ValueError("'options' must be a JSON list of objects")
+        tasks = []
+        for index, file in enumerate(files):
+            override = overrides[index] if index < len(overrides) else {}
+            options = options_from_form({**request.form.to_dict(), **override})
+            tasks.append((index, file.filename or f"file{index}", file, options))
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+
+    if worker_pool.saturated:
+        return _busy_response()
+
+    # Keep every upload past the end of the request (small ones in memory,
+    # spooled ones as files of our own); the pool does the rest.  Uploads
+    # refused from their header are never read.
+    jobs = []
+    for index, filename, file, options in tasks:
+        source, error, cost = None, None, 0.0
+        if not allowed_file(filename):
+            error = "Invalid file type"
+        else:
+            try:
+                cost = cost_model.estimate(render_features(check_upload(file), options))
+                source = keep_upload(file.stream)
+            except UploadRejected as exc:
+                error = str(exc)
+        jobs.append((index, filename, source, error, cost, options))
+    kept = [job[2] for job in jobs if isinstance(job[2], str)]
+    refused = _charge(sum(job[4] for job in jobs))
+    if refused is not None:
+        _remove_files(kept)
+        return refused
+
+    response = Response(
+        stream_zip(_batch_entries(jobs)),
+        mimetype="application/zip",
+        headers={"Content-Disposition": "attachment; filename=batch.zip"},
+    )
+    response.call_on_close(lambda: _remove_files(kept))
+    return response
+
+
+def _remove_files(paths: list[str]) -> None:
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _batch_entries(jobs: list) -> Iterator[tuple[str, bytes]]:
+    """Fan *jobs* out over the worker pool; yield ZIP members as they finish.
+
+    At most one task per worker is in flight for a batch at a time, so a big
+    batch shares the pool's queue with single-image requests instead of
+    filling it.
+    """
+    manifest = [None] * len(jobs)
+    window = max(1, worker_pool.max_workers)
+    in_flight = {}
+
+    def finished(done) -> Iterator[tuple[str, bytes]]:
+        for future in done:
+            index, filename, options = in_flight.pop(future)
+            stem, _ = os.path.splitext(os.path.basename(filename))
+            name = f"{index:04d}_{stem}.{options['format'].lower()}"
+            try:
+                encoded = future.result()
+            except UnidentifiedImageError:
+                manifest[index] = {"input": filename, "error": "Cannot identify image file"}
+                continue
+            except Exception as exc:
+                manifest[index] = {"input": filename, "error": str(exc) or type(exc).__name__}
+                continue
+            manifest[index] = {"input": filename, "output": name, "bytes": len(encoded)}
+            yield name, encoded
+
+    for index, filename, source, error, cost, options in jobs:
+        if error is not None:
+            manifest[index] = {"input": filename, "error": error}
+            continue
+        if len(in_flight) >= window:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            yield from finished(done)
+        future = worker_pool.submit(render_image, source, options, cost=cost)
+        in_flight[future] = (index, filename, options)
+
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        yield from finished(done)
+
+    yield "manifest.json", json.dumps(manifest, indent=2).encode()
+
+
+@app.route("/process/variants", methods=["POST"])
+def process_variants():
+    """Build several widths of one upload from a single decode.
+
+    ``widths`` is a comma-separated list; ``grayscale``, ``sepia`` and
+    ``format`` are as for ``/process``.  Returns a ZIP, or ``multipart/mixed``
+    if the client's ``Accept`` header prefers it.
+    """
+    file = request.files.get("file")
+    if file is None or file.filename == "":
+        return jsonify(error="No file uploaded (expected a 'file' part)"), 400
+    if not allowed_file(file.filename):
+        return jsonify(error="Invalid file type. Allowed types: png, jpg, jpeg, gif"), 400
+    try:
+        info = check_upload(file)
+    except UploadRejected as exc:
+        return jsonify(error=str(exc)), exc.status
+    try:
+        widths = [int(w) for w in request.form.get("widths", "").split(",") if w.strip()]
+    except ValueError:
+        widths = []
+    if not widths or min(widths) <= 0 or len(set(widths)) > MAX_VARIANTS:
+        return jsonify(error=f"'widths' must list 1-{MAX_VARIANTS} positive integers"), 400
+    try:
+        options = options_from_form({**request.form.to_dict(), "resize_option": "none"})
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+
+    # Priced as one full-size render; the smaller widths add a fraction of that.
+    cost = cost_model.estimate(render_features(info, options))
+    refused = _charge(cost)
+    if refused is not None:
+        return refused
+    try:
+        future = worker_pool.submit(
+            render_variants, upload_source(file.stream), widths, options, block=False, cost=cost
+        )
+    except PoolSaturated:
+        _refund(cost)
+        return _busy_response()
+    try:
+        variants = future.result()
+    except UnidentifiedImageError:
+        return jsonify(error="Cannot identify image file"), 400
+
+    stem, _ = os.path.splitext(os.path.basename(file.filename).replace('"', ""))
+    ext = options["format"].lower()
+    entries = [(f"{stem}_{width}w.{ext}", encoded) for width, encoded in variants]
+    if request.accept_mimetypes["multipart/mixed"] > request.accept_mimetypes["application/zip"]:
+        boundary = uuid.uuid4().hex
+        return Response(
+            stream_multipart(entries, f"image/{ext}", boundary),
+            mimetype=f"multipart/mixed; boundary={boundary}",
+        )
+    response = Response(stream_zip(entries), mimetype="application/zip")
+    set_download_name(response.headers, f"{stem}_variants.zip")
+    return response
+
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Queue an upload for background processing and return its job id.
+
+    Takes the same form fields as ``/process``; responds ``202 Accepted``
+    with the job's status and result URLs.
+    """
+    file = request.files.get("file")
+    if file is None or file.filename == "":
+        return jsonify(error="No file uploaded (expected a 'file' part)"), 400
+    if not allowed_file(file.filename):
+        return jsonify(error="Invalid file type. Allowed types: png, jpg, jpeg, gif"), 400
+    try:
+        info = check_upload(file)
+    except UploadRejected as exc:
+        return jsonify(error=str(exc)), exc.status
+    try:
+        options = options_from_form(request.form)
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+
+    cost = cost_model.estimate(render_features(info, options))
+    refused = _charge(cost)
+    if refused is not None:
+        return refused
+    # The worker reads the upload from the spool, not from this process.
+    meta = job_spool.create(file.filename, options, file.stream)
+    try:
+        future = worker_pool.submit(
+            run_job, job_spool.directory, meta, job_spool.input_path(meta["id"]), render_image,
+            block=False, cost=cost,
+        )
+    except PoolSaturated:
+        _refund(cost)
+        job_spool.fail(meta["id"], "Rejected: server busy")
+        return _busy_response()
+    future.add_done_callback(lambda f: _job_crashed(meta["id"], f))
+
+    status_url = url_for("job_status", job_id=meta["id"])
+    response = jsonify(
+        id=meta["id"],
+        status=meta["status"],
+        status_url=status_url,
+        result_url=url_for("job_result", job_id=meta["id"]),
+    )
+    response.status_code = 202
+    response.headers["Location"] = status_url
+    return response
+
+
+def _job_crashed(job_id: str, future) -> None:
+    """Record a job whose worker died before it could report back."""
+    if future.cancelled() or future.exception() is not None:
+        job_spool.fail(job_id, "Worker process failed")
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id: str):
+    """Report a job's state (queued, running, done or failed) with timings."""
+    meta = job_spool.read(job_id)
+    if meta is None:
+        return jsonify(error="Unknown or expired job"), 404
+    return jsonify(public_status(meta))
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id: str):
+    """Stream a finished job's encoded image."""
+    meta = job_spool.read(job_id)
+    if meta is None:
+        return jsonify(error="Unknown or expired job"), 404
+    if meta["status"] == "failed":
+        return jsonify(public_status(meta)), 422
+    if meta["status"] != "done":
+        response = jsonify(public_status(meta))
+        response.status_code = 409
+        response.headers["Retry-After"] = str(app.config["RETRY_AFTER_SECONDS"])
+        return response
+
+    output_format = meta["options"]["format"].lower()
+    stem, _ = os.path.splitext(meta["filename"])
+    return send_file(
+        job_spool.result_path(job_id),
+        mimetype=f"image/{output_format}",
+        as_attachment=True,
+        download_name=f"{stem}_{job_id[:8]}.{output_format}",
+    )
+
+
+@app.route("/images", methods=["POST"])
+def upload_image():
+    """Store an original once and return its content-hash id.
+
+    Variants are then fetched with ``GET /images/<id>/render`` without
+    re-uploading.  Responds 201 for a new image, 200 if it was already stored.
+    """
+    file = request.files.get("file")
+    if file is None or file.filename == "":
+        return jsonify(error="No file uploaded (expected a 'file' part)"), 400
+    if not allowed_file(file.filename):
+        return jsonify(error="Invalid file type. Allowed types: png, jpg, jpeg, gif"), 400
+    try:
+        info = check_upload(file)
+    except UploadRejected as exc:
+        return jsonify(error=str(exc)), exc.status
+
+    image_id, created = image_store.put(file.stream)
+    response = jsonify(
+        id=image_id,
+        width=info.width,
+        height=info.height,
+        format=info.format,
+        render_url=url_for("render_stored_image", image_id=image_id),
+    )
+    response.status_code = 201 if created else 200
+    return response
+
+
+@app.route("/images/<image_id>/render", methods=["GET"])
+def render_stored_image(image_id: str):
+    """Render a stored image.
+
+    Query parameters: ``w`` (width) or ``percent``, ``grayscale``, ``sepia``,
+    ``filters``, ``format`` (negotiated from ``Accept`` if omitted) and
+    ``encoding``.  Results are content-addressed, so responses are immutable
+    and carry an ETag for conditional requests.
+    """
+    if not image_store.exists(image_id):
+        return jsonify(error="Unknown image"), 404
+
+    args = request.args
+    form = {key: args[key] for key in ("grayscale", "sepia", "filters", "format", "encoding")
+            if key in args}
+    if "w" in args:
+        form.update(resize_option="width", width=args["w"])
+    elif "percent" in args:
+        form.update(resize_option="percent", percentage=args["percent"])
+    else:
+        form["resize_option"] = "none"
+    try:
+        options = options_from_form(form, request.accept_mimetypes)
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+
+    key = make_key(image_id.encode(), options)
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        encoded = result_cache.get(key)
+        if encoded is None:
+            img = image_store.open(image_id)
+            animated = options["format"] == "GIF" and is_animated(img)
+            info = UploadInfo(img.format or "", img.width, img.height,
+                              img.n_frames if animated else 1)
+            cost = cost_model.estimate(render_features(info, options))
+            refused = _charge(cost)
+            if refused is not None:
+                return refused
+            try:
+                if animated:
+                    encoded = _render_stored_animation(image_id, img, options, cost)
+                else:
+                    encoded = _render_stored(image_id, img, options, cost)
+            except PoolSaturated:
+                _refund(cost)
+                return _busy_response()
+            except AnimationTooLarge as exc:
+                _refund(cost)
+                return jsonify(error=str(exc)), 413
+            result_cache.put(key, encoded)
+        # Range requests (e.g. resumed downloads) are answered from the buffer.
+        response = buffer_response(
+            encoded, f"image/{options['format'].lower()}", environ=request.environ, etag=key
+        )
+
+    # Same id + options always renders the same bytes, so let caches keep it.
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    if format_negotiated(form):
+        response.vary.add("Accept")
+    return response
+
+
+def _render_stored(image_id: str, img: Image.Image, options: dict, cost: float) -> bytes:
+    """Render the decoded original *img* per *options* and encode it; *cost*
+    is its estimate in seconds.
+
+    With worker processes the render runs in one of them, which maps the
+    pixels from SHARED_PIXELS_DIR instead of receiving them pickled (see
+    :mod:`sharedimage`).  The file is written on the first render of
+    *image_id* and reused by later ones while :data:`shared_pixels` keeps
+    it.  Without workers or that directory, for modes that cannot be shared
+    and when the directory is full, it renders here.  Raises
+    :class:`workers.PoolSaturated` if the pool is full.
+    """
+    if worker_pool.max_workers == 0 or shared_pixels is None or not can_share(img):
+        return render_pixels(img, options)
+    with ExitStack() as stack:
+        try:
+            shared = stack.enter_context(shared_pixels.lease(image_id, img))
+        except OSError:
+            app.logger.warning(
+                "No room to share pixels in %s", shared_pixels.directory, exc_info=True
+            )
+            return render_pixels(img, options)
+        future = worker_pool.submit(render_shared, shared, options, block=False, cost=cost)
+        return future.result()
+
+
+def _render_stored_animation(
+    image_id: str, img: Image.Image, options: dict, cost: float
+) -> bytes:
+    """Render the stored animated GIF *image_id* as GIF, frame by frame.
+
+    The decoded original *img* holds only the first frame, so a worker
+    renders the original file, as ``/process`` does (see :mod:`animation`).
+    Raises :class:`animation.AnimationTooLarge` over ``MAX_ANIMATION_PIXELS``
+    and :class:`workers.PoolSaturated` if the pool is full.
+    """
+    check_budget(img, app.config["MAX_ANIMATION_PIXELS"])
+    return worker_pool.submit(
+        render_image, image_store.path(image_id), options, block=False, cost=cost
+    ).result()
+
+
+@app.route("/images/stats", methods=["GET"])
+def image_store_stats():
+    """Report decoded-image LRU and shared-pixel occupancy and hit counters as JSON."""
+    return jsonify(**image_store.stats(), **(shared_pixels.stats() if shared_pixels else {}))
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Pure-function image operations
 # ──────────────────────────────────────────────────────────────────────────────
+# Large downscales first shrink by an integer factor (JPEG DCT scaling via
+# ``Image.draft`` at decode time, then ``Image.reduce``) and finish with LANCZOS
+# over the last REDUCING_GAP x.  3.0 is Pillow's "indistinguishable from fair
+# resampling" setting; DOWNSCALE_TOLERANCE is the mean absolute per-channel
+# error (0-255 scale) versus a full-resolution LANCZOS that the tests enforce.
+REDUCING_GAP = 3.0
+DOWNSCALE_TOLERANCE = 1.0
+
+
+def target_size(
+    size: tuple[int, int],
+    resize_option: str,
+    target_width: int | None,
+    percentage: int,
+) -> tuple[int, int] | None:
+    """Return the output size for an image of *size*, or None if unchanged."""
+    ow, oh = size
+    if resize_option == "width" and target_width and target_width > 0 and ow != target_width:
+        aspect = oh / ow
+        return (target_width, int(target_width * aspect))
+
+    if resize_option == "percent" and percentage > 0 and percentage != 100:
+        scale = percentage / 100.0
+        return (max(1, int(ow * scale)), max(1, int(oh * scale)))
+
+    return None
+
+
+def render_features(info: UploadInfo, options: dict) -> RenderFeatures:
+    """What :class:`costs.CostModel` needs to price rendering *info* with *options*."""
+    size = (info.width, info.height)
+    out = target_size(
+        size, options["resize_option"], options.get("width"), options.get("percentage", 100)
+    ) or size
+    scale = 1
+    if info.format == "JPEG":  # mirror the DCT scale draft_for_downscale will get
+        request = (max(1, int(out[0] * REDUCING_GAP)), max(1, int(out[1] * REDUCING_GAP)))
+        if request[0] < size[0] and request[1] < size[1]:
+            fit = min(size[0] // request[0], size[1] // request[1])
+            scale = next(factor for factor in (8, 4, 2, 1) if fit >= factor)
+    return RenderFeatures(
+        source_format=info.format,
+        source_pixels=size[0] * size[1],
+        decoded_pixels=-(-size[0] // scale) * -(-size[1] // scale),
+        output_pixels=out[0] * out[1],
+        resized=out != size,
+        grayscale=options["grayscale"],
+        sepia=options["sepia"],
+        output_format=options["format"],
+        encoding=options["encoding"],
+        frames=info.frames if options["format"] == "GIF" else 1,
+        filters=compile_chain(parse_chain(options.get("filters"))).kind,
+    )
+
+
+def draft_for_downscale(
+    img: Image.Image, size: tuple[int, int]
+) -> tuple[float, float, float, float] | None:
+    """Ask the decoder of a not-yet-loaded *img* to decode at reduced scale.
+
+    Only JPEG supports this (1/2, 1/4 or 1/8 DCT scaling).  The decoded image
+    keeps at least ``REDUCING_GAP`` times *size*.  Returns the source box to
+    pass to ``resize`` so geometry stays exact, or None if nothing changed.
+    """
+    request = (int(size[0] * REDUCING_GAP), int(size[1] * REDUCING_GAP))
+    if request[0] >= img.width or request[1] >= img.height:
+        return None
+    result = img.draft(None, request)
+    return result[1] if result else None
+
+
+def plan_processing(
+    img: Image.Image,
+    resize_option: str,
+    target_width: int | None,
+    percentage: int,
+    apply_grayscale: bool,
+    apply_sepia: bool,
+    reduce_on_decode: bool = True,
+    owned: bool = False,
+    tile_budget: int | None = None,
+    filters: str | None = None,
+) -> Plan:
+    """Plan the work for :func:`process_image_data` (see :mod:`pipeline`).
+
+    The target size is planned from the header dimensions before anything is
+    decoded.  For large downscales (and unless *reduce_on_decode* is False) a
+    lazily opened JPEG is switched to reduced-scale decoding here, and the
+    resize reduces by an integer factor first, so cost tracks the output
+    rather than the input.  This may change ``img.size`` if *img* has not been
+    loaded yet.
+    """
+    header_size = img.size
+    new_size = target_size(header_size, resize_option, target_width, percentage)
+    box = None
+    reducing_gap = None
+    notes = []
+    if new_size and reduce_on_decode and new_size[0] < img.width:
+        box = draft_for_downscale(img, new_size)
+        reducing_gap = REDUCING_GAP
+        if box is not None:
+            source = f"{header_size[0]}x{header_size[1]}"
+            notes.append(f"decoder draft: {source} decodes as {img.width}x{img.height}")
+
+    return plan_operations(
+        img.size,
+        img.mode,
+        new_size,
+        apply_grayscale=apply_grayscale,
+        apply_sepia=apply_sepia,
+        filters=filters,
+        box=box,
+        reducing_gap=reducing_gap,
+        owned=owned,
+        notes=notes,
+        tile_budget=tile_budget,
+    )
+
+
 def process_image_data(
     img: Image.Image,
     resize_option: str,
@@ -130,55 +1266,379 @@ def process_image_data(
     percentage: int,
     apply_grayscale: bool,
     apply_sepia: bool,
+    reduce_on_decode: bool = True,
+    owned: bool = False,
+    timer: StageTimer = NULL_TIMER,
+    tile_budget: int | None = None,
+    filters: str | None = None,
 ) -> Image.Image:
-    """Resize and/or filter *img* according to the supplied options."""
-    processed = img.copy()
+    """Resize and/or filter *img* according to the supplied options.
 
-    # ----- resizing -----
-    ow, oh = processed.size
-    if resize_option == "width" and target_width and target_width > 0 and ow != target_width:
-        aspect = oh / ow
-        new_size = (target_width, int(target_width * aspect))
-        processed = processed.resize(new_size, Image.Resampling.LANCZOS)
+    Runs the plan from :func:`plan_processing`.  Pass ``owned=True`` when the
+    caller will not use *img* again, which lets a no-op plan return it
+    without a defensive copy.  Decoding and every planned step are timed on
+    *timer*.  With a *tile_budget* (bytes), large images are processed in
+    strips with the same output (see :mod:`tiles`).  *filters* is a chain of
+    further tone filters, run after sepia (see :mod:`filters`).
+    """
+    plan = plan_processing(
+        img,
+        resize_option,
+        target_width,
+        percentage,
+        apply_grayscale,
+        apply_sepia,
+        reduce_on_decode=reduce_on_decode,
+        owned=owned,
+        tile_budget=tile_budget,
+        filters=filters,
+    )
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug(plan.explain())
+    with timer.stage("decode"):
+        img.load()
+    timer.count_pixels(img.width * img.height)
+    return plan.run(img, timer)
 
-    elif resize_option == "percent" and percentage > 0 and percentage != 100:
-        scale = percentage / 100.0
-        nw = max(1, int(ow * scale))
-        nh = max(1, int(oh * scale))
-        processed = processed.resize((nw, nh), Image.Resampling.LANCZOS)
 
-    # ----- filters -----
+def apply_filters(
+    img: Image.Image, apply_grayscale: bool, apply_sepia: bool, filters: str | None = None
+) -> Image.Image:
+    """Apply the enabled tone filters to *img* (grayscale first, then sepia,
+    then the *filters* chain, the last two in one pass)."""
     if apply_grayscale:
-        processed = ImageOps.grayscale(processed)
-    if apply_sepia:
-        processed = apply_sepia_filter(processed)
+        img = ImageOps.grayscale(img)
+    chain = tone_chain(apply_sepia, filters)
+    if chain:
+        img = compile_chain(chain).apply(img)
+    return img
+
+
+# Responsive variants are resampled from an already-built smaller variant when
+# it is at least PYRAMID_GAP x the target width (otherwise from the largest
+# one).  The extra resampling step stays within VARIANT_TOLERANCE (mean
+# absolute error, 0-255) of processing each width independently.
+PYRAMID_GAP = 2.0
+VARIANT_TOLERANCE = 1.0
+MAX_VARIANTS = 16
+
+
+def build_variants(
+    img: Image.Image,
+    widths: list[int],
+    apply_grayscale: bool,
+    apply_sepia: bool,
+    reduce_on_decode: bool = True,
+    filters: str | None = None,
+) -> list[tuple[int, Image.Image]]:
+    """Decode *img* once and return ``(width, image)`` per width, largest first.
+
+    The largest variant is built like :func:`process_image_data` (including
+    reduce-on-decode).  Filters run once, on whichever of the source and the
+    largest variant is smaller, and every other variant is a downscale of a
+    filtered variant (see ``PYRAMID_GAP``).
+    """
+    sizes = [
+        (w, target_size(img.size, "width", w, 100) or img.size)
+        for w in sorted(set(widths), reverse=True)
+    ]
+    largest = sizes[0][1]
+    box = None
+    reducing_gap = None
+    if reduce_on_decode and largest[0] < img.width:
+        box = draft_for_downscale(img, largest)
+        reducing_gap = REDUCING_GAP
+
+    if largest[0] * largest[1] > img.width * img.height:
+        top = apply_filters(img.copy(), apply_grayscale, apply_sepia, filters)
+        top = top.resize(largest, Image.Resampling.LANCZOS)
+    else:
+        top = img.copy()
+        if largest != img.size or box is not None:
+            top = top.resize(largest, Image.Resampling.LANCZOS, box=box, reducing_gap=reducing_gap)
+        top = apply_filters(top, apply_grayscale, apply_sepia, filters)
+
+    variants = [(sizes[0][0], top)]
+    for width, size in sizes[1:]:
+        sources = [v for _, v in variants if v.width >= PYRAMID_GAP * size[0]]
+        source = sources[-1] if sources else top
+        variants.append(
+            (width, source.resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP))
+        )
+    return variants
+
+
+_FALSE_VALUES = {"", "0", "false", "off", "no"}
+
+
+def _flag_field(form, name: str) -> bool:
+    """A checkbox-style field: absent or false-ish means off."""
+    value = form.get(name)
+    if isinstance(value, bool) or value is None:
+        return bool(value)
+    return str(value).strip().lower() not in _FALSE_VALUES
+
+
+def _int_field(form, name: str, default: int | None) -> int | None:
+    """An integer field; missing or unparsable values give *default*."""
+    try:
+        return int(form.get(name))
+    except (TypeError, ValueError):
+        return default
+
+
+def options_from_form(form, accept=None) -> dict:
+    """Parse and validate processing options from a form-like mapping.
+
+    Raises ValueError (with a user-facing message) for an unusable width or
+    filter chain; a non-positive percentage falls back to the original size.  Without a known
+    ``format`` (or with ``format=auto``) the format is negotiated from
+    *accept*, the request's ``Accept`` header, if given; an unknown
+    ``encoding`` profile falls back to ``ENCODING_PROFILE``.
+    """
+    resize_option = form.get("resize_option", "width")  # width • percent • none
+    target_width = _int_field(form, "width", None)
+    if resize_option == "width" and (target_width is None or target_width <= 0):
+        raise ValueError("Invalid input for dimensions")
+
+    output_format = str(form.get("format", "auto")).upper()
+    if output_format not in OUTPUT_FORMATS:
+        output_format = negotiate_format(accept)
+    encoding = str(form.get("encoding", "")).lower()
+    if encoding not in PROFILES:
+        encoding = app.config["ENCODING_PROFILE"]
+
+    return normalize_options(
+        resize_option,
+        target_width,
+        _int_field(form, "percentage", 100),
+        _flag_field(form, "grayscale"),
+        _flag_field(form, "sepia"),
+        output_format,
+        encoding,
+        str(form.get("filters") or ""),
+    )
+
+
+def format_negotiated(form) -> bool:
+    """Whether the output format of *form* comes from the ``Accept`` header,
+    so responses must carry ``Vary: Accept``."""
+    return str(form.get("format", "auto")).upper() not in OUTPUT_FORMATS
+
+
+def normalize_options(
+    resize_option: str,
+    target_width: int | None,
+    percentage: int | None,
+    apply_grayscale: bool,
+    apply_sepia: bool,
+    output_format: str,
+    encoding: str = DEFAULT_PROFILE,
+    filters: str | None = None,
+) -> dict:
+    """Return the canonical options dict for rendering and cache keys.
+
+    Options that cannot affect the output (a width in percent mode, 100%, an
+    unknown resize option, no-op filters) are dropped so equivalent requests
+    share a key; a filter chain is stored as its signature.  Raises
+    ValueError for an invalid chain (see :func:`filters.parse_chain`).
+    """
+    options = {
+        "resize_option": "none",
+        "grayscale": bool(apply_grayscale),
+        "sepia": bool(apply_sepia),
+        "format": output_format,
+        "encoding": encoding,
+    }
+    if resize_option == "width" and target_width and target_width > 0:
+        options.update(resize_option="width", width=target_width)
+    elif resize_option == "percent" and percentage and percentage > 0 and percentage != 100:
+        options.update(resize_option="percent", percentage=percentage)
+    chain = parse_chain(filters)
+    if chain:
+        options["filters"] = chain_signature(chain)
+    return options
+
+
+def render_image(source: bytes | str, options: dict, timer: StageTimer = NULL_TIMER) -> bytes:
+    """Decode *source* (the image's bytes or a path to it), process it per
+    *options* (see :func:`normalize_options`) and return the encoded result,
+    timing each stage on *timer*.
+
+    Animated GIFs rendered as GIF keep every frame (see :mod:`animation`);
+    other output formats get the first frame.
+    """
+    processed = _decode_and_process(source, options, timer)
+    img_io = io.BytesIO()
+    _encode_result(processed, options, img_io, timer)
+    return img_io.getvalue()
+
+
+def render_image_to_file(
+    source: bytes | str, options: dict, path: str, timer: StageTimer = NULL_TIMER
+) -> int:
+    """:func:`render_image`, but encode straight into a new file at *path*
+    and return its size.
+
+    The file is created only once decoding and processing have succeeded, so a
+    reader can follow it (see :func:`streaming.follow_file`) from the moment it
+    appears.  It is removed again if encoding fails.
+    """
+    processed = _decode_and_process(source, options, timer)
+    try:
+        with open(path, "wb") as fh:
+            _encode_result(processed, options, fh, timer)
+            return fh.tell()
+    except BaseException:
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
+
+
+class _Animation(NamedTuple):
+    frames: Iterator[Frame]  # processed lazily, as they are written
+    loop: int | None
+
+
+def open_source(source: bytes | str) -> Image.Image:
+    """Open an image given as bytes or as a path (see :func:`uploads.upload_source`)."""
+    return Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+
+
+def _decode_and_process(
+    source: bytes | str, options: dict, timer: StageTimer
+) -> Image.Image | _Animation:
+    """The processed image, or for an animated GIF rendered as GIF its
+    processed frames (the first one processed already, so that errors in
+    decoding or processing surface here)."""
+    with timer.stage("open"):
+        img = open_source(source)
+    process = partial(
+        process_image_data,
+        resize_option=options["resize_option"],
+        target_width=options.get("width"),
+        percentage=options.get("percentage", 100),
+        apply_grayscale=options["grayscale"],
+        apply_sepia=options["sepia"],
+        filters=options.get("filters"),
+        owned=True,
+        timer=timer,
+        tile_budget=app.config["TILE_BUDGET_BYTES"] or None,
+    )
+    if options["format"] != "GIF" or not is_animated(img):
+        return process(img)
+    check_budget(img, app.config["MAX_ANIMATION_PIXELS"])
+    frames = (frame._replace(image=process(frame.image)) for frame in iter_frames(img, timer))
+    loop = img.info.get("loop")
+    first = next(frames)
+    return _Animation(itertools.chain([first], frames), loop)
 
-    return processed
+
+def _encode_result(
+    processed: Image.Image | _Animation, options: dict, fp, timer: StageTimer
+) -> None:
+    if isinstance(processed, _Animation):
+        write_gif(processed.frames, fp, processed.loop, options["encoding"], timer)
+        return
+    with timer.stage("encode"):
+        write_image(processed, options["format"], fp, options["encoding"])
+
+
+def render_image_timed(
+    source: bytes | str,
+    options: dict,
+    timed: bool = True,
+    profile: bool = False,
+    path: str | None = None,
+) -> tuple[bytes | int, StageTimer, dict | None]:
+    """:func:`render_image` that also returns its stage timings and, with
+    *profile*, a capture: the marshalled cProfile stats plus the source's
+    width, height, mode and format.  With *path* it runs
+    :func:`render_image_to_file` instead and returns the size written.
+
+    Runs in a worker process, so both travel back with the result.
+    """
+    timer = StageTimer() if timed else NULL_TIMER
+    if path is None:
+        render, args = render_image, (source, options, timer)
+    else:
+        render, args = render_image_to_file, (source, options, path, timer)
+    if not profile:
+        return render(*args), timer, None
+    with open_source(source) as img:  # header only
+        capture = {"width": img.width, "height": img.height, "mode": img.mode, "format": img.format}
+    result, capture["stats"] = profile_call(render, *args)
+    return result, timer, capture
+
+
+def render_pixels(img: Image.Image, options: dict) -> bytes:
+    """Process the decoded *img* per *options* and return it encoded; *img*
+    itself is left as it was."""
+    processed = process_image_data(
+        img,
+        resize_option=options["resize_option"],
+        target_width=options.get("width"),
+        percentage=options.get("percentage", 100),
+        apply_grayscale=options["grayscale"],
+        apply_sepia=options["sepia"],
+        tile_budget=app.config["TILE_BUDGET_BYTES"] or None,
+        filters=options.get("filters"),
+    )
+    return encode_image(processed, options["format"], options["encoding"])
+
+
+def render_shared(shared: SharedImage, options: dict) -> bytes:
+    """:func:`render_pixels` on the pixels another process shared (see
+    :mod:`sharedimage`), mapped rather than copied.  Runs in a worker process."""
+    return call_with_image(shared, render_pixels, options)
+
+
+def render_variants(
+    source: bytes | str, widths: list[int], options: dict
+) -> list[tuple[int, bytes]]:
+    """Decode *source* (bytes or a path) once and return ``(width, encoded)``
+    for every width.
+
+    *options* supplies the filters and output format (see
+    :func:`normalize_options`); its resize settings are ignored.  An
+    animated GIF rendered as GIF keeps every frame: each width is then a
+    :func:`render_image` of its own.
+    """
+    img = open_source(source)
+    if options["format"] == "GIF" and is_animated(img):
+        return [
+            (width, render_image(source, {**options, "resize_option": "width", "width": width}))
+            for width in sorted(set(widths), reverse=True)
+        ]
+    variants = build_variants(
+        img, widths, options["grayscale"], options["sepia"], filters=options.get("filters")
+    )
+    return [
+        (width, encode_image(variant, options["format"], options["encoding"]))
+        for width, variant in variants
+    ]
+
+
+def encode_image(img: Image.Image, output_format: str, encoding: str = DEFAULT_PROFILE) -> bytes:
+    """Encode *img* as *output_format* (JPEG, PNG, GIF or WEBP) with the
+    *encoding* profile (see :mod:`encoding`)."""
+    img_io = io.BytesIO()
+    write_image(img, output_format, img_io, encoding)
+    return img_io.getvalue()
+
+
+def write_image(img: Image.Image, output_format: str, fp, encoding: str = DEFAULT_PROFILE) -> None:
+    """Encode *img* as *output_format* into the binary file object *fp*."""
+    save_image(img, output_format, fp, encoding)
 
 
 def apply_sepia_filter(img: Image.Image) -> Image.Image:
-    """Return *img* with a naïve sepia tone applied."""
-    if img.mode != "RGB":
-        img = img.convert("RGB")
-
-    px = img.load()
-    for y in range(img.height):
-        for x in range(img.width):
-            r, g, b = px[x, y]
-            # tr = min(255, int(0.393 * r + 0.769 * g + 0.189 * b))
-            # tg = min(255, int(0.349 * r + 0.686 * g + 0.168 * b))
-            # tb = min(255, int(0.272 * r + 0.534 * g + 0.131 * b))
-            
-            # Slightly warmer sepia tone by increasing red component
-            tr = min(255, int(0.423 * r + 0.769 * g + 0.189 * b))
-            tg = min(255, int(0.349 * r + 0.686 * g + 0.168 * b))
-            tb = min(255, int(0.272 * r + 0.534 * g + 0.131 * b))
-            px[x, y] = (tr, tg, tb)
-    return img
+    """Return *img* with a warm sepia tone applied (see :mod:`tone`)."""
+    return apply_color_matrix(img, SEPIA_WARM)
 
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Dev server
 # ──────────────────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    create_app({"STARTUP_DIAGNOSTICS": True}).run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
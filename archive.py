@@ -0,0 +1,62 @@
+"""Streaming multi-file response bodies (ZIP and ``multipart/mixed``).
+
+``stream_zip`` turns an iterable of ``(name, bytes)`` pairs into an iterator of
+archive chunks, emitting each member as soon as it is available.  Nothing but
+the member currently being written is held in memory, so it can back a
+streamed HTTP response.  Members are stored uncompressed (the payloads are
+already-compressed images) and use data descriptors, since the output cannot
+be seeked back into.
+"""
+import io
+import zipfile
+from collections.abc import Iterable, Iterator
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, non-seekable buffer that hands back what was written."""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries: Iterable[tuple[str, bytes]]) -> Iterator[bytes]:
+    """Yield a ZIP archive of *entries* chunk by chunk, one member at a time."""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        for name, data in entries:
+            zf.writestr(name, data)
+            yield sink.drain()
+    yield sink.drain()  # central directory
+
+
+def stream_multipart(
+    entries: Iterable[tuple[str, bytes]], content_type: str, boundary: str
+) -> Iterator[bytes]:
+    """Yield a ``multipart/mixed`` body with one attachment part per entry."""
+    for name, data in entries:
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f'Content-Disposition: attachment; filename="{name}"\r\n'
+            f"Content-Length: {len(data)}\r\n\r\n"
+        ).encode()
+        yield data
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
@@ -0,0 +1,206 @@
+"""ASGI entry point: the application with non-blocking request and response I/O.
+
+Under a WSGI server a request holds a worker thread from its first byte to
+its last, so a client on a slow link pins a thread for the whole upload and
+download while the image work takes milliseconds.  :class:`AsgiApp` moves
+the I/O onto the event loop:
+
+* the request body is received without blocking, into memory and past
+  ``UPLOAD_SPOOL_BYTES`` into a temporary file, and only a complete request
+  is dispatched (a body over ``MAX_CONTENT_LENGTH`` is dropped unread and
+  answered with the application's usual 413);
+* the Flask application then runs on one of ``ASGI_APP_THREADS`` threads,
+  which parses the buffered form, consults the caches and waits for the
+  image worker pool to decode, process and encode.  That pool
+  (``IMAGE_WORKERS``, ``IMAGE_QUEUE_LIMIT``) bounds the CPU work in flight;
+  the threads bound the requests being handled; open connections are
+  bounded only by the server (e.g. uvicorn's ``--limit-concurrency``);
+* the response is sent without blocking, in ``CHUNK_SIZE`` pieces so the
+  server's flow control applies.  A body that is generated (a streamed
+  render, a ZIP archive) is pulled from the application a chunk at a time
+  on the same threads.  Output passed to the legacy WSGI ``write()``
+  callable is buffered and sent ahead of it.
+
+Every route, form field and response is the Flask application's, unchanged.
+Serve it with any ASGI server, e.g.
+``uvicorn --factory 'asgi:create_asgi_app' --workers 2``.
+"""
+import asyncio
+import itertools
+import sys
+import tempfile
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+
+from app import create_app
+
+CHUNK_SIZE = 64 * 1024
+
+
+class AsgiApp:
+    """ASGI 3 application serving the WSGI callable *wsgi_app*.
+
+    *threads* run *wsgi_app*; bodies are spooled to *spool_dir* past
+    *spool_bytes*, and *max_body* (read per request, None for no limit)
+    returns the largest body worth receiving.
+    """
+
+    def __init__(
+        self,
+        wsgi_app: Callable,
+        threads: int,
+        spool_bytes: int,
+        spool_dir: str | None = None,
+        max_body: Callable[[], int | None] = lambda: None,
+    ) -> None:
+        self.wsgi_app = wsgi_app
+        self.spool_bytes = spool_bytes
+        self.spool_dir = spool_dir
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="asgi-app")
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise ValueError(f"unsupported ASGI scope {scope['type']!r}")
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes, dir=self.spool_dir)
+        try:
+            length = await self._receive_body(scope, receive, body)
+            if length is None:
+                return  # the client went away
+            await self._respond(_environ(scope, body, length), send)
+        finally:
+            body.close()
+
+    # ----- request -----
+    async def _receive_body(self, scope: dict, receive: Callable, body) -> int | None:
+        """Receive the request body into *body*; return its length, or None
+        on disconnect.  Past the limit, stop and return the length so far."""
+        limit = self.max_body()
+        declared = _header(scope, b"content-length")
+        if limit is not None and declared and declared.isdigit() and int(declared) > limit:
+            return int(declared)
+        length = 0
+        more = True
+        while more:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunk = message.get("body", b"")
+            length += len(chunk)
+            if limit is not None and length > limit:
+                body.truncate(0)
+                return length
+            body.write(chunk)
+            more = message.get("more_body", False)
+        body.seek(0)
+        return length
+
+    # ----- response -----
+    async def _respond(self, environ: dict, send: Callable) -> None:
+        loop = asyncio.get_running_loop()
+        status, headers, written, iterable = await loop.run_in_executor(
+            self.executor, self._call, environ
+        )
+        try:
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            chunks = itertools.chain(written, iterable)
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+                if chunk is None:
+                    break
+                for start in range(0, len(chunk), CHUNK_SIZE):
+                    piece = bytes(chunk[start:start + CHUNK_SIZE])
+                    await send({"type": "http.response.body", "body": piece, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if hasattr(iterable, "close"):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+    def _call(self, environ: dict) -> tuple[int, list, list[bytes], Iterable[bytes]]:
+        """Run the WSGI application on *environ* (in a worker thread); return
+        the status, headers, anything it passed to ``write()`` and its
+        iterable."""
+        started = []
+        written = []
+
+        def start_response(status: str, headers: list, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+            return written.append
+
+        iterable = self.wsgi_app(environ, start_response)
+        status, headers = started
+        return (
+            int(status.split(" ", 1)[0]),
+            [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+            written,
+            iterable,
+        )
+
+    # ----- lifespan -----
+    async def _lifespan(self, receive: Callable, send: Callable) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def _header(scope: dict, name: bytes) -> str | None:
+    for key, value in scope["headers"]:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _environ(scope: dict, body, length: int) -> dict:
+    """The WSGI environ (PEP 3333) for the HTTP *scope* with the received *body*."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if client:
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = client[0], str(client[1])
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        value = value.decode("latin-1")
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    # The body has been received in full (chunked or not), so its length is known.
+    if length or "CONTENT_LENGTH" in environ:
+        environ["CONTENT_LENGTH"] = str(length)
+    return environ
+
+
+def create_asgi_app(config: dict | None = None) -> AsgiApp:
+    """Build the application (see :func:`app.create_app`) and wrap it for ASGI."""
+    flask_app = create_app(config)
+    return AsgiApp(
+        flask_app,
+        flask_app.config["ASGI_APP_THREADS"],
+        flask_app.config["UPLOAD_SPOOL_BYTES"],
+        flask_app.config["UPLOAD_SPOOL_DIR"],
+        max_body=lambda: flask_app.config["MAX_CONTENT_LENGTH"],
+    )
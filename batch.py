@@ -0,0 +1,348 @@
+"""Offline batch processing: the web app's transformations over directory trees.
+
+Usage::
+
+    python batch.py photos/ -o out/ --width 800 --format WEBP
+    python batch.py a/ b/ -o out/ --percent 50 --sepia --workers 8
+
+Every image under the inputs (by extension, as for uploads) is vetted with
+:func:`uploads.inspect_upload`, rendered with :func:`app.render_image_to_file`
+using the same options as ``/process`` and written to the same relative path
+under the output directory, with the extension of the output format.  With
+several inputs, each keeps its own name there: ``a/x.png`` and ``b/x.png``
+go to ``out/a/x.webp`` and ``out/b/x.webp`` (see :func:`input_bases`).
+
+Memory stays bounded however many files there are:
+
+* the trees are walked lazily with ``os.scandir``, one directory open at a
+  time, and files are submitted to the process pool as they are found, with
+  at most ``2 x workers`` in flight;
+* workers read their input files themselves, so only paths cross processes;
+* the manifest of finished files lives in SQLite next to the outputs, not in
+  memory.
+
+Outputs are written to a temporary file and renamed into place, so an
+interrupted run never leaves a truncated image behind.  Rerunning the same
+command resumes it: files whose manifest entry matches their size, mtime and
+the options are skipped (``--force`` redoes them).  Failed files are recorded
+with their error and retried on the next run.  Throughput (images/s and
+megapixels/s of source image) is reported every ``--progress`` seconds.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import NamedTuple
+
+from app import (
+    ALLOWED_EXTENSIONS,
+    UPLOAD_FORMATS,
+    app,
+    normalize_options,
+    render_image_to_file,
+)
+from encoding import DEFAULT_PROFILE, OUTPUT_FORMATS, PROFILES
+from startup import configure_pillow
+from uploads import inspect_upload
+
+MANIFEST_NAME = ".batch-manifest.sqlite"
+# Manifest rows are committed in groups; a crash loses at most this many
+# records (and so redoes that much work), never an output.
+COMMIT_EVERY = 200
+
+
+class Task(NamedTuple):
+    """One input file and where its output goes."""
+
+    source: str
+    name: str  # path relative to its input root, the manifest key
+    output: str
+    size: int
+    mtime_ns: int
+
+
+class Outcome(NamedTuple):
+    """What a worker reports for one file."""
+
+    pixels: int  # source pixels x frames
+    written: int  # output bytes
+    error: str | None = None
+
+
+def iter_images(root: str, exclude: str | None = None) -> Iterator[tuple[str, os.stat_result]]:
+    """Yield ``(path, stat)`` for every file under *root* with an allowed
+    extension, without ever listing a whole tree; *exclude* is a directory
+    to leave out (the output, when it is inside an input)."""
+    if not os.path.isdir(root):
+        yield root, os.stat(root)
+        return
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if exclude is None or not os.path.samefile(entry.path, exclude):
+                        stack.append(entry.path)
+                elif _allowed(entry.name) and entry.is_file():
+                    yield entry.path, entry.stat()
+
+
+def _allowed(name: str) -> bool:
+    return not name.startswith(".") and name.rsplit(".", 1)[-1].lower() in ALLOWED_EXTENSIONS
+
+
+def input_bases(inputs: Iterable[str]) -> list[tuple[str, str]]:
+    """Pair each of *inputs* with the directory its output names are relative to.
+
+    A single input's files keep their path relative to it.  With several,
+    each one's files are named from its parent directory on, so ``a/x.png``
+    and ``b/x.png`` become ``a/x.png`` and ``b/x.png`` rather than both
+    ``x.png``.  Raises :class:`ValueError` if two inputs would still write
+    the same names (``x/photos`` and ``y/photos``, or a directory and a file
+    inside it).
+    """
+    inputs = list(inputs)
+    if len(inputs) == 1:
+        root = inputs[0]
+        return [(root, root if os.path.isdir(root) else os.path.dirname(root))]
+    pairs, names = [], []
+    for root in inputs:
+        path = os.path.abspath(root)
+        base = os.path.dirname(path if os.path.isdir(path) else os.path.dirname(path))
+        pairs.append((root, base))
+        names.append((tuple(os.path.relpath(path, base).split(os.sep)), root))
+    # Sorted, a name is followed by the names it contains, so comparing
+    # neighbours finds every clash.
+    names.sort()
+    for (name, root), (other, other_root) in zip(names, names[1:]):
+        if other[: len(name)] == name:
+            raise ValueError(
+                f"{root} and {other_root} would both write to {os.path.join(*name)} "
+                "in the output directory; process them separately"
+            )
+    return pairs
+
+
+def iter_tasks(inputs: Iterable[str], output_dir: str, output_format: str) -> Iterator[Task]:
+    """The files of *inputs* as :class:`Task` objects, lazily; their names
+    are chosen by :func:`input_bases`, which is checked before walking."""
+    bases = input_bases(inputs)
+    suffix = "." + output_format.lower()
+
+    def walk() -> Iterator[Task]:
+        for root, base in bases:
+            for path, st in iter_images(root, exclude=output_dir):
+                name = os.path.relpath(path, base)
+                output = os.path.join(output_dir, os.path.splitext(name)[0] + suffix)
+                yield Task(path, name, output, st.st_size, st.st_mtime_ns)
+
+    return walk()
+
+
+class Manifest:
+    """Which files a previous run already processed, with which options.
+
+    Stored in SQLite so that lookups over millions of entries need neither
+    a full load nor much memory, and a killed run keeps what it committed.
+    """
+
+    def __init__(self, path: str, options: dict) -> None:
+        self.signature = json.dumps(options, sort_keys=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER,"
+            " mtime_ns INTEGER, options TEXT, status TEXT, error TEXT, pixels INTEGER,"
+            " bytes INTEGER, finished REAL)"
+        )
+        self._uncommitted = 0
+
+    def is_done(self, task: Task) -> bool:
+        row = self.db.execute(
+            "SELECT size, mtime_ns, options FROM files WHERE name = ? AND status = 'done'",
+            (task.name,),
+        ).fetchone()
+        return row == (task.size, task.mtime_ns, self.signature)
+
+    def record(self, task: Task, outcome: Outcome) -> None:
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (task.name, task.size, task.mtime_ns, self.signature,
+             "failed" if outcome.error else "done", outcome.error, outcome.pixels,
+             outcome.written, time.time()),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self) -> None:
+        self.db.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
+
+
+def init_process() -> None:
+    """Apply the app's pixel budget and Pillow plugins to this process."""
+    configure_pillow(app.config["MAX_IMAGE_PIXELS"], UPLOAD_FORMATS | set(OUTPUT_FORMATS))
+
+
+def process_file(task: Task, options: dict) -> Outcome:
+    """Render one file into ``task.output``, atomically; runs in a worker.
+
+    Errors are reported in the outcome rather than raised, so one bad file
+    does not stop the batch.
+    """
+    try:
+        with open(task.source, "rb") as fh:
+            info = inspect_upload(
+                fh, UPLOAD_FORMATS, app.config["MAX_IMAGE_PIXELS"],
+                app.config["MAX_ANIMATION_PIXELS"],
+            )
+            data = fh.read()
+        directory = os.path.dirname(task.output) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        os.close(fd)
+        try:
+            written = render_image_to_file(data, options, tmp)  # removes tmp on failure
+            os.replace(tmp, task.output)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+    except Exception as exc:
+        return Outcome(0, 0, str(exc) or type(exc).__name__)
+    return Outcome(info.width * info.height * info.frames, written)
+
+
+class Progress:
+    """Counts and throughput of a run."""
+
+    def __init__(self, out=sys.stderr, interval: float = 5.0) -> None:
+        self.out = out
+        self.interval = interval
+        self.started = self._last = time.perf_counter()
+        self.done = self.skipped = self.failed = 0
+        self.pixels = 0
+        self.written = 0
+
+    def add(self, outcome: Outcome) -> None:
+        if outcome.error:
+            self.failed += 1
+        else:
+            self.done += 1
+            self.pixels += outcome.pixels
+            self.written += outcome.written
+        now = time.perf_counter()
+        if self.interval and now - self._last >= self.interval:
+            self._last = now
+            print(self.summary(), file=self.out, flush=True)
+
+    def summary(self) -> str:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return (
+            f"{self.done} done, {self.skipped} skipped, {self.failed} failed in {elapsed:.1f} s: "
+            f"{self.done / elapsed:.1f} images/s, {self.pixels / 1e6 / elapsed:.1f} MP/s"
+        )
+
+
+def run_batch(
+    inputs: Iterable[str],
+    output_dir: str,
+    options: dict,
+    workers: int | None = None,
+    force: bool = False,
+    progress: Progress | None = None,
+    errors=sys.stderr,
+) -> Progress:
+    """Process every image under *inputs* into *output_dir* and return the
+    counts.  ``workers=0`` processes files inline."""
+    tasks = iter_tasks(inputs, output_dir, options["format"])
+    os.makedirs(output_dir, exist_ok=True)
+    progress = progress or Progress()
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME), options)
+    workers = (os.cpu_count() or 1) if workers is None else workers
+
+    def finish(task: Task, outcome: Outcome) -> None:
+        manifest.record(task, outcome)
+        if outcome.error:
+            print(f"{task.source}: {outcome.error}", file=errors, flush=True)
+        progress.add(outcome)
+
+    def todo() -> Iterator[Task]:
+        for task in tasks:
+            if not force and manifest.is_done(task):
+                progress.skipped += 1
+            else:
+                yield task
+
+    init_process()
+    try:
+        if workers == 0:
+            for task in todo():
+                finish(task, process_file(task, options))
+            return progress
+        with ProcessPoolExecutor(workers, initializer=init_process) as pool:
+            in_flight: dict[Future, Task] = {}
+            for task in todo():
+                if len(in_flight) >= 2 * workers:
+                    completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        finish(in_flight.pop(future), future.result())
+                in_flight[pool.submit(process_file, task, options)] = task
+            for future in wait(in_flight).done:
+                finish(in_flight[future], future.result())
+        return progress
+    finally:
+        manifest.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="image files or directories")
+    parser.add_argument("-o", "--output", required=True, help="output directory")
+    resize = parser.add_mutually_exclusive_group()
+    resize.add_argument("--width", type=int, help="resize to this width (pixels)")
+    resize.add_argument("--percent", type=int, help="resize to this percentage")
+    parser.add_argument("--grayscale", action="store_true")
+    parser.add_argument("--sepia", action="store_true")
+    parser.add_argument("--filters", default="", help="tone-filter chain, e.g. brightness:1.2,invert")
+    parser.add_argument("--format", default="JPEG", type=str.upper, choices=OUTPUT_FORMATS)
+    parser.add_argument("--encoding", default=DEFAULT_PROFILE, choices=PROFILES)
+    parser.add_argument("--workers", type=int, help="worker processes (default: CPU count; 0 = inline)")
+    parser.add_argument("--force", action="store_true", help="redo files the manifest lists as done")
+    parser.add_argument("--progress", type=float, default=5.0, help="seconds between reports (0 = none)")
+    args = parser.parse_args(argv)
+    if args.width is not None and args.width <= 0:
+        parser.error("--width must be positive")
+
+    if args.width:
+        resize_args = ("width", args.width, 100)
+    elif args.percent:
+        resize_args = ("percent", None, args.percent)
+    else:
+        resize_args = ("none", None, 100)
+    try:
+        options = normalize_options(
+            *resize_args, args.grayscale, args.sepia, args.format, args.encoding, args.filters
+        )
+        input_bases(args.inputs)
+    except ValueError as exc:
+        parser.error(str(exc))
+    progress = run_batch(
+        args.inputs, args.output, options, args.workers, args.force,
+        Progress(interval=args.progress),
+    )
+    print(progress.summary())
+    return 1 if progress.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""Benchmark: animated GIF rendering, naive per-frame loop vs. the frame pipeline.
+
+Usage::
+
+    python benchmarks/bench_animation.py
+    python benchmarks/bench_animation.py --frames 120 --size 800x600 --sepia
+
+The naive version is what a straightforward loop does: process every frame
+into a list, then let Pillow's ``save_all`` quantize and write them all.  The
+pipeline is ``render_image`` (see :mod:`animation`).  Each run happens in a
+fresh process so its peak RSS can be reported (Linux only); also reported
+are wall time, the encode share of the pipeline and the output size.
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageSequence  # noqa: E402
+
+from app import normalize_options, process_image_data, render_image  # noqa: E402
+from bench_downscale import make_jpeg  # noqa: E402
+from metrics import StageTimer  # noqa: E402
+
+
+def make_animation(frames: int, size: tuple[int, int]) -> bytes:
+    """A pan across a photo-like image, as a looping GIF."""
+    photo = Image.open(io.BytesIO(make_jpeg(size[0] * size[1] * 4 / 1e6)))
+    step = max(1, (photo.width - size[0]) // frames)
+    images = [photo.crop((i * step, 0, i * step + size[0], size[1])) for i in range(frames)]
+    out = io.BytesIO()
+    images[0].save(out, format="GIF", save_all=True, append_images=images[1:],
+                   duration=40, loop=0)
+    return out.getvalue()
+
+
+def naive(data: bytes, options: dict) -> bytes:
+    img = Image.open(io.BytesIO(data))
+    frames, durations = [], []
+    for frame in ImageSequence.Iterator(img):
+        durations.append(frame.info.get("duration", 0))
+        frames.append(process_image_data(
+            frame.convert("RGB"), options["resize_option"], options.get("width"),
+            options.get("percentage", 100), options["grayscale"], options["sepia"],
+        ))
+    out = io.BytesIO()
+    frames[0].save(out, format="GIF", save_all=True, append_images=frames[1:],
+                   duration=durations, loop=img.info.get("loop", 0))
+    return out.getvalue()
+
+
+def rss_kib(field: str) -> int:
+    with open("/proc/self/status") as fh:
+        return next(int(line.split()[1]) for line in fh if line.startswith(field + ":"))
+
+
+def run(method: str, data: bytes, options: dict, results) -> None:
+    # Linux keeps the peak RSS across exec, so reset it (clear_refs "5")
+    # rather than trusting getrusage in a fresh process.
+    with open("/proc/self/clear_refs", "w") as fh:
+        fh.write("5")
+    baseline = rss_kib("VmRSS")
+    timer = StageTimer()
+    t0 = time.perf_counter()
+    out = naive(data, options) if method == "naive" else render_image(data, options, timer)
+    elapsed = time.perf_counter() - t0
+    peak = rss_kib("VmHWM") - baseline
+    results.put((elapsed, peak / 1024, len(out), timer.stages.get("encode", 0.0),
+                 Image.open(io.BytesIO(out)).n_frames))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--size", default="640x480")
+    parser.add_argument("--sepia", action="store_true")
+    parser.add_argument("--width", type=int, help="resize to this width")
+    args = parser.parse_args(argv)
+
+    size = tuple(int(v) for v in args.size.split("x"))
+    data = make_animation(args.frames, size)
+    resize = ("width", args.width) if args.width else ("none", None)
+    options = normalize_options(*resize, 100, False, args.sepia, "GIF")
+    print(f"{args.frames} frames of {args.size}, {len(data) / 2**20:.1f} MiB, "
+          f"sepia={args.sepia}, width={args.width or 'unchanged'}")
+    print(f"{'method':<9} {'total s':>8} {'encode s':>9} {'peak MiB':>9} {'out MiB':>8} {'frames':>7}")
+    context = multiprocessing.get_context("spawn")
+    for method in ("naive", "pipeline"):
+        results = context.Queue()
+        process = context.Process(target=run, args=(method, data, options, results))
+        process.start()
+        elapsed, peak, size_out, encode, frames = results.get()
+        process.join()
+        encode_text = f"{encode:9.2f}" if method == "pipeline" else f"{'-':>9}"
+        print(f"{method:<9} {elapsed:8.2f} {encode_text} {peak:9.1f} {size_out / 2**20:8.2f} {frames:7d}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
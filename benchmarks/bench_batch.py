@@ -0,0 +1,79 @@
+"""Benchmark: batch CLI throughput and memory against the size of the tree.
+
+Usage::
+
+    python benchmarks/bench_batch.py
+    python benchmarks/bench_batch.py --files 1000 10000 --workers 4
+
+Builds trees of small JPEGs (100 per directory) in a temporary directory and
+runs :func:`batch.run_batch` over each one in a fresh process, reporting
+images/s, MP/s and the peak RSS of the coordinating process (Linux only).
+Bounded memory means the last column stays flat as the tree grows.  A second
+run over the same tree shows the cost of resuming (all files skipped).
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_animation import rss_kib  # noqa: E402
+from bench_downscale import make_jpeg  # noqa: E402
+
+
+def make_tree(root: str, files: int, data: bytes) -> None:
+    for i in range(files):
+        directory = os.path.join(root, f"d{i // 100:05d}")
+        if i % 100 == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, f"{i}.jpg"), "wb") as fh:
+            fh.write(data)
+
+
+def run(source: str, output: str, workers: int, results) -> None:
+    from app import normalize_options
+    from batch import Progress, run_batch
+
+    with open("/proc/self/clear_refs", "w") as fh:
+        fh.write("5")
+    baseline = rss_kib("VmRSS")
+    options = normalize_options("width", 320, 100, False, False, "JPEG")
+    t0 = time.perf_counter()
+    progress = run_batch([source], output, options, workers, progress=Progress(io.StringIO(), 0))
+    elapsed = time.perf_counter() - t0
+    results.put((elapsed, progress.done, progress.skipped, progress.pixels,
+                 (rss_kib("VmHWM") - baseline) / 1024))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, nargs="+", default=[500, 5000])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--megapixels", type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    data = make_jpeg(args.megapixels)
+    context = multiprocessing.get_context("spawn")
+    print(f"{args.megapixels} MP JPEGs -> width 320, {args.workers} workers")
+    print(f"{'files':>7} {'run':<7} {'seconds':>8} {'images/s':>9} {'MP/s':>7} {'peak MiB':>9}")
+    for files in args.files:
+        with tempfile.TemporaryDirectory() as tmp:
+            source, output = os.path.join(tmp, "in"), os.path.join(tmp, "out")
+            make_tree(source, files, data)
+            for label in ("fresh", "resume"):
+                results = context.Queue()
+                process = context.Process(target=run, args=(source, output, args.workers, results))
+                process.start()
+                elapsed, done, skipped, pixels, peak = results.get()
+                process.join()
+                print(f"{files:7d} {label:<7} {elapsed:8.2f} {(done or skipped) / elapsed:9.0f} "
+                      f"{pixels / 1e6 / elapsed:7.1f} {peak:9.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
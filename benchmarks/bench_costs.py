@@ -0,0 +1,129 @@
+"""Benchmark: cost-model accuracy, and FIFO vs. shortest-job-first latency.
+
+Usage::
+
+    python benchmarks/bench_costs.py
+    python benchmarks/bench_costs.py --source-mp 2 12 --workers 2 --thumbnails 40
+
+Part 1 renders a matrix of sources and options, compares each estimate of
+``costs.CostModel`` with the measured worker time (before and after
+calibrating on one pass over the same matrix) and reports the median and
+worst ratio.  Part 2 queues a few large sepia PNG renders ahead of a burst
+of thumbnails on a small pool, once in arrival order and once cheapest-first,
+and reports thumbnail and large-render latencies.
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from app import normalize_options, render_features, render_image, render_image_timed  # noqa: E402
+from bench_downscale import make_jpeg  # noqa: E402
+from costs import CostModel  # noqa: E402
+from uploads import UploadInfo  # noqa: E402
+from workers import WorkerPool  # noqa: E402
+
+CASES = [
+    ("thumbnail", ("width", 200, 100, False, False, "JPEG")),
+    ("w=1024 gray", ("width", 1024, 100, True, False, "JPEG")),
+    ("50% sepia PNG", ("percent", None, 50, False, True, "PNG")),
+    ("full sepia", ("none", None, 100, False, True, "JPEG")),
+    ("full PNG", ("none", None, 100, False, False, "PNG")),
+    ("full GIF", ("none", None, 100, False, False, "GIF")),
+]
+
+
+def sources(mp: float) -> dict[str, bytes]:
+    jpeg = make_jpeg(mp)
+    png = io.BytesIO()
+    Image.open(io.BytesIO(jpeg)).save(png, format="PNG")
+    return {"JPEG": jpeg, "PNG": png.getvalue()}
+
+
+def info_for(data: bytes) -> UploadInfo:
+    with Image.open(io.BytesIO(data)) as img:
+        return UploadInfo(img.format, img.width, img.height)
+
+
+def accuracy(args) -> None:
+    model = CostModel()
+    runs = []
+    for mp in args.source_mp:
+        for fmt, data in sources(mp).items():
+            for name, params in CASES:
+                options = normalize_options(*params)
+                features = render_features(info_for(data), options)
+                _, timer, _ = render_image_timed(data, options)
+                runs.append((f"{mp:g} MP {fmt} {name}", features, timer))
+
+    print(f"{'case':<30} {'actual s':>9} {'prior s':>9} {'calibrated s':>13}")
+    priors = [model.estimate(features) for _, features, _ in runs]
+    for _, features, timer in runs:
+        model.observe(features, timer.stages)
+    ratios = {"prior": [], "calibrated": []}
+    for (label, features, timer), prior in zip(runs, priors):
+        calibrated = model.estimate(features)
+        ratios["prior"].append(prior / timer.total)
+        ratios["calibrated"].append(calibrated / timer.total)
+        print(f"{label:<30} {timer.total:9.3f} {prior:9.3f} {calibrated:13.3f}")
+    for kind, values in ratios.items():
+        worst = max(values, key=lambda r: max(r, 1 / r))
+        print(f"{kind:>10}: median estimate/actual {statistics.median(values):.2f}, worst {worst:.2f}")
+
+
+def scheduling(args) -> None:
+    data = sources(args.large_mp)["PNG"]
+    large = normalize_options("none", None, 100, False, True, "PNG")
+    thumb_data = make_jpeg(2)
+    thumb = normalize_options("width", 200, 100, False, False, "JPEG")
+    model = CostModel()
+    large_cost = model.estimate(render_features(info_for(data), large))
+    thumb_cost = model.estimate(render_features(info_for(thumb_data), thumb))
+
+    print(f"\n{args.large} x {args.large_mp:g} MP sepia PNG (est. {large_cost:.2f} s) queued before "
+          f"{args.thumbnails} thumbnails (est. {thumb_cost * 1000:.0f} ms), {args.workers} workers")
+    print(f"{'order':<8} {'thumb p50 s':>12} {'thumb p95 s':>12} {'large max s':>12}")
+    for order, costs in (("FIFO", (0.0, 0.0)), ("SJF", (large_cost, thumb_cost))):
+        pool = WorkerPool(args.workers, max_queue=args.large + args.thumbnails)
+        try:
+            pool.submit(sum, [0]).result()  # start the workers outside the timing
+            start = time.perf_counter()
+            jobs = [(pool.submit(render_image, data, large, cost=costs[0]), "large")
+                    for _ in range(args.large)]
+            jobs += [(pool.submit(render_image, thumb_data, thumb, cost=costs[1]), "thumb")
+                     for _ in range(args.thumbnails)]
+            latency = {"large": [], "thumb": []}
+            for future, kind in jobs:
+                future.add_done_callback(
+                    lambda _, kind=kind: latency[kind].append(time.perf_counter() - start)
+                )
+            for future, _ in jobs:
+                future.result()
+        finally:
+            pool.shutdown()
+        thumbs = sorted(latency["thumb"])
+        p95 = thumbs[min(len(thumbs) - 1, int(len(thumbs) * 0.95))]
+        print(f"{order:<8} {statistics.median(thumbs):12.3f} {p95:12.3f} {max(latency['large']):12.3f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source-mp", type=float, nargs="+", default=[1, 6])
+    parser.add_argument("--large-mp", type=float, default=12)
+    parser.add_argument("--large", type=int, default=2)
+    parser.add_argument("--thumbnails", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args(argv)
+    accuracy(args)
+    scheduling(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""Benchmark: reduce-on-decode downscaling vs. full-resolution LANCZOS.
+
+Usage::
+
+    python benchmarks/bench_downscale.py
+    python benchmarks/bench_downscale.py --source-mp 12 24 --widths 1600 400 100
+
+For each JPEG source size and target width this reports the latency of both
+paths, the pixels actually decoded (what peak memory scales with) and the mean
+absolute error of the fast path against the exact one, next to the tolerance
+enforced by the tests (``app.DOWNSCALE_TOLERANCE``).
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageChops, ImageFilter, ImageStat  # noqa: E402
+
+from app import DOWNSCALE_TOLERANCE, process_image_data  # noqa: E402
+
+
+def make_jpeg(megapixels: float) -> bytes:
+    """Photo-like 4:3 JPEG (fractal detail, gradient, soft noise)."""
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    size = (width, width * 3 // 4)
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 100)
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(1))
+    out = io.BytesIO()
+    Image.merge("RGB", (detail, gradient, noise)).save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+def run(data: bytes, width: int, fast: bool) -> tuple[float, Image.Image, tuple[int, int]]:
+    """Return (seconds, result, decoded size) for one decode + resize."""
+    t0 = time.perf_counter()
+    img = Image.open(io.BytesIO(data))
+    result = process_image_data(img, "width", width, 100, False, False, reduce_on_decode=fast)
+    return time.perf_counter() - t0, result, img.size
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source-mp", type=float, nargs="+", default=[2, 12, 24])
+    parser.add_argument("--widths", type=int, nargs="+", default=[1600, 800, 400, 100])
+    args = parser.parse_args(argv)
+
+    print(f"tolerance (mean abs error): {DOWNSCALE_TOLERANCE}")
+    print(f"{'src MP':>6} {'width':>6} {'exact s':>8} {'fast s':>8} {'speedup':>8} "
+          f"{'decoded MP':>10} {'MAE':>6}")
+    for mp in args.source_mp:
+        data = make_jpeg(mp)
+        for width in args.widths:
+            t_exact, exact, full = run(data, width, fast=False)
+            t_fast, fast, decoded = run(data, width, fast=True)
+            mae = max(ImageStat.Stat(ImageChops.difference(fast, exact)).mean)
+            decoded_mp = decoded[0] * decoded[1] / 1e6
+            print(f"{mp:6.1f} {width:6d} {t_exact:8.3f} {t_fast:8.3f} {t_exact / t_fast:7.1f}x "
+                  f"{decoded_mp:10.2f} {mae:6.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
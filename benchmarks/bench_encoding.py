@@ -0,0 +1,102 @@
+"""Benchmark: encode time vs. output bytes for every encoding profile and format.
+
+Usage::
+
+    python benchmarks/bench_encoding.py
+    python benchmarks/bench_encoding.py --sizes 1 12 --output benchmarks/encoding_profiles.json
+
+Encodes a photo-like image and a flat-colour graphic (the two kinds of input
+PNG and GIF output are chosen for) with each profile of :mod:`encoding`, the
+way the workers do, and reports the best-of-``--repeat`` encode time, the
+output size and both relative to ``balanced``.  ``--output`` records the run
+as JSON (``benchmarks/encoding_profiles.json`` is the one the docs quote).
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw  # noqa: E402
+
+from bench_downscale import make_jpeg  # noqa: E402
+from encoding import OUTPUT_FORMATS, PROFILES, save_image  # noqa: E402
+from suite import metadata  # noqa: E402
+
+
+def make_graphic(megapixels: float) -> Image.Image:
+    """Flat-colour 4:3 RGB graphic: bands, shapes and thin lines."""
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    size = (width, width * 3 // 4)
+    img = Image.new("RGB", size, (245, 245, 240))
+    draw = ImageDraw.Draw(img)
+    step = max(8, width // 24)
+    for i, x in enumerate(range(0, size[0], step)):
+        colour = ((i * 53) % 256, (i * 97) % 256, (i * 151) % 256)
+        draw.rectangle((x, 0, x + step // 2, size[1] // 3), fill=colour)
+        draw.ellipse((x, size[1] // 2, x + step, size[1] // 2 + step), fill=colour[::-1])
+    for y in range(size[1] // 3, size[1], max(4, step // 4)):
+        draw.line((0, y, size[0], y), fill=(30, 30, 30))
+    return img
+
+
+def make_photo(megapixels: float) -> Image.Image:
+    img = Image.open(io.BytesIO(make_jpeg(megapixels)))
+    img.load()
+    return img
+
+
+def measure(img: Image.Image, fmt: str, profile: str, repeat: int) -> tuple[float, int]:
+    """Best encode seconds and output bytes."""
+    best = float("inf")
+    for _ in range(repeat):
+        out = io.BytesIO()
+        t0 = time.perf_counter()
+        save_image(img, fmt, out, profile)
+        best = min(best, time.perf_counter() - t0)
+    return best, out.tell()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1])
+    parser.add_argument("--formats", nargs="+", default=list(OUTPUT_FORMATS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    args = parser.parse_args(argv)
+
+    results = {}
+    print(f"{'case':<22} {'profile':<9} {'encode ms':>10} {'ns/px':>7} {'KiB':>8} "
+          f"{'time x':>7} {'bytes x':>8}")
+    for content, make in (("photo", make_photo), ("graphic", make_graphic)):
+        for mp in args.sizes:
+            img = make(mp)
+            pixels = img.width * img.height
+            for fmt in args.formats:
+                case = f"{content}/{mp:g}MP/{fmt}"
+                rows = {profile: measure(img, fmt, profile, args.repeat) for profile in PROFILES}
+                base_time, base_bytes = rows["balanced"]
+                for profile, (seconds, size) in rows.items():
+                    results[f"{case}/{profile}"] = {
+                        "encode_s": round(seconds, 6),
+                        "ns_per_pixel": round(seconds / pixels * 1e9, 2),
+                        "bytes": size,
+                        "bits_per_pixel": round(size * 8 / pixels, 3),
+                    }
+                    print(f"{case:<22} {profile:<9} {seconds * 1000:10.1f} "
+                          f"{seconds / pixels * 1e9:7.1f} {size / 1024:8.0f} "
+                          f"{seconds / base_time:7.2f} {size / base_bytes:8.2f}")
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump({"meta": metadata("encoding"), "results": results}, fh, indent=2)
+            fh.write("\n")
+        print(f"wrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""Benchmark: tone-filter chains run filter by filter vs. compiled to one pass.
+
+Usage::
+
+    python benchmarks/bench_filters.py
+    python benchmarks/bench_filters.py --sizes 1 12 --chains "gamma:0.8,invert"
+
+Each chain is timed twice on the same image: once applying every filter as
+its own pass over the pixels (one ``Image.point`` or colour-matrix pass per
+filter, as a chain of independent filters would), and once as the program
+:func:`filters.compile_chain` builds.  ``stages`` is how many tables and
+matrices that program applies in its one pass; ``max diff`` is the largest
+per-channel difference between the two outputs.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+from bench_sepia import best_of, make_image  # noqa: E402
+from filters import compile_chain, parse_chain  # noqa: E402
+
+DEFAULT_CHAINS = [
+    "brightness:1.1,contrast:1.2,gamma:0.9,invert",
+    "tint:ff8800:0.3,sepia",
+    "brightness:1.1,gamma:0.9,sepia,contrast:1.2",
+    "gamma:1.2,tint:3366ff:0.4,brightness:1.1,tint:ff8800:0.2,invert",
+]
+
+
+def one_by_one(img, chain):
+    for item in chain:
+        img = compile_chain((item,)).apply(img)
+    return img
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 12], help="megapixels")
+    parser.add_argument("--chains", nargs="+", default=DEFAULT_CHAINS)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print(f"{'MP':>5} {'filters':>7} {'stages':>6} {'separate s':>11} {'compiled s':>11} "
+          f"{'speedup':>8} {'max diff':>8}  chain")
+    for mp in args.sizes:
+        img = make_image(mp)
+        for text in args.chains:
+            chain = parse_chain(text)
+            program = compile_chain(chain)
+            separate = best_of(lambda i: one_by_one(i, chain), img, args.repeat)
+            compiled = best_of(program.apply, img, args.repeat)
+            diff = np.abs(np.asarray(program.apply(img), dtype=int)
+                          - np.asarray(one_by_one(img, chain), dtype=int)).max()
+            print(f"{mp:5.1f} {len(chain):7d} {len(program.stages):6d} {separate:11.4f} "
+                  f"{compiled:11.4f} {separate / compiled:7.1f}x {diff:8d}  {text}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Benchmark: legacy per-pixel sepia loop vs. the vectorised colour-matrix engine.
+
+Usage::
+
+    python benchmarks/bench_sepia.py                 # default size matrix
+    python benchmarks/bench_sepia.py --sizes 0.1 1 12 --legacy-max-mp 1
+
+The legacy loop is only timed up to ``--legacy-max-mp`` megapixels (it takes
+tens of seconds beyond that); larger sizes report the engine alone.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from tone import SEPIA_WARM, apply_color_matrix  # noqa: E402
+
+
+def legacy_sepia(img: Image.Image) -> Image.Image:
+    """The original ``apply_sepia_filter`` pixel loop."""
+    img = img.convert("RGB")
+    px = img.load()
+    for y in range(img.height):
+        for x in range(img.width):
+            r, g, b = px[x, y]
+            tr = min(255, int(0.423 * r + 0.769 * g + 0.189 * b))
+            tg = min(255, int(0.349 * r + 0.686 * g + 0.168 * b))
+            tb = min(255, int(0.272 * r + 0.534 * g + 0.131 * b))
+            px[x, y] = (tr, tg, tb)
+    return img
+
+
+def make_image(megapixels: float) -> Image.Image:
+    """Noisy 4:3 RGB test image of roughly *megapixels* MP."""
+    width = max(1, int((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = max(1, int(width * 3 / 4))
+    return Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+
+
+def best_of(fn, img, repeat: int) -> float:
+    """Return the fastest of *repeat* runs of ``fn(img)`` in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(img)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[0.1, 0.5, 1, 2, 12],
+                        help="image sizes in megapixels")
+    parser.add_argument("--legacy-max-mp", type=float, default=2.0,
+                        help="largest size to time the legacy loop on")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print(f"{'MP':>6} {'size':>11} {'legacy s':>10} {'engine s':>10} {'speedup':>9}")
+    for mp in args.sizes:
+        img = make_image(mp)
+        engine = best_of(lambda i: apply_color_matrix(i, SEPIA_WARM), img, args.repeat)
+        if mp <= args.legacy_max_mp:
+            legacy = best_of(legacy_sepia, img, 1)
+            legacy_col, speedup_col = f"{legacy:10.3f}", f"{legacy / engine:8.0f}x"
+        else:
+            legacy_col, speedup_col = f"{'-':>10}", f"{'-':>9}"
+        size = f"{img.width}x{img.height}"
+        print(f"{mp:6.1f} {size:>11} {legacy_col} {engine:10.4f} {speedup_col}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
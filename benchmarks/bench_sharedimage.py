@@ -0,0 +1,86 @@
+"""Benchmark: handing a decoded image to a worker process, pickled vs. shared.
+
+Usage::
+
+    python benchmarks/bench_sharedimage.py
+    python benchmarks/bench_sharedimage.py --sizes 1 100 --repeat 5 --dir /tmp
+
+For each size, a warmed-up one-process pool receives a decoded RGB image
+either pickled (``pool.submit(fn, img)``, as the worker pool would send it)
+or as a :class:`sharedimage.SharedImage` whose pixels it maps: ``shared``
+writes the file for each task (the first render of an image), ``reused``
+takes it from a :class:`sharedimage.SharedPixels` (every later render).
+``hand-over`` times a task that only reads one pixel, i.e. the transfer
+itself; ``render`` times a full stored-image render to a 1024 px wide JPEG
+(:func:`app.render_pixels`) over each transport.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image  # noqa: E402
+
+from app import app, options_from_form, render_pixels  # noqa: E402
+from bench_sepia import best_of, make_image  # noqa: E402
+from sharedimage import SharedPixels, call_with_image, share  # noqa: E402
+
+
+def first_pixel(img: Image.Image):
+    return img.getpixel((0, 0))
+
+
+def pickled(pool: ProcessPoolExecutor, fn, img: Image.Image):
+    return pool.submit(fn, img).result()
+
+
+def shared(pool: ProcessPoolExecutor, directory: str, fn, img: Image.Image):
+    with share(img, directory) as handle:
+        return pool.submit(call_with_image, handle, fn).result()
+
+
+def reused(pool: ProcessPoolExecutor, pixels: SharedPixels, fn, img: Image.Image):
+    with pixels.lease("bench", img) as handle:
+        return pool.submit(call_with_image, handle, fn).result()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10, 50, 100],
+                        help="image sizes in megapixels")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dir", default=app.config["SHARED_PIXELS_DIR"],
+                        help="directory for the shared files (default: SHARED_PIXELS_DIR)")
+    args = parser.parse_args(argv)
+
+    Image.MAX_IMAGE_PIXELS = None
+    render = partial(render_pixels, options=options_from_form(
+        {"resize_option": "width", "width": "1024", "format": "JPEG"}
+    ))
+    print(f"{'':19} {'hand-over s':^29} {'render s':^29}")
+    print(f"{'MP':>6} {'size':>12} {'pickle':>9} {'shared':>9} {'reused':>9}"
+          f" {'pickle':>9} {'shared':>9} {'reused':>9}")
+    with ProcessPoolExecutor(1) as pool:
+        pool.submit(first_pixel, Image.new("RGB", (1, 1))).result()  # start the worker
+        for mp in args.sizes:
+            img = make_image(mp)
+            pixels = SharedPixels(args.dir, 0)
+            row = []
+            with pixels.lease("bench", img):  # written once, kept for every task below
+                for fn in (first_pixel, render):
+                    by_pickle = best_of(partial(pickled, pool, fn), img, args.repeat)
+                    by_share = best_of(partial(shared, pool, args.dir, fn), img, args.repeat)
+                    by_reuse = best_of(partial(reused, pool, pixels, fn), img, args.repeat)
+                    row.append(f"{by_pickle:9.3f} {by_share:9.3f} {by_reuse:9.3f}")
+            size = f"{img.width}x{img.height}"
+            print(f"{mp:6.1f} {size:>12} {' '.join(row)}")
+            del img
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""Benchmark: cold start of a web worker, from interpreter start to first response.
+
+Usage::
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20
+
+Each run is a fresh interpreter that imports :mod:`app`, calls
+:func:`app.create_app` and answers one ``/process`` request (a small PNG to
+WEBP, like a browser's first upload), timing each step.  ``selective`` is the
+default start-up, which loads only the Pillow plugins for the formats we read
+and write (see :mod:`startup`); ``all plugins`` leaves plugin loading to
+Pillow, which scans all of them on the first WEBP.  Medians over ``--runs``;
+``interpreter`` is the time to a bare ``python -c pass``.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import io, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+if {all_plugins}:
+    import startup
+    startup.load_plugins = lambda formats: None
+app.create_app({{"IMAGE_WORKERS": 0}})
+t2 = time.perf_counter()
+from PIL import Image
+png = io.BytesIO()
+Image.new("RGB", (64, 48), "red").save(png, format="PNG")
+png.seek(0)
+response = app.app.test_client().post(
+    "/process", data={{"file": (png, "a.png"), "resize_option": "none", "format": "WEBP"}},
+    content_type="multipart/form-data",
+)
+assert response.status_code == 200, response.status_code
+t3 = time.perf_counter()
+print(t1 - t0, t2 - t1, t3 - t2)
+"""
+
+
+def interpreter() -> float:
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.perf_counter() - t0
+
+
+def cold_start(all_plugins: bool) -> tuple[float, float, float, float]:
+    """(import, create_app, first request, whole process) seconds."""
+    t0 = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD.format(all_plugins=all_plugins)],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    total = time.perf_counter() - t0
+    return (*map(float, result.stdout.split()), total)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    base = statistics.median(interpreter() for _ in range(args.runs))
+    print(f"interpreter: {base * 1000:.0f} ms")
+    print(f"{'plugins':<12} {'import ms':>10} {'create ms':>10} {'1st req ms':>11} {'process ms':>11}")
+    for label, all_plugins in (("selective", False), ("all plugins", True)):
+        runs = [cold_start(all_plugins) for _ in range(args.runs)]
+        medians = [statistics.median(column) * 1000 for column in zip(*runs)]
+        print(f"{label:<12} " + " ".join(f"{value:10.1f}" for value in medians[:2])
+              + f" {medians[2]:11.1f} {medians[3]:11.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""Benchmark: time to first byte of streamed vs. buffered /process responses.
+
+Usage::
+
+    python benchmarks/bench_streaming.py
+    python benchmarks/bench_streaming.py --source-mp 12 24 --format PNG
+
+Serves the app with Werkzeug's threaded server on a free local port and posts
+a fresh (uncached) upload per run, once with streaming off and once with
+``STREAM_MIN_PIXELS`` at 1.  Reports time to the first body byte, total time
+and response size, and checks that both modes return identical bytes.
+"""
+import argparse
+import http.client
+import io
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from app import app, result_cache  # noqa: E402
+from bench_downscale import make_jpeg  # noqa: E402
+
+
+def post(port: int, data: bytes, fmt: str, sepia: bool) -> tuple[float, float, bytes]:
+    boundary = uuid.uuid4().hex
+    fields = [("resize_option", "none"), ("format", fmt)] + ([("sepia", "on")] if sepia else [])
+    body = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields
+    )
+    body += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="src.png"\r\n'
+        f"Content-Type: image/png\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    t0 = time.perf_counter()
+    conn.request("POST", "/process", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    response = conn.getresponse()
+    first = response.read(1)
+    ttfb = time.perf_counter() - t0
+    rest = response.read()
+    total = time.perf_counter() - t0
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"/process answered {response.status}")
+    return ttfb, total, first + rest
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source-mp", type=float, nargs="+", default=[4, 12])
+    parser.add_argument("--format", default="PNG")
+    parser.add_argument("--no-sepia", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no per-request log lines
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+    try:
+        print(f"{'src MP':>6} {'mode':<9} {'TTFB s':>8} {'total s':>8} {'MiB':>7} {'identical':>9}")
+        for mp in args.source_mp:
+            png = io.BytesIO()
+            Image.open(io.BytesIO(make_jpeg(mp))).save(png, format="PNG")
+            data = png.getvalue()
+            results = {}
+            for mode, threshold in (("buffered", 0), ("streamed", 1)):
+                app.config["STREAM_MIN_PIXELS"] = threshold
+                result_cache.clear()
+                # A distinct trailing byte keeps the shared disk tier from answering.
+                ttfb, total, body = post(port, data + uuid.uuid4().bytes, args.format, not args.no_sepia)
+                results[mode] = body
+                same = "yes" if body == results["buffered"] else "NO"
+                print(f"{mp:6.1f} {mode:<9} {ttfb:8.3f} {total:8.3f} {len(body) / 2**20:7.1f} {same:>9}")
+    finally:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""Benchmark: peak memory and time of tiled vs. untiled processing.
+
+Usage::
+
+    python benchmarks/bench_tiles.py
+    python benchmarks/bench_tiles.py --source-mp 50 100 --budget-mib 16 64
+
+Each case runs ``render_image`` in a fresh subprocess and reports its peak
+resident set size (``ru_maxrss``) and wall time, with tiling off and at each
+budget, and checks that the encoded output is byte-identical.
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image  # noqa: E402
+
+from bench_downscale import make_jpeg  # noqa: E402
+
+CASES = {
+    "sepia (full size)": {"resize_option": "none", "sepia": "on", "format": "PNG"},
+    "gray+sepia, w=4000": {"resize_option": "width", "width": "4000", "grayscale": "on",
+                           "sepia": "on", "format": "JPEG"},
+    "sepia, w=1024": {"resize_option": "width", "width": "1024", "sepia": "on", "format": "JPEG"},
+}
+
+CHILD = """
+import hashlib, io, json, resource, sys, time
+sys.path.insert(0, {root!r})
+from app import app, options_from_form, render_image
+source, form, budget = sys.argv[1], json.loads(sys.argv[2]), int(sys.argv[3])
+app.config["TILE_BUDGET_BYTES"] = budget
+data = open(source, "rb").read()
+t0 = time.perf_counter()
+out = render_image(data, options_from_form(form))
+elapsed = time.perf_counter() - t0
+print(json.dumps({{"seconds": elapsed, "rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "digest": hashlib.sha256(out).hexdigest()}}))
+"""
+
+
+def run(source: str, form: dict, budget: int) -> dict:
+    code = CHILD.format(root=ROOT)
+    out = subprocess.run(
+        [sys.executable, "-c", code, source, json.dumps(form), str(budget)],
+        check=True, capture_output=True, text=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source-mp", type=float, nargs="+", default=[24, 50])
+    parser.add_argument("--budget-mib", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--source-format", default="PNG", help="PNG decodes at full size")
+    args = parser.parse_args(argv)
+
+    print(f"{'src MP':>6} {'case':<20} {'budget':>8} {'peak MiB':>9} {'seconds':>8} {'identical':>9}")
+    for mp in args.source_mp:
+        with tempfile.NamedTemporaryFile(suffix=f".{args.source_format.lower()}", delete=False) as fh:
+            img = Image.open(io.BytesIO(make_jpeg(mp)))
+            img.save(fh, format=args.source_format)
+            source = fh.name
+        try:
+            for case, form in CASES.items():
+                base = run(source, form, 0)
+                print(f"{mp:6.1f} {case:<20} {'off':>8} {base['rss_mib']:9.0f} {base['seconds']:8.2f} {'':>9}")
+                for budget in args.budget_mib:
+                    result = run(source, form, budget * 1024 * 1024)
+                    same = "yes" if result["digest"] == base["digest"] else "NO"
+                    print(f"{mp:6.1f} {case:<20} {budget:>5} MiB {result['rss_mib']:9.0f} "
+                          f"{result['seconds']:8.2f} {same:>9}")
+        finally:
+            os.unlink(source)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""Benchmark: header-only upload checks vs. a full decode.
+
+Usage::
+
+    python benchmarks/bench_uploads.py
+    python benchmarks/bench_uploads.py --source-mp 12 50 --repeat 200
+
+For each source size, times :func:`uploads.inspect_upload` (magic bytes plus
+image header) against ``Image.open(...).load()``, i.e. what it costs to turn
+an upload away before and after decoding it.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from bench_downscale import make_jpeg  # noqa: E402
+from uploads import inspect_upload  # noqa: E402
+
+FORMATS = {"PNG", "JPEG", "GIF"}
+
+
+def best_of(repeat: int, fn) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source-mp", type=float, nargs="+", default=[2, 12])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    print(f"{'src MP':>6} {'format':<6} {'header us':>10} {'decode ms':>10} {'ratio':>8}")
+    for mp in args.source_mp:
+        jpeg = make_jpeg(mp)
+        png = io.BytesIO()
+        Image.open(io.BytesIO(jpeg)).save(png, format="PNG", compress_level=1)
+        for fmt, data in (("JPEG", jpeg), ("PNG", png.getvalue())):
+            header = best_of(args.repeat, lambda: inspect_upload(io.BytesIO(data), FORMATS, None))
+            decode = best_of(max(1, args.repeat // 10), lambda: Image.open(io.BytesIO(data)).load())
+            print(f"{mp:6.1f} {fmt:<6} {header * 1e6:10.1f} {decode * 1e3:10.1f} {decode / header:7.0f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""Benchmark: responsive variants from one decode vs. one request per width.
+
+Usage::
+
+    python benchmarks/bench_variants.py
+    python benchmarks/bench_variants.py --source-mp 24 --widths 2048 1600 1024 640 320 --sepia
+
+Compares the CPU time of ``render_image`` called once per width (what N
+``/process`` requests cost) with a single ``render_variants`` call, and
+reports the worst mean absolute error of the pyramid against independently
+processed images (before encoding) next to ``app.VARIANT_TOLERANCE``.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageChops, ImageStat  # noqa: E402
+
+from app import (  # noqa: E402
+    VARIANT_TOLERANCE,
+    build_variants,
+    normalize_options,
+    process_image_data,
+    render_image,
+    render_variants,
+)
+from bench_downscale import make_jpeg  # noqa: E402
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source-mp", type=float, nargs="+", default=[2, 12])
+    parser.add_argument("--widths", type=int, nargs="+", default=[1920, 1280, 960, 640, 480, 320])
+    parser.add_argument("--format", default="JPEG")
+    parser.add_argument("--grayscale", action="store_true")
+    parser.add_argument("--sepia", action="store_true")
+    args = parser.parse_args(argv)
+
+    print(f"{len(args.widths)} widths, format {args.format}, tolerance {VARIANT_TOLERANCE}")
+    print(f"{'src MP':>6} {'N x /process s':>15} {'variants s':>11} {'speedup':>8} {'max MAE':>8}")
+    for mp in args.source_mp:
+        data = make_jpeg(mp)
+
+        t0 = time.process_time()
+        independent = {}
+        for width in args.widths:
+            options = normalize_options("width", width, 100, args.grayscale, args.sepia, args.format)
+            independent[width] = render_image(data, options)
+        t_independent = time.process_time() - t0
+
+        options = normalize_options("none", None, 100, args.grayscale, args.sepia, args.format)
+        t0 = time.process_time()
+        variants = render_variants(data, args.widths, options)
+        t_variants = time.process_time() - t0
+
+        assert [w for w, _ in variants] == sorted(independent, reverse=True)
+
+        worst = 0.0
+        pyramid = build_variants(Image.open(io.BytesIO(data)), args.widths, args.grayscale, args.sepia)
+        for width, variant in pyramid:
+            alone = process_image_data(
+                Image.open(io.BytesIO(data)), "width", width, 100, args.grayscale, args.sepia
+            )
+            worst = max(worst, *ImageStat.Stat(ImageChops.difference(variant, alone)).mean)
+        print(f"{mp:6.1f} {t_independent:15.3f} {t_variants:11.3f} "
+              f"{t_independent / t_variants:7.1f}x {worst:8.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,644 @@
+"""Load test: ``POST /process`` under a real multi-worker server at rising concurrency.
+
+Usage::
+
+    python benchmarks/loadtest.py                                 # default mix and levels
+    python benchmarks/loadtest.py --workers 4 --concurrency 1 4 16 64 --duration 20
+    python benchmarks/loadtest.py --mix mix.json --output run.json
+    python benchmarks/loadtest.py --env IMAGE_WORKERS=0 --output inline.json --compare run.json
+    python benchmarks/loadtest.py --server gunicorn --threads 8  # if Gunicorn is installed
+    python benchmarks/loadtest.py --server asgi --slow-clients 1000 --concurrency 4
+
+Everything runs on this machine, with no network access needed:
+
+* **Server.**  ``builtin`` opens one listening socket and starts ``--workers``
+  processes that each serve the application from it with Werkzeug's threaded
+  server (a thread per connection), the way a prefork server shares its
+  socket.  ``asgi`` does the same with the ASGI application (:mod:`asgi`)
+  behind a minimal asyncio HTTP/1.1 server built on h11 (a development
+  requirement), the event-loop model uvicorn uses.  ``gunicorn`` runs
+  ``gunicorn 'app:create_app()'`` with gthread workers and ``uvicorn`` runs
+  ``uvicorn --factory asgi:create_asgi_app``, as in production, if they are
+  installed.  Every server gets the environment of this process plus
+  ``--env`` overrides.  The result cache is off (it would turn
+  the test into a cache benchmark) unless ``--env`` sets
+  ``RESULT_CACHE_BYTES``, and ``CLIENT_ID_HEADER`` is set so each virtual
+  client has its own budget (see ``--clients``).
+* **Load.**  For each ``--concurrency`` level, that many connections send
+  requests back to back for ``--duration`` seconds (a closed loop: each waits
+  for its response before sending the next).  A 429 or 503 is retried at
+  once, as an impatient client would, unless ``--backoff`` makes clients
+  honour ``Retry-After``.  Each request is drawn from the mix by weight.  A
+  mix is a JSON list of entries like those in ``DEFAULT_MIX``: a source size
+  and container, and the ``/process`` form fields.  The sources are generated
+  once, up front.  A ``--warmup`` period at the highest level runs first and
+  is not reported.  ``--slow-clients`` adds that many connections in the
+  background, for the whole run, that upload the first mix entry at
+  ``--slow-rate`` bytes/s each, over and over, like clients on slow links.
+* **Report.**  Per level: requests, throughput (requests/s and source
+  megapixels/s), latency percentiles of all responses, the rates of errors
+  (connection failures and statuses other than 200, 429 and 503), 429
+  (client budget) and 503 (worker pool saturated), and the server's memory.
+  That is the peak over the level of the summed RSS and PSS of every server
+  process, including the image worker pools, and the peak RSS of the largest
+  single process (Linux ``/proc``).  RSS counts shared pages once per process;
+  PSS splits them, so its sum is the better total.  The peak number of
+  server threads is reported too.
+
+Reports are JSON (``{"meta": ..., "levels": [...]}``, see :func:`run_level`),
+and ``meta`` records the server, workers, environment overrides, mix and
+machine.  ``--compare`` prints the throughput and p99 of this run against
+another report, level by level.  Only reports made on the same machine with
+the same mix are comparable.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import logging
+import os
+import random
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from suite import encode_source, make_image, metadata  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT_HEADER = "X-Loadtest-Client"
+BOUNDARY = "loadtest-boundary-7d1e3c"
+
+# Weights are relative.  Sources are photo-like images (see suite.make_image);
+# "mode" picks the container as suite.SOURCE_FORMATS does (RGB -> JPEG, RGBA -> PNG).
+DEFAULT_MIX = [
+    {"name": "thumbnail", "weight": 50, "megapixels": 1, "mode": "RGB",
+     "form": {"resize_option": "width", "width": "320", "format": "JPEG"}},
+    {"name": "web-webp", "weight": 20, "megapixels": 4, "mode": "RGB",
+     "form": {"resize_option": "width", "width": "1024", "format": "WEBP"}},
+    {"name": "png-gray", "weight": 10, "megapixels": 1, "mode": "RGBA",
+     "form": {"resize_option": "percent", "percentage": "50", "grayscale": "true", "format": "PNG"}},
+    {"name": "sepia", "weight": 10, "megapixels": 1, "mode": "RGB",
+     "form": {"resize_option": "none", "sepia": "true", "format": "JPEG"}},
+    {"name": "filters", "weight": 10, "megapixels": 2, "mode": "RGB",
+     "form": {"resize_option": "width", "width": "800", "format": "JPEG",
+              "filters": "brightness:1.1,contrast:1.2"}},
+]
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Request mix
+# ──────────────────────────────────────────────────────────────────────────────
+class Body:
+    """One mix entry, encoded once as a ``multipart/form-data`` body."""
+
+    def __init__(self, entry: dict) -> None:
+        self.name = entry["name"]
+        self.weight = entry.get("weight", 1)
+        img = make_image(entry["megapixels"], entry.get("mode", "RGB"))
+        self.pixels = img.width * img.height
+        data, filename = encode_source(img)
+        parts = [
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode()
+            for key, value in entry.get("form", {}).items()
+        ]
+        parts.append(
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n".encode() + data + b"\r\n"
+        )
+        self.data = b"".join(parts) + f"--{BOUNDARY}--\r\n".encode()
+
+
+def load_mix(path: str | None) -> list[dict]:
+    if path is None:
+        return DEFAULT_MIX
+    with open(path) as fh:
+        return json.load(fh)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Server
+# ──────────────────────────────────────────────────────────────────────────────
+def serve_asgi_fd(fd: int) -> None:
+    """Worker process of the asgi server: serve :mod:`asgi` from listening socket *fd*."""
+    import asyncio
+    from urllib.parse import unquote
+
+    import h11
+
+    import asgi
+
+    application = asgi.create_asgi_app()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = h11.Connection(h11.SERVER)
+
+        async def next_event():
+            while True:
+                event = connection.next_event()
+                if event is not h11.NEED_DATA:
+                    return event
+                connection.receive_data(await reader.read(64 * 1024))
+
+        async def receive() -> dict:
+            event = await next_event()
+            if isinstance(event, h11.Data):
+                return {"type": "http.request", "body": bytes(event.data), "more_body": True}
+            if isinstance(event, h11.EndOfMessage):
+                return {"type": "http.request", "body": b"", "more_body": False}
+            return {"type": "http.disconnect"}
+
+        async def send(message: dict) -> None:
+            if message["type"] == "http.response.start":
+                writer.write(connection.send(h11.Response(
+                    status_code=message["status"], headers=message["headers"])))
+                return
+            if message.get("body"):
+                writer.write(connection.send(h11.Data(data=message["body"])))
+            if not message.get("more_body"):
+                writer.write(connection.send(h11.EndOfMessage()))
+            await writer.drain()
+
+        try:
+            while True:
+                request = await next_event()
+                if not isinstance(request, h11.Request):
+                    break
+                path, _, query = request.target.partition(b"?")
+                await application({
+                    "type": "http", "asgi": {"version": "3.0"},
+                    "http_version": request.http_version.decode(), "method": request.method.decode(),
+                    "scheme": "http", "path": unquote(path.decode("latin-1")), "root_path": "",
+                    "query_string": query, "headers": list(request.headers),
+                    "server": writer.get_extra_info("sockname")[:2],
+                    "client": writer.get_extra_info("peername")[:2],
+                }, receive, send)
+                if connection.our_state is not h11.DONE or connection.their_state is not h11.DONE:
+                    break  # e.g. a refused body that was never read
+                connection.start_next_cycle()
+        except (OSError, h11.ProtocolError):
+            pass
+        finally:
+            writer.close()
+
+    async def main() -> None:
+        server = await asyncio.start_server(handle, sock=socket.socket(fileno=fd))
+        print("ready", flush=True)
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def serve_fd(fd: int) -> None:
+    """Worker process of the builtin server: serve the app from listening socket *fd*."""
+    from werkzeug.serving import make_server
+
+    import app as app_module
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # no line per request
+    server = make_server("127.0.0.1", 0, app_module.create_app(), threaded=True, fd=fd)
+    print("ready", flush=True)
+    server.serve_forever()
+
+
+class Server:
+    """The server under test, listening on ``127.0.0.1:port``."""
+
+    def __init__(self, kind: str, workers: int, threads: int, env: dict[str, str]) -> None:
+        self.kind = kind
+        self.processes: list[subprocess.Popen] = []
+        env = {**os.environ, "RESULT_CACHE_BYTES": "0", "CLIENT_ID_HEADER": CLIENT_HEADER, **env}
+        if kind in ("builtin", "asgi"):
+            self.listener = socket.create_server(("127.0.0.1", 0), backlog=4096)
+            self.port = self.listener.getsockname()[1]
+            fd = self.listener.fileno()
+            flag = "--serve-fd" if kind == "builtin" else "--serve-asgi-fd"
+            for _ in range(workers):
+                self.processes.append(subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), flag, str(fd)],
+                    cwd=ROOT, env=env, pass_fds=(fd,), stdout=subprocess.PIPE, text=True,
+                ))
+            for process in self.processes:
+                if not select.select([process.stdout], [], [], 60)[0] or process.stdout.readline() != "ready\n":
+                    self.stop()
+                    raise RuntimeError("server worker failed to start")
+        elif kind == "gunicorn":
+            if shutil.which("gunicorn") is None:
+                raise RuntimeError("gunicorn is not installed")
+            self.port = free_port()
+            self.processes.append(subprocess.Popen(
+                ["gunicorn", "-w", str(workers), "-k", "gthread", "--threads", str(threads),
+                 "-b", f"127.0.0.1:{self.port}", "app:create_app()"],
+                cwd=ROOT, env=env,
+            ))
+            self._wait_until_up(60)
+        elif kind == "uvicorn":
+            if shutil.which("uvicorn") is None:
+                raise RuntimeError("uvicorn is not installed")
+            self.port = free_port()
+            self.processes.append(subprocess.Popen(
+                ["uvicorn", "--factory", "asgi:create_asgi_app", "--workers", str(workers),
+                 "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"],
+                cwd=ROOT, env=env,
+            ))
+            self._wait_until_up(60)
+        else:
+            raise ValueError(f"unknown server {kind!r}")
+
+    def _wait_until_up(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=5)
+                connection.request("GET", "/")
+                if connection.getresponse().status == 200:
+                    return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("server did not come up")
+
+    def pids(self) -> list[int]:
+        """Every process of the server: the ones started plus their descendants."""
+        parents: dict[int, list[int]] = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as fh:
+                    ppid = int(fh.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            parents.setdefault(ppid, []).append(int(entry))
+        found, stack = [], [p.pid for p in self.processes]
+        while stack:
+            pid = stack.pop()
+            found.append(pid)
+            stack.extend(parents.get(pid, []))
+        return found
+
+    def stop(self) -> None:
+        for pid in self.pids():  # image worker pools too, which outlive a killed parent
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.kind in ("builtin", "asgi"):
+            self.listener.close()
+
+
+def free_port() -> int:
+    """A port that is free now, for a server that binds its own socket."""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def memory_kib(pid: int) -> tuple[int, int]:
+    """``(rss, pss)`` of *pid* in KiB, or zeros if it has gone."""
+    values = {"Rss:": 0, "Pss:": 0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as fh:
+            for line in fh:
+                field, value = line.split()[:2]
+                if field in values:
+                    values[field] = int(value)
+    except (OSError, ValueError):
+        pass
+    return values["Rss:"], values["Pss:"]
+
+
+def thread_count(pid: int) -> int:
+    """Threads of *pid*, or 0 if it has gone."""
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+class MemorySampler(threading.Thread):
+    """Samples the server's memory and threads every *interval* seconds, keeping the peaks."""
+
+    def __init__(self, server: Server, interval: float = 0.25) -> None:
+        super().__init__(daemon=True)
+        self.server = server
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.rss_total = self.pss_total = self.rss_largest = 0
+        self.threads = 0
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            samples = [memory_kib(pid) for pid in self.server.pids()]
+            self.rss_total = max(self.rss_total, sum(rss for rss, _ in samples))
+            self.pss_total = max(self.pss_total, sum(pss for _, pss in samples))
+            self.rss_largest = max(self.rss_largest, max((rss for rss, _ in samples), default=0))
+            self.threads = max(self.threads, sum(thread_count(pid) for pid in self.server.pids()))
+            self.stopped.wait(self.interval)
+
+    def peaks_mib(self) -> dict:
+        self.stopped.set()
+        self.join()
+        return {"rss_total": round(self.rss_total / 1024, 1),
+                "pss_total": round(self.pss_total / 1024, 1),
+                "rss_largest_process": round(self.rss_largest / 1024, 1)}
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Load
+# ──────────────────────────────────────────────────────────────────────────────
+def client_loop(port: int, bodies: list[Body], client: str, seed: int, deadline: float, out: list,
+                backoff: bool = False) -> None:
+    """Send requests back to back until *deadline*; append ``(body, seconds, status)``.
+
+    Status 0 is a connection failure (the connection is then reopened).  With
+    *backoff*, a 429 or 503 is followed by its ``Retry-After`` pause.
+    """
+    rng = random.Random(seed)
+    weights = [body.weight for body in bodies]
+    headers = {"Content-Type": f"multipart/form-data; boundary={BOUNDARY}", CLIENT_HEADER: client}
+    connection = None
+    while time.monotonic() < deadline:
+        body = rng.choices(bodies, weights)[0]
+        t0 = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+            connection.request("POST", "/process", body.data, headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            pause = float(response.getheader("Retry-After") or 0) if backoff else 0.0
+            if response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            status, pause = 0, 0.0
+            if connection is not None:
+                connection.close()
+            connection = None
+        out.append((body, time.perf_counter() - t0, status))
+        if pause:
+            time.sleep(min(pause, max(0.0, deadline - time.monotonic())))
+    if connection is not None:
+        connection.close()
+
+
+class SlowClients(threading.Thread):
+    """*count* connections that each upload *body* at *rate* bytes/s, over and over.
+
+    Each holds a connection open for ``len(body.data) / rate`` seconds per
+    request.  They run on an event loop of their own, so thousands cost this
+    process little.
+    """
+
+    def __init__(self, port: int, body: Body, count: int, rate: float) -> None:
+        super().__init__(daemon=True)
+        self.port = port
+        self.body = body
+        self.count = count
+        self.rate = rate
+        self.completed = self.failed = 0
+        self.started = threading.Event()
+
+    def run(self) -> None:
+        asyncio.run(self._main())
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.clients.cancel)
+        self.join()
+
+    async def _main(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.clients = asyncio.gather(*(self._client(i) for i in range(self.count)))
+        self.started.set()
+        try:
+            await self.clients
+        except asyncio.CancelledError:
+            pass
+
+    async def _client(self, i: int) -> None:
+        data = self.body.data
+        head = (f"POST /process HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n"
+                f"Content-Type: multipart/form-data; boundary={BOUNDARY}\r\n"
+                f"Content-Length: {len(data)}\r\n{CLIENT_HEADER}: slow-{i}\r\n\r\n").encode()
+        interval = 0.25
+        piece = max(1, int(self.rate * interval))
+        await asyncio.sleep(random.random() * interval * 4)  # spread the arrivals
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+                try:
+                    writer.write(head)
+                    for start in range(0, len(data), piece):
+                        writer.write(data[start:start + piece])
+                        await writer.drain()
+                        await asyncio.sleep(interval)
+                    status = (await reader.readline()).split(b" ")[1:2]
+                    await reader.read()  # to the end (Connection: close)
+                    if status == [b"200"]:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                finally:
+                    writer.close()
+            except (OSError, IndexError):
+                self.failed += 1
+                await asyncio.sleep(interval)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """Nearest-rank percentile *q* (0-100) of non-empty *sorted_values*."""
+    rank = max(1, -(-len(sorted_values) * q // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def run_level(server: Server, bodies: list[Body], concurrency: int, duration: float,
+              clients: int | None, seed: int = 0, backoff: bool = False) -> dict:
+    """Drive *server* with *concurrency* connections for *duration* seconds.
+
+    Connection ``i`` identifies itself as client ``i % clients`` (every
+    connection is its own client if *clients* is None).
+    """
+    results: list[list] = [[] for _ in range(concurrency)]
+    sampler = MemorySampler(server)
+    sampler.start()
+    t0 = time.monotonic()
+    deadline = t0 + duration
+    threads = [
+        threading.Thread(target=client_loop, args=(
+            server.port, bodies, f"client-{i % (clients or concurrency)}", seed + i, deadline, results[i],
+            backoff))
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - t0  # includes the requests still running at the deadline
+    memory = sampler.peaks_mib()
+
+    samples = [sample for per_client in results for sample in per_client]
+    latencies = sorted(seconds for _, seconds, _ in samples)
+    status: dict[str, int] = {}
+    for _, _, code in samples:
+        status[str(code)] = status.get(str(code), 0) + 1
+    done = len(samples) or 1
+    ok_pixels = sum(body.pixels for body, _, code in samples if code == 200)
+    errors = sum(n for code, n in status.items() if code not in ("200", "429", "503"))
+    return {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(status.get("200", 0) / elapsed, 2),
+        "megapixels_per_s": round(ok_pixels / 1e6 / elapsed, 2),
+        "latency_ms": {
+            name: round(percentile(latencies, q) * 1000, 1) if latencies else None
+            for name, q in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100))
+        },
+        "status": status,
+        "error_rate": round(errors / done, 4),
+        "rate_429": round(status.get("429", 0) / done, 4),
+        "rate_503": round(status.get("503", 0) / done, 4),
+        "memory_mib": memory,
+        "server_threads": sampler.threads,
+    }
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Reports
+# ──────────────────────────────────────────────────────────────────────────────
+def print_level(level: dict) -> None:
+    latency = level["latency_ms"]
+    print(f"{level['concurrency']:6d} {level['requests']:8d} {level['throughput_rps']:8.1f} "
+          f"{level['megapixels_per_s']:7.1f} {latency['p50'] or 0:8.0f} {latency['p95'] or 0:8.0f} "
+          f"{latency['p99'] or 0:8.0f} {level['error_rate']:6.1%} {level['rate_429']:6.1%} "
+          f"{level['rate_503']:6.1%} {level['memory_mib']['pss_total']:8.0f} "
+          f"{level.get('server_threads', 0):7d}")
+
+
+def print_comparison(current: dict, other: dict, label: str) -> None:
+    before = {level["concurrency"]: level for level in other["levels"]}
+    print(f"\nagainst {label} ({other['meta'].get('server')}, {other['meta'].get('workers')} workers, "
+          f"env {other['meta'].get('env')}):")
+    print(f"{'conc':>6} {'req/s':>16} {'p99 ms':>18}")
+    for level in current["levels"]:
+        old = before.get(level["concurrency"])
+        if old is None:
+            continue
+        rps, old_rps = level["throughput_rps"], old["throughput_rps"]
+        p99, old_p99 = level["latency_ms"]["p99"] or 0, old["latency_ms"]["p99"] or 0
+        print(f"{level['concurrency']:6d} {old_rps:7.1f} -> {rps:6.1f} {old_p99:8.0f} -> {p99:7.0f}"
+              + (f"  ({rps / old_rps:.2f}x)" if old_rps else ""))
+
+
+def parse_env(values: list[str]) -> dict[str, str]:
+    env = {}
+    for value in values:
+        key, _, setting = value.partition("=")
+        env[key] = setting
+    return env
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["builtin", "asgi", "gunicorn", "uvicorn"], default="builtin")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="server processes")
+    parser.add_argument("--threads", type=int, default=8, help="threads per Gunicorn worker")
+    parser.add_argument("--env", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="server settings, e.g. IMAGE_WORKERS=0")
+    parser.add_argument("--mix", help="JSON request mix (default: DEFAULT_MIX)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per level")
+    parser.add_argument("--warmup", type=float, default=3.0, help="unreported seconds first")
+    parser.add_argument("--clients", type=int, help="distinct client ids (default: one per connection)")
+    parser.add_argument("--backoff", action="store_true",
+                        help="clients honour Retry-After on 429/503 (default: retry at once)")
+    parser.add_argument("--slow-clients", type=int, default=0,
+                        help="background connections uploading at --slow-rate")
+    parser.add_argument("--slow-rate", type=float, default=16 * 1024, help="bytes/s per slow client")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="a previous JSON report to compare with")
+    parser.add_argument("--serve-fd", type=int, help=argparse.SUPPRESS)  # builtin server worker
+    parser.add_argument("--serve-asgi-fd", type=int, help=argparse.SUPPRESS)  # asgi server worker
+    args = parser.parse_args(argv)
+    if args.serve_fd is not None:
+        serve_fd(args.serve_fd)
+        return 0
+    if args.serve_asgi_fd is not None:
+        serve_asgi_fd(args.serve_asgi_fd)
+        return 0
+
+    mix = load_mix(args.mix)
+    bodies = [Body(entry) for entry in mix]
+    env = parse_env(args.env)
+    server = Server(args.server, args.workers, args.threads, env)
+    slow = None
+    try:
+        if args.slow_clients:
+            slow = SlowClients(server.port, bodies[0], args.slow_clients, args.slow_rate)
+            slow.start()
+            slow.started.wait()
+        if args.warmup > 0:
+            run_level(server, bodies, max(args.concurrency), args.warmup, args.clients, args.seed,
+                      args.backoff)
+        print(f"{args.server} server, {args.workers} workers, env {env or '{}'}; "
+              f"{args.duration:g} s per level"
+              + (f"; {args.slow_clients} slow clients at {args.slow_rate:g} B/s" if slow else ""))
+        print(f"{'conc':>6} {'requests':>8} {'req/s':>8} {'MP/s':>7} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'errors':>6} {'429':>6} {'503':>6} {'PSS MiB':>8} {'threads':>7}")
+        levels = []
+        for concurrency in args.concurrency:
+            levels.append(run_level(server, bodies, concurrency, args.duration, args.clients, args.seed,
+                                    args.backoff))
+            print_level(levels[-1])
+    finally:
+        if slow is not None:
+            slow.stop()
+        server.stop()
+    if slow is not None:
+        print(f"slow clients: {slow.completed} uploads answered with 200, {slow.failed} failed")
+
+    report = {
+        "meta": {
+            **metadata("loadtest"),
+            "server": args.server,
+            "workers": args.workers,
+            "threads": args.threads if args.server == "gunicorn" else None,
+            "env": env,
+            "duration_s": args.duration,
+            "clients": args.clients,
+            "backoff": args.backoff,
+            "slow_clients": args.slow_clients,
+            "slow_rate": args.slow_rate if args.slow_clients else None,
+            "mix": mix,
+        },
+        "levels": levels,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    if args.compare:
+        with open(args.compare) as fh:
+            print_comparison(report, json.load(fh), args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""Benchmark suite for the processing pipeline, with regression thresholds.
+
+Times each stage separately over a matrix of image sizes, modes and output
+formats:
+
+* ``decode``   – ``Image.open`` + ``load`` of the encoded source;
+* ``process``  – ``process_image_data`` (resize to half width + grayscale);
+* ``sepia``    – ``apply_sepia_filter``;
+* ``encode``   – ``encode_image`` per output format;
+* ``e2e``      – ``POST /process`` through the Flask test client (result cache
+  disabled), per output format.
+
+Usage::
+
+    python benchmarks/suite.py                              # quick profile, print only
+    python benchmarks/suite.py --profile full --output results.json
+    python benchmarks/suite.py --update-baseline            # store benchmarks/baseline.json
+    python benchmarks/suite.py --compare                    # exit 1 on regressions
+    python benchmarks/suite.py --compare --max-slowdown 0.25 --stage-slowdown e2e=1.0
+
+Results are JSON (``{"meta": ..., "results": {case: {...}}}``).  Cases are
+compared on their best time (as ``timeit`` does: the minimum is the least
+noisy estimate on a shared machine).  A case regresses when it is more than ``max-slowdown`` (a fraction) slower
+than the baseline's and the absolute difference exceeds ``--min-delta``
+seconds, so sub-millisecond jitter does not fail the run.  Baselines are
+machine specific: regenerate them on the machine that runs the comparison.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy  # noqa: E402
+import PIL  # noqa: E402
+from PIL import Image, ImageFilter  # noqa: E402
+
+import app as app_module  # noqa: E402
+from cache import ResultCache  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+PROFILES = {
+    "smoke": {"sizes": [0.05], "modes": ["RGB", "P"], "formats": ["JPEG", "PNG"], "repeat": 1},
+    "quick": {"sizes": [0.1, 1], "modes": ["RGB", "RGBA", "P", "L"],
+              "formats": ["JPEG", "PNG", "GIF"], "repeat": 5},
+    "full": {"sizes": [0.1, 1, 12, 50], "modes": ["RGB", "RGBA", "P", "L"],
+             "formats": ["JPEG", "PNG", "GIF"], "repeat": 3},
+}
+
+# Container used for the uploaded source of each mode.
+SOURCE_FORMATS = {"RGB": "JPEG", "L": "JPEG", "RGBA": "PNG", "P": "PNG"}
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Inputs
+# ──────────────────────────────────────────────────────────────────────────────
+def make_image(megapixels: float, mode: str) -> Image.Image:
+    """Photo-like 4:3 image of roughly *megapixels* MP in *mode*."""
+    width = max(8, int((megapixels * 1e6 * 4 / 3) ** 0.5))
+    size = (width, width * 3 // 4)
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 64)
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.BoxBlur(1))
+    img = Image.merge("RGB", (detail, gradient, noise))
+    if mode == "RGBA":
+        img.putalpha(gradient)
+    elif mode == "P":
+        img = img.convert("P", palette=Image.Palette.ADAPTIVE)
+    elif mode != "RGB":
+        img = img.convert(mode)
+    return img
+
+
+def encode_source(img: Image.Image) -> tuple[bytes, str]:
+    """Encode *img* the way a client would upload it; return (bytes, filename)."""
+    fmt = SOURCE_FORMATS[img.mode]
+    out = io.BytesIO()
+    img.save(out, format=fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return out.getvalue(), f"source.{fmt.lower()}"
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Timing
+# ──────────────────────────────────────────────────────────────────────────────
+def measure(fn, repeat: int) -> dict:
+    """Run *fn* *repeat* times; return median/min wall-clock seconds."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {"median_s": statistics.median(times), "min_s": min(times), "repeat": repeat}
+
+
+def decode(data: bytes) -> Image.Image:
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+
+def run_suite(profile: dict, stages: set[str], log=print) -> dict:
+    """Run every selected stage over the profile's matrix; return results."""
+    app_module.create_app()
+    app_module.result_cache = ResultCache(0)  # measure work, not cache hits
+    app_module.app.config["TESTING"] = True
+    client = app_module.app.test_client()
+    repeat = profile["repeat"]
+    results = {}
+
+    def record(case: str, fn, times: int = repeat) -> None:
+        results[case] = measure(fn, times)
+        log(f"{case:<32} {results[case]['median_s'] * 1000:10.2f} ms")
+
+    for mp in profile["sizes"]:
+        # Keep the biggest sizes affordable: a single run is plenty at 12+ MP.
+        times = repeat if mp < 12 else 1
+        for mode in profile["modes"]:
+            img = make_image(mp, mode)
+            data, filename = encode_source(img)
+            decoded = decode(data)
+            half = max(1, decoded.width // 2)
+            prefix = f"{mp:g}MP/{mode}"
+
+            if "decode" in stages:
+                record(f"decode/{prefix}", lambda: decode(data), times)
+            if "process" in stages:
+                record(
+                    f"process/{prefix}",
+                    lambda: app_module.process_image_data(decoded, "width", half, 100, True, False),
+                    times,
+                )
+            if "sepia" in stages:
+                record(f"sepia/{prefix}", lambda: app_module.apply_sepia_filter(decoded), times)
+            for fmt in profile["formats"]:
+                if "encode" in stages:
+                    record(
+                        f"encode/{prefix}/{fmt}",
+                        lambda: app_module.encode_image(decoded, fmt),
+                        times,
+                    )
+                if "e2e" in stages:
+                    def post():
+                        form = {"file": (io.BytesIO(data), filename), "resize_option": "width",
+                                "width": str(half), "format": fmt}
+                        response = client.post("/process", data=form,
+                                               content_type="multipart/form-data")
+                        assert response.status_code == 200, response.status
+                    record(f"e2e/{prefix}/{fmt}", post, times)
+    return results
+
+
+def metadata(profile_name: str) -> dict:
+    return {
+        "profile": profile_name,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Comparison
+# ──────────────────────────────────────────────────────────────────────────────
+def compare(
+    current: dict,
+    baseline: dict,
+    max_slowdown: float,
+    stage_slowdown: dict[str, float] | None = None,
+    min_delta: float = 0.002,
+) -> list[dict]:
+    """Return one row per case present in both result sets, flagging regressions."""
+    stage_slowdown = stage_slowdown or {}
+    rows = []
+    for case, now in sorted(current.items()):
+        before = baseline.get(case)
+        if before is None:
+            continue
+        limit = stage_slowdown.get(case.split("/", 1)[0], max_slowdown)
+        ratio = now["min_s"] / before["min_s"] if before["min_s"] else float("inf")
+        regressed = ratio > 1 + limit and now["min_s"] - before["min_s"] > min_delta
+        rows.append({"case": case, "baseline_s": before["min_s"], "current_s": now["min_s"],
+                     "ratio": ratio, "limit": limit, "regressed": regressed})
+    return rows
+
+
+def parse_stage_limits(values: list[str]) -> dict[str, float]:
+    limits = {}
+    for value in values:
+        stage, _, limit = value.partition("=")
+        limits[stage] = float(limit)
+    return limits
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--sizes", type=float, nargs="+", help="override the profile's sizes (MP)")
+    parser.add_argument("--modes", nargs="+", help="override the profile's modes")
+    parser.add_argument("--formats", nargs="+", help="override the profile's output formats")
+    parser.add_argument("--repeat", type=int, help="override the profile's repeat count")
+    parser.add_argument("--stages", nargs="+", default=["decode", "process", "sepia", "encode", "e2e"])
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="save results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="fail on regressions vs. the baseline")
+    parser.add_argument("--max-slowdown", type=float, default=0.5,
+                        help="allowed fractional slowdown per case (default 0.5 = 50%%)")
+    parser.add_argument("--stage-slowdown", nargs="*", default=[], metavar="STAGE=FRACTION",
+                        help="per-stage override, e.g. e2e=1.0")
+    parser.add_argument("--min-delta", type=float, default=0.002,
+                        help="ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args(argv)
+
+    profile = dict(PROFILES[args.profile])
+    for key in ("sizes", "modes", "formats", "repeat"):
+        if getattr(args, key) is not None:
+            profile[key] = getattr(args, key)
+
+    report = {"meta": metadata(args.profile), "results": run_suite(profile, set(args.stages))}
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as fh:
+            json.dump(report, fh, indent=2)
+        print(f"baseline written to {args.baseline}")
+
+    if not args.compare:
+        return 0
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)["results"]
+    rows = compare(report["results"], baseline, args.max_slowdown,
+                   parse_stage_limits(args.stage_slowdown), args.min_delta)
+    failures = [row for row in rows if row["regressed"]]
+    print(f"\ncompared {len(rows)} cases against {args.baseline}")
+    for row in failures:
+        print(f"REGRESSION {row['case']}: {row['baseline_s'] * 1000:.2f} ms -> "
+              f"{row['current_s'] * 1000:.2f} ms ({row['ratio']:.2f}x, limit {1 + row['limit']:.2f}x)")
+    if not failures:
+        print("no regressions")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
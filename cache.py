@@ -0,0 +1,236 @@
+"""Content-addressed result cache for processed images.
+
+Entries are keyed on a hash of the uploaded bytes plus the normalised
+processing options, so identical requests map to the same encoded output.
+
+Two tiers:
+
+* an in-process LRU bounded by total bytes;
+* an optional on-disk tier (a directory of ``<key>`` files) that several
+  worker processes can share.  Writes are atomic (temp file + rename) and
+  the tier is pruned oldest-access-first when it grows past its byte budget.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import IO
+
+# Read size when hashing a stream.
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def hash_stream(stream: IO[bytes]) -> "hashlib._Hash":
+    """SHA-256 of the seekable *stream* from its start, read in chunks; the
+    stream is left where it was."""
+    digest = hashlib.sha256()
+    position = stream.tell()
+    stream.seek(0)
+    try:
+        while chunk := stream.read(HASH_CHUNK_BYTES):
+            digest.update(chunk)
+    finally:
+        stream.seek(position)
+    return digest
+
+
+def make_key(data: bytes | IO[bytes], options: dict) -> str:
+    """Return the cache key for *data* processed with *options*.
+
+    *data* is the upload's bytes or a seekable stream of them (see
+    :func:`hash_stream`); both give the same key.
+    """
+    digest = hashlib.sha256(data) if isinstance(data, bytes) else hash_stream(data)
+    digest.update(b"\0")
+    digest.update(json.dumps(options, sort_keys=True, separators=(",", ":")).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Byte-bounded LRU of encoded results with an optional shared disk tier.
+
+    ``disk_max_bytes`` of 0 leaves the disk tier unbounded.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        disk_dir: str | None = None,
+        disk_max_bytes: int = 0,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_written = 0  # bytes written since the last prune
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    # ----- public API -----
+    def get(self, key: str) -> bytes | None:
+        """Return the cached bytes for *key*, or None on a miss."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._memory_put(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Store *data* under *key* in every enabled tier."""
+        with self._lock:
+            self._memory_put(key, data)
+        self._disk_put(key, data)
+
+    def put_file(self, key: str, path: str) -> None:
+        """Store the finished file at *path* under *key*, consuming the file.
+
+        It is renamed into the disk tier when there is one (no copy if it is
+        on the same filesystem) and read into the memory tier only if it fits.
+        """
+        try:
+            size = os.path.getsize(path)
+            if size <= self.max_bytes:
+                with open(path, "rb") as fh:
+                    data = fh.read()
+                with self._lock:
+                    self._memory_put(key, data)
+            if self.disk_dir and not (self.disk_max_bytes and size > self.disk_max_bytes):
+                try:
+                    os.replace(path, self._path(key))
+                except OSError:  # e.g. another filesystem: copy it instead
+                    with open(path, "rb") as fh:
+                        self._disk_put(key, fh.read())
+                else:
+                    self._disk_written_bytes(size)
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def stats(self) -> dict:
+        """Return counters and current occupancy."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk_enabled": bool(self.disk_dir),
+            }
+
+    def clear(self) -> None:
+        """Drop the memory tier and reset counters (the disk tier is kept)."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.disk_hits = self.misses = 0
+            self.evictions = self.disk_evictions = 0
+
+    # ----- memory tier -----
+    def _memory_put(self, key: str, data: bytes) -> None:
+        """Insert into the LRU and evict down to budget; caller holds the lock."""
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    # ----- disk tier -----
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key)
+
+    def _disk_get(self, key: str) -> bytes | None:
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+            os.utime(path)  # mtime doubles as the shared LRU clock
+        except OSError:
+            return None
+        return data
+
+    def _disk_put(self, key: str, data: bytes) -> None:
+        if not self.disk_dir or (self.disk_max_bytes and len(data) > self.disk_max_bytes):
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.disk_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return
+        self._disk_written_bytes(len(data))
+
+    def _disk_written_bytes(self, size: int) -> None:
+        """Account for *size* new bytes on disk, pruning when that may be due."""
+        with self._lock:
+            self._disk_written += size
+            # Scanning the directory is O(entries); only do it once the bytes
+            # written since the last prune could plausibly overflow the budget.
+            due = self.disk_max_bytes and self._disk_written >= self.disk_max_bytes // 10
+            if due:
+                self._disk_written = 0
+        if due:
+            self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        """Remove least-recently-used files until the tier fits its budget."""
+        files = []
+        total = 0
+        with os.scandir(self.disk_dir) as it:
+            for entry in it:
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        files.sort()
+        removed = 0
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:  # another worker got there first
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self.disk_evictions += removed
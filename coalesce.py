@@ -0,0 +1,295 @@
+"""Single-flight coalescing of identical in-flight renders.
+
+When a popular image is shared, dozens of identical ``/process`` requests
+(same upload bytes, same normalised options, so the same
+:func:`cache.make_key`) can arrive before the first has been rendered and
+cached.  :meth:`Coalescer.run` lets only the first compute the result; the
+duplicates wait for it and share its encoded bytes.
+
+* Within a process, duplicates wait on the leader's in-memory flight and
+  get its result, or its exception.
+* Across worker processes on the host, each process's leader takes an
+  exclusive ``flock`` on ``<directory>/<key>.lock`` while it computes.  A
+  process that finds the lock held touches a ``<key>.wait`` marker and polls
+  for the lock; a leader that finds (and removes) the marker when it is done
+  writes the result to ``<directory>/<key>`` (temp file + rename) before
+  unlocking, and the waiters read it.  Only a result written since a waiter
+  started waiting counts, so the directory never acts as a cache; a waiter
+  that finds none (the leader failed) computes the result itself.
+
+Waiting is bounded by *timeout*: a duplicate that has waited that long
+computes the result itself.  Files older than *linger* seconds are removed
+from time to time.  Losing a race (a marker dropped just as the leader
+finishes, a lock file pruned while in use) costs at most one duplicate
+computation, never a wrong result.  A ``flock`` belongs to the open file,
+which a forked child (such as a new image worker) would share and keep
+locked, so children let go of the lock files held at the fork.  Without
+``fcntl`` (Windows) only threads are coalesced.
+
+Results large enough to be streamed while they are encoded go through
+:meth:`Coalescer.stream` instead: duplicates get the leader's spool file and
+its writer's future, and follow that file (see :func:`streaming.follow_file`)
+rather than waiting for the whole result.  Only threads of one process can
+follow a stream, since the writer's future lives there; the deployments this
+targets run one web process with many threads, and in other processes a
+duplicate that arrives after the leader finished is a cache hit.
+"""
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from typing import TypeVar
+
+try:
+    import fcntl
+except ImportError:  # Windows: coalesce threads only
+    fcntl = None
+
+POLL_SECONDS = 0.005
+
+T = TypeVar("T")
+
+_held_locks: set[int] = set()  # descriptors of the lock files this process holds
+
+
+def _release_in_child() -> None:
+    """Point the inherited lock-file descriptors at /dev/null, so that the
+    child does not hold its parent's locks (and never closes an fd twice)."""
+    if not _held_locks:
+        return
+    null = os.open(os.devnull, os.O_RDONLY)
+    for fd in _held_locks:
+        os.dup2(null, fd)
+    os.close(null)
+    _held_locks.clear()
+
+
+if fcntl is not None:
+    os.register_at_fork(after_in_child=_release_in_child)
+
+
+class _Flight:
+    """One in-process computation and the outcome its duplicates wait for."""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: bytes | None = None
+        self.error: Exception | None = None
+
+
+class Coalescer:
+    """Run one computation per key at a time and share its bytes.
+
+    *directory* (``None`` = threads only) holds the lock, marker and result
+    files shared with other processes.  A *timeout* of 0 disables
+    coalescing: every call computes.
+    """
+
+    def __init__(self, directory: str | None, timeout: float, linger: float = 60.0) -> None:
+        self.directory = directory if fcntl is not None else None
+        self.timeout = timeout
+        self.linger = linger
+        self._flights: dict[str, _Flight] = {}
+        self._streams: dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.time()
+        self.computed = 0
+        self.shared_threads = 0
+        self.shared_processes = 0
+        self.timeouts = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    # ----- public API -----
+    def run(self, key: str, compute: Callable[[], bytes]) -> tuple[bytes, bool]:
+        """Return ``(result, shared)`` for *key*: the bytes *compute* returns,
+        and whether another request's call computed them.
+
+        Exceptions from the leader's *compute* are raised in the threads
+        that waited for it as well.
+        """
+        if self.timeout <= 0:
+            return self._compute(compute), False
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if flight.done.wait(self.timeout):
+                if flight.error is not None:
+                    raise flight.error
+                if flight.result is not None:
+                    with self._lock:
+                        self.shared_threads += 1
+                    return flight.result, True
+            else:
+                with self._lock:
+                    self.timeouts += 1
+            return self._compute(compute), False
+
+        try:
+            flight.result, shared = self._lead(key, compute)
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, shared
+
+    def stream(self, key: str, start: Callable[[], T]) -> tuple[T, bool]:
+        """Return ``(stream, shared)`` for *key*: what *start* returns (say a
+        spool file and its writer's future), or the stream an earlier call
+        started, which stays shared until :meth:`end_stream`.
+
+        A duplicate waits up to *timeout* for the leader's *start*; if that
+        raises or takes longer, the duplicate starts its own stream, which
+        is not shared.
+        """
+        if self.timeout <= 0:
+            return self._compute(start), False
+        with self._lock:
+            flight = self._streams.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._streams[key] = _Flight()
+        if not leader:
+            if flight.done.wait(self.timeout) and flight.error is None:
+                with self._lock:
+                    self.shared_threads += 1
+                return flight.result, True
+            if not flight.done.is_set():
+                with self._lock:
+                    self.timeouts += 1
+            return self._compute(start), False
+        try:
+            flight.result = self._compute(start)
+        except Exception as exc:
+            flight.error = exc
+            self.end_stream(key)
+            raise
+        finally:
+            flight.done.set()
+        return flight.result, False
+
+    def end_stream(self, key: str) -> None:
+        """Stop sharing the stream for *key*: later calls start a new one."""
+        with self._lock:
+            self._streams.pop(key, None)
+
+    def stats(self) -> dict:
+        """Return computations run and saved, and flights in progress."""
+        with self._lock:
+            return {
+                "computed": self.computed,
+                "saved": self.shared_threads + self.shared_processes,
+                "shared_threads": self.shared_threads,
+                "shared_processes": self.shared_processes,
+                "timeouts": self.timeouts,
+                "in_flight": len(self._flights) + len(self._streams),
+                "enabled": self.timeout > 0,
+                "processes_enabled": self.timeout > 0 and bool(self.directory),
+            }
+
+    # ----- internals -----
+    def _compute(self, compute: Callable[[], T]) -> T:
+        result = compute()
+        with self._lock:
+            self.computed += 1
+        return result
+
+    def _lead(self, key: str, compute: Callable[[], bytes]) -> tuple[bytes, bool]:
+        """Compute *key* as this process's leader, coordinating with the others."""
+        if not self.directory:
+            return self._compute(compute), False
+        self._maybe_prune()
+        path = os.path.join(self.directory, key)
+        with open(path + ".lock", "ab") as lock:
+            since = self._acquire(lock, path + ".wait")
+            if since is False:
+                with self._lock:
+                    self.timeouts += 1
+                return self._compute(compute), False
+            _held_locks.add(lock.fileno())
+            try:
+                if since is not None:
+                    result = _read_since(path, since)
+                    if result is not None:
+                        with self._lock:
+                            self.shared_processes += 1
+                        return result, True
+                result = self._compute(compute)
+                try:
+                    os.unlink(path + ".wait")
+                except FileNotFoundError:
+                    pass  # nobody is waiting
+                else:
+                    self._write(path, result)
+                return result, False
+            finally:
+                _held_locks.discard(lock.fileno())  # closing *lock* releases it
+
+    def _acquire(self, lock, marker: str) -> float | bool | None:
+        """Lock *lock*.  Return None if it was free; if it was held, touch
+        *marker*, wait, and return the marker's mtime (when the wait began);
+        False after *timeout* seconds."""
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return None
+        except BlockingIOError:
+            pass
+        # The marker's own clock, so that comparing it with the result's
+        # mtime holds on filesystems with coarse timestamps too.
+        with open(marker, "ab") as fh:
+            os.utime(fh.fileno())
+            since = os.fstat(fh.fileno()).st_mtime
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            time.sleep(POLL_SECONDS)
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return since
+            except BlockingIOError:
+                continue
+        return False
+
+    def _write(self, path: str, result: bytes) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(result)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _maybe_prune(self) -> None:
+        """Remove files older than *linger*, at most once per *linger* seconds."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < self.linger:
+                return
+            self._last_prune = now
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if now - entry.stat().st_mtime > self.linger:
+                        os.unlink(entry.path)
+                except OSError:
+                    continue
+
+
+def _read_since(path: str, since: float) -> bytes | None:
+    """The contents of *path* if it was written at or after *since*."""
+    try:
+        with open(path, "rb") as fh:
+            if os.fstat(fh.fileno()).st_mtime < since:
+                return None
+            return fh.read()
+    except OSError:
+        return None
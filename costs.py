@@ -0,0 +1,195 @@
+"""Render cost estimates, for shortest-job-first scheduling and admission.
+
+The cost of a render varies by orders of magnitude: decoding a PNG costs ten
+times as much per pixel as a JPEG, sepia costs twenty-five times as much as
+grayscale, and PNG encoding is a hundred times slower than JPEG.
+:class:`CostModel` predicts the worker seconds of a render from what is known
+before decoding: the source format and size (from the header) and the parsed
+options.  The estimate is a sum over the three stages ``decode``, ``process``
+and ``encode``:
+
+    prior rate (seconds per pixel, measured on the reference host)
+    x pixels the stage touches
+    x a learned correction factor
+
+Each finished render reports its stage timings through
+:meth:`CostModel.observe`.  The correction factor for that stage and
+situation is then moved towards ``actual / prior``, which adapts the model to
+the host and to the images it really sees.
+
+:class:`ClientBudget` is a token bucket of estimated worker seconds per
+client, used to turn away clients that ask for more work than their share.
+"""
+import threading
+import time
+from typing import NamedTuple
+
+from encoding import DEFAULT_PROFILE
+
+# Seconds per pixel on the reference host (see benchmarks/bench_costs.py).
+DECODE_RATES = {"JPEG": 5.5e-9, "PNG": 55e-9, "GIF": 9e-9}
+ENCODE_RATES = {"JPEG": 10e-9, "PNG": 550e-9, "GIF": 150e-9, "WEBP": 120e-9}  # balanced profile
+# Encode time of the other profiles relative to balanced, for photographic
+# content (see benchmarks/encoding_profiles.json).
+PROFILE_ENCODE_FACTORS = {
+    "fast": {"JPEG": 0.5, "PNG": 0.25, "GIF": 0.15, "WEBP": 0.25},
+    "smallest": {"JPEG": 2.5, "PNG": 3.0, "GIF": 3.3, "WEBP": 1.4},
+}
+# Animation frames are mapped onto a shared palette rather than quantized
+# one by one (see animation.py): about 28 ns/pixel for a 60-frame 640x480
+# pan (benchmarks/bench_animation.py) against 150 for a still.
+ANIMATION_ENCODE_FACTOR = 0.2
+DEFAULT_RATE = 50e-9
+RESIZE_RATE = 22e-9  # per decoded pixel
+GRAYSCALE_RATE = 2e-9  # per pixel filtered (the smaller of source and output)
+SEPIA_RATE = 50e-9
+# Other tone filters by what their chain compiles to (see filters.py): one
+# lookup-table pass is cheap, any colour matrix costs about as much as sepia.
+FILTER_RATES = {"lut": 2e-9, "matrix": 50e-9, "mixed": 60e-9}
+GRAYSCALE_ENCODE_FACTOR = 0.35  # one channel instead of three
+OVERHEAD_SECONDS = 0.001
+
+# Calibration: weight of each new observation, the bounds on one observed
+# ratio (so one odd image cannot wreck the model), and the smallest prior
+# that is worth learning from (tiny stages are mostly timer noise).
+LEARNING_RATE = 0.2
+RATIO_BOUNDS = (0.05, 20.0)
+MIN_OBSERVED_SECONDS = 0.002
+
+
+class RenderFeatures(NamedTuple):
+    """What a render's cost depends on, known before decoding."""
+
+    source_format: str
+    source_pixels: int
+    decoded_pixels: int  # fewer than source_pixels when JPEG decodes at reduced scale
+    output_pixels: int
+    resized: bool
+    grayscale: bool
+    sepia: bool
+    output_format: str
+    encoding: str = DEFAULT_PROFILE
+    frames: int = 1  # more than one for animations rendered frame by frame
+    filters: str = ""  # kind of the compiled filter chain: "", lut, matrix or mixed
+
+
+class CostModel:
+    """Predicts render seconds from :class:`RenderFeatures`, learning from timings."""
+
+    def __init__(self) -> None:
+        self._scales: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        self.observations = 0
+
+    def estimate(self, features: RenderFeatures) -> float:
+        """Predicted worker seconds for a render."""
+        with self._lock:
+            return OVERHEAD_SECONDS + sum(
+                prior * self._scales.get(key, 1.0) for key, prior in self._priors(features)
+            )
+
+    def observe(self, features: RenderFeatures, stages: dict[str, float]) -> None:
+        """Calibrate from the stage timings (a ``StageTimer.stages``) of a finished render."""
+        decode = stages.get("open", 0.0) + stages.get("decode", 0.0)
+        encode = stages.get("encode", 0.0)
+        actual = {
+            "decode": decode,
+            "process": sum(stages.values()) - decode - encode,
+            "encode": encode,
+        }
+        with self._lock:
+            for key, prior in self._priors(features):
+                if prior < MIN_OBSERVED_SECONDS:
+                    continue
+                ratio = min(max(actual[key[0]] / prior, RATIO_BOUNDS[0]), RATIO_BOUNDS[1])
+                scale = self._scales.get(key, 1.0)
+                self._scales[key] = scale + LEARNING_RATE * (ratio - scale)
+            self.observations += 1
+
+    def stats(self) -> dict:
+        """The learned correction factors, keyed ``stage:situation``."""
+        with self._lock:
+            return {
+                "observations": self.observations,
+                "scales": {
+                    ":".join(str(part) for part in key): round(scale, 4)
+                    for key, scale in sorted(self._scales.items(), key=str)
+                },
+            }
+
+    @staticmethod
+    def _priors(f: RenderFeatures) -> list[tuple[tuple, float]]:
+        """``(key, prior seconds)`` per stage; the key names what is learned."""
+        # Reduced-scale JPEG decoding still parses all the entropy-coded data,
+        # so it saves only about half the time the pixel count suggests.
+        decode_work = (f.source_pixels + f.decoded_pixels) / 2
+        filtered = min(f.decoded_pixels, f.output_pixels)  # filters run on the smaller side
+        process = (RESIZE_RATE * f.decoded_pixels if f.resized else 0.0) + filtered * (
+            (GRAYSCALE_RATE if f.grayscale else 0.0) + (SEPIA_RATE if f.sepia else 0.0)
+            + FILTER_RATES.get(f.filters, 0.0)
+        )
+        encode = ENCODE_RATES.get(f.output_format, DEFAULT_RATE) * f.output_pixels
+        encode *= PROFILE_ENCODE_FACTORS.get(f.encoding, {}).get(f.output_format, 1.0)
+        if f.grayscale:
+            encode *= GRAYSCALE_ENCODE_FACTOR
+        if f.frames > 1:
+            encode *= ANIMATION_ENCODE_FACTOR
+        decode = DECODE_RATES.get(f.source_format, DEFAULT_RATE) * decode_work
+        return [
+            (("decode", f.source_format), decode * f.frames),
+            (("process", f.resized, f.grayscale, f.sepia) + ((f.filters,) if f.filters else ()),
+             process * f.frames),
+            (("encode", f.output_format, f.encoding, f.grayscale), encode * f.frames),
+        ]
+
+
+class ClientBudget:
+    """Per-client token bucket of estimated worker seconds.
+
+    Every client may spend *seconds* of estimated work per *window* seconds,
+    with bursts of up to *seconds*.  A render costing more than the whole
+    budget is never admitted.  ``seconds=0`` disables the budget.
+    """
+
+    def __init__(self, seconds: float, window: float, max_clients: int = 10_000) -> None:
+        self.seconds = seconds
+        self.rate = seconds / window if window > 0 else 0.0
+        self.max_clients = max_clients
+        self._buckets: dict[str, tuple[float, float]] = {}  # client -> (tokens, as of)
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def charge(self, client: str, cost: float) -> float:
+        """Take *cost* from *client*'s bucket and return 0, or take nothing
+        and return the seconds until the client can afford it: ``inf`` if
+        *cost* exceeds the whole budget."""
+        if not self.seconds:
+            return 0.0
+        with self._lock:
+            tokens = self._tokens(client)
+            if tokens < cost:
+                self.rejected += 1
+                if cost > self.seconds or not self.rate:
+                    return float("inf")
+                return (cost - tokens) / self.rate
+            self._buckets[client] = (tokens - cost, time.monotonic())
+            if len(self._buckets) > self.max_clients:
+                self._forget_idle()
+        return 0.0
+
+    def settle(self, client: str, charged: float, actual: float) -> None:
+        """Correct a charge once the real cost is known (0 refunds it)."""
+        if not self.seconds:
+            return
+        with self._lock:
+            self._buckets[client] = (self._tokens(client) + charged - actual, time.monotonic())
+
+    def _tokens(self, client: str) -> float:
+        """The client's tokens now, refilled since last seen; caller holds the lock."""
+        tokens, since = self._buckets.get(client, (self.seconds, 0.0))
+        return min(self.seconds, tokens + (time.monotonic() - since) * self.rate)
+
+    def _forget_idle(self) -> None:
+        """Drop clients whose buckets have refilled; they are as good as new."""
+        for client in [c for c in self._buckets if self._tokens(c) >= self.seconds]:
+            del self._buckets[client]
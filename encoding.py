@@ -0,0 +1,87 @@
+"""Output encoders: formats, encoding profiles and ``Accept`` negotiation.
+
+After decoding, encoding is the most expensive stage, and its output size is
+what we pay for in egress.  Both depend heavily on encoder settings.  Each
+named profile picks settings for every output format:
+
+``fast``
+    Cheapest encode: baseline JPEG, PNG ``compress_level=1``, fast-octree GIF
+    quantization and WEBP ``method=0``.
+``balanced`` (default)
+    Huffman-optimized JPEG (a few percent smaller at the same quality), and
+    Pillow's default PNG, GIF and WEBP effort.
+``smallest``
+    Fewest bytes: progressive JPEG at quality 85, PNG ``compress_level=9`` with
+    ``optimize``, max-coverage GIF quantization and WEBP ``method=6`` at
+    quality 75.  Can be several times slower than ``balanced``.
+
+``benchmarks/bench_encoding.py`` measures encode time against output bytes for
+every profile and format; ``benchmarks/encoding_profiles.json`` holds a
+recorded run.
+"""
+from PIL import Image
+from werkzeug.datastructures import MIMEAccept
+
+OUTPUT_FORMATS = ("JPEG", "PNG", "GIF", "WEBP")
+MIMETYPES = {fmt: f"image/{fmt.lower()}" for fmt in OUTPUT_FORMATS}
+DEFAULT_FORMAT = "JPEG"
+
+# Negotiation preference on equal quality.  JPEG comes first so that a bare
+# "*/*" or "image/*" keeps getting JPEG; WEBP is only chosen when a client
+# names it (every current browser does).
+NEGOTIATION_ORDER = ("JPEG", "WEBP", "PNG", "GIF")
+
+PROFILES = ("fast", "balanced", "smallest")
+DEFAULT_PROFILE = "balanced"
+
+# Keyword arguments for Image.save, by profile and format.  ``quantize`` is
+# not a save argument: it is the method used to reduce RGB to a GIF palette
+# (None leaves it to Pillow, which uses median cut).
+_SETTINGS = {
+    "fast": {
+        "JPEG": {"quality": 90, "subsampling": "4:2:0"},
+        "PNG": {"compress_level": 1},
+        "GIF": {"quantize": Image.Quantize.FASTOCTREE},
+        "WEBP": {"quality": 80, "method": 0},
+    },
+    "balanced": {
+        "JPEG": {"quality": 90, "subsampling": "4:2:0", "optimize": True},
+        "PNG": {"compress_level": 6},
+        "GIF": {"quantize": None},
+        "WEBP": {"quality": 80, "method": 4},
+    },
+    "smallest": {
+        "JPEG": {"quality": 85, "subsampling": "4:2:0", "optimize": True, "progressive": True},
+        "PNG": {"compress_level": 9, "optimize": True},
+        "GIF": {"quantize": Image.Quantize.MAXCOVERAGE, "optimize": True},
+        "WEBP": {"quality": 75, "method": 6},
+    },
+}
+
+
+def encoder_settings(output_format: str, profile: str = DEFAULT_PROFILE) -> dict:
+    """The settings *profile* uses for *output_format* (a fresh dict)."""
+    return dict(_SETTINGS[profile].get(output_format, {}))
+
+
+def save_image(img: Image.Image, output_format: str, fp, profile: str = DEFAULT_PROFILE) -> None:
+    """Encode *img* as *output_format* into *fp* with *profile*'s settings."""
+    settings = encoder_settings(output_format, profile)
+    quantize = settings.pop("quantize", None)
+    if output_format == "JPEG" and img.mode in {"RGBA", "P"}:
+        img = img.convert("RGB")  # JPEG must be RGB
+    elif output_format == "GIF" and quantize is not None and img.mode == "RGB":
+        img = img.quantize(256, method=quantize)
+    img.save(fp, format=output_format, **settings)
+
+
+def negotiate_format(accept: MIMEAccept | None) -> str:
+    """The output format *accept* (a request's ``Accept``) likes best.
+
+    Falls back to :data:`DEFAULT_FORMAT` when there is no header or nothing in
+    it matches.
+    """
+    if not accept:
+        return DEFAULT_FORMAT
+    best = accept.best_match([MIMETYPES[fmt] for fmt in NEGOTIATION_ORDER])
+    return best.split("/", 1)[1].upper() if best else DEFAULT_FORMAT
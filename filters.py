@@ -0,0 +1,309 @@
+"""Tone-filter registry and chain compiler.
+
+Every filter declares itself as one of two kinds of pixel transform:
+
+* a per-channel lookup table (brightness, contrast, gamma, invert), or
+* a colour matrix, 3x3 or 3x4 with an offset column (sepia, tint).
+
+A chain such as ``brightness:1.2,gamma:0.8,sepia`` is never run filter by
+filter.  :func:`compile_chain` folds it into a :class:`Program` of as few
+stages as the chain allows:
+
+* consecutive tables compose into one table.  This is exact: each table
+  clips to 0..255 just as running the filters in turn would;
+* consecutive matrices multiply into one matrix, so clipping happens once,
+  at the end of the run of matrices, not between them;
+* the resulting stages run in a single pass over the image: a table-only
+  program is one ``Image.point``, a matrix-only program one pass of the
+  colour-matrix engine (:mod:`tone`, bit-identical to it for a single
+  matrix).  Mixed programs apply their stages to each chunk of pixels in turn
+  while it is in cache.
+
+Grayscale (``L``) input has equal channels, so any program is evaluated once
+over the 256 gray levels and applied as lookup tables: the image stays ``L``
+when the program keeps channels equal, otherwise it becomes RGB.
+
+Compiled programs are memoized by chain signature, the canonical text of the
+chain (see :func:`parse_chain`), which also keys the result cache.
+"""
+from collections.abc import Callable
+from functools import cached_property, lru_cache
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+from tone import CHUNK_PIXELS, SEPIA_WARM, apply_color_matrix
+
+Lut = tuple[tuple[int, ...], tuple[int, ...], tuple[int, ...]]  # 3 x 256
+Matrix = tuple[tuple[float, float, float, float], ...]  # 3 x 4, last column an offset
+Chain = tuple[tuple[str, tuple], ...]  # (name, arguments) per filter
+
+MAX_FILTERS = 16
+
+# Luma weights (ITU-R 601-2, as Pillow's convert("L")).
+LUMA = (0.299, 0.587, 0.114)
+
+
+class Filter(NamedTuple):
+    """A registered filter: how to parse its arguments and what it does."""
+
+    kind: str  # "lut" or "matrix"
+    parse: Callable[[list[str]], tuple]  # text arguments -> normalized arguments
+    build: Callable[..., Lut | Matrix]
+    identity: Callable[[tuple], bool]  # whether the arguments make it a no-op
+    doc: str
+
+
+def _float(text: str) -> float:
+    try:
+        return float(text)
+    except ValueError:
+        raise ValueError(f"{text!r} is not a number") from None
+
+
+def _number(low: float, high: float, default: float) -> Callable[[list[str]], tuple]:
+    def parse(args: list[str]) -> tuple:
+        if len(args) > 1:
+            raise ValueError("takes one number")
+        value = _float(args[0]) if args else default
+        if not low <= value <= high:  # also rejects nan
+            raise ValueError(f"must be between {low:g} and {high:g}")
+        return (round(value, 4),)
+
+    return parse
+
+
+def _no_args(args: list[str]) -> tuple:
+    if args:
+        raise ValueError("takes no arguments")
+    return ()
+
+
+def _colour_amount(args: list[str]) -> tuple:
+    if not 1 <= len(args) <= 2:
+        raise ValueError("takes a colour and an optional amount")
+    colour = args[0].lstrip("#").lower()
+    if len(colour) != 6 or any(c not in "0123456789abcdef" for c in colour):
+        raise ValueError("colour must be 6 hex digits, e.g. ff8800")
+    amount = _float(args[1]) if len(args) > 1 else 0.5
+    if not 0 <= amount <= 1:
+        raise ValueError("amount must be between 0 and 1")
+    return (colour, round(amount, 4))
+
+
+def _table(fn: Callable[[int], float]) -> Lut:
+    """A 3-channel table of *fn*, rounded and clipped to 0..255."""
+    row = tuple(max(0, min(255, int(fn(v) + 0.5))) for v in range(256))
+    return (row, row, row)
+
+
+def _tint(colour: str, amount: float) -> Matrix:
+    """Blend towards the luma of the pixel in *colour*: ``(1 - amount) * rgb
+    + amount * luma * colour / 255``."""
+    target = [int(colour[i:i + 2], 16) / 255 for i in (0, 2, 4)]
+    return tuple(
+        tuple((1 - amount) * (j == k) + amount * target[k] * LUMA[j] for j in range(3)) + (0.0,)
+        for k in range(3)
+    )
+
+
+FILTERS: dict[str, Filter] = {
+    "brightness": Filter(
+        "lut", _number(0, 10, 1), lambda f: _table(lambda v: v * f), lambda a: a == (1,),
+        "brightness:F scales every channel by F (1 = unchanged)",
+    ),
+    "contrast": Filter(
+        "lut", _number(0, 10, 1), lambda f: _table(lambda v: (v - 128) * f + 128),
+        lambda a: a == (1,), "contrast:F stretches channels around mid-gray by F (1 = unchanged)",
+    ),
+    "gamma": Filter(
+        "lut", _number(0.05, 20, 1), lambda g: _table(lambda v: 255 * (v / 255) ** (1 / g)),
+        lambda a: a == (1,), "gamma:G applies gamma G (above 1 brightens the mid-tones)",
+    ),
+    "invert": Filter(
+        "lut", _no_args, lambda: _table(lambda v: 255 - v), lambda a: False,
+        "invert gives the negative",
+    ),
+    "sepia": Filter(
+        "matrix", _no_args, lambda: tuple(row + (0.0,) for row in SEPIA_WARM), lambda a: False,
+        "sepia applies the warm sepia tone of the sepia option",
+    ),
+    "tint": Filter(
+        "matrix", _colour_amount, _tint, lambda a: a[1] == 0,
+        "tint:RRGGBB[:A] tints towards a colour by A (0..1, default 0.5)",
+    ),
+}
+
+
+def parse_chain(text: str | None) -> Chain:
+    """Parse ``name[:arg[:arg]],...`` into a normalized chain.
+
+    No-op filters (``brightness:1``, ``tint:...:0``) are dropped, so chains
+    that render the same share a signature.  Raises ValueError with a
+    user-facing message for unknown filters or bad arguments.
+    """
+    chain = []
+    for item in (text or "").split(","):
+        if not item.strip():
+            continue
+        name, *args = [part.strip() for part in item.split(":")]
+        spec = FILTERS.get(name.lower())
+        if spec is None:
+            raise ValueError(f"Unknown filter: {name}")
+        try:
+            normalized = spec.parse(args)
+        except ValueError as exc:
+            raise ValueError(f"Invalid filter {name}: {exc}") from None
+        if not spec.identity(normalized):
+            chain.append((name.lower(), normalized))
+    if len(chain) > MAX_FILTERS:
+        raise ValueError(f"Too many filters; the limit is {MAX_FILTERS}")
+    return tuple(chain)
+
+
+def chain_signature(chain: Chain) -> str:
+    """Canonical text of *chain*; parses back to the same chain."""
+    return ",".join(
+        ":".join([name, *(f"{a:g}" if isinstance(a, float) else str(a) for a in args)])
+        for name, args in chain
+    )
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Compilation
+# ──────────────────────────────────────────────────────────────────────────────
+class Stage(NamedTuple):
+    kind: str  # "lut" or "matrix"
+    value: Lut | Matrix
+
+
+def _compose_luts(first: Lut, second: Lut) -> Lut:
+    return tuple(tuple(b[v] for v in a) for a, b in zip(first, second))
+
+
+def _compose_matrices(first: Matrix, second: Matrix) -> Matrix:
+    """The affine map of applying *first*, then *second*."""
+    return tuple(
+        tuple(sum(second[k][i] * first[i][j] for i in range(3)) for j in range(3))
+        + (sum(second[k][i] * first[i][3] for i in range(3)) + second[k][3],)
+        for k in range(3)
+    )
+
+
+class Program:
+    """A compiled chain: alternating table and matrix stages."""
+
+    def __init__(self, chain: Chain, stages: list[Stage]) -> None:
+        self.chain = chain
+        self.stages = stages
+
+    @property
+    def kind(self) -> str:
+        """``lut``, ``matrix``, ``mixed`` or ``""`` for an empty program."""
+        kinds = {stage.kind for stage in self.stages}
+        return "mixed" if len(kinds) > 1 else next(iter(kinds), "")
+
+    def describe(self) -> str:
+        """E.g. ``brightness + gamma + sepia -> lookup table + colour matrix, one pass``."""
+        names = " + ".join(name for name, _ in self.chain)
+        labels = {"lut": "lookup table", "matrix": "colour matrix"}
+        return f"{names} -> {' + '.join(labels[stage.kind] for stage in self.stages)}, one pass"
+
+    def output_mode(self, mode: str) -> str:
+        """The mode :meth:`apply` returns for *mode* input."""
+        if mode in ("L", "1"):
+            luts = self.gray_luts
+            return "L" if luts[0] == luts[1] == luts[2] else "RGB"
+        if self.kind == "lut" and mode in ("RGB", "RGBA"):
+            return mode
+        return "RGB"
+
+    def apply(self, img: Image.Image) -> Image.Image:
+        """Return a new image with the program applied to *img*."""
+        if not self.stages:
+            return img.copy()
+        if img.mode in ("L", "1"):
+            luts = self.gray_luts
+            if luts[0] == luts[1] == luts[2]:
+                return img.convert("L").point(luts[0])
+            return Image.merge("RGB", [img.convert("L").point(lut) for lut in luts])
+        if img.mode not in ("RGB", "RGBA") or self.kind != "lut":
+            img = img.convert("RGB")
+        if self.kind == "lut":
+            table = [v for row in self.stages[0].value for v in row]
+            return img.point(table + list(range(256)) if img.mode == "RGBA" else table)
+        if self.kind == "matrix" and all(row[3] == 0 for row in self.stages[0].value):
+            return apply_color_matrix(img, tuple(row[:3] for row in self.stages[0].value))
+        return _apply_stages(img, self.stages)
+
+    @cached_property
+    def gray_luts(self) -> Lut:
+        """Per-channel output for each gray level, from the RGB path itself."""
+        ramp = Image.frombytes("RGB", (256, 1), bytes(v for v in range(256) for _ in range(3)))
+        out = np.asarray(self.apply(ramp))[0]
+        return tuple(tuple(int(v) for v in out[:, k]) for k in range(3))
+
+
+@lru_cache(maxsize=256)
+def compile_chain(chain: Chain) -> Program:
+    """Compile *chain* (see :func:`parse_chain`); memoized by signature."""
+    stages: list[Stage] = []
+    for name, args in chain:
+        spec = FILTERS[name]
+        value = spec.build(*args)
+        if stages and stages[-1].kind == spec.kind:
+            compose = _compose_luts if spec.kind == "lut" else _compose_matrices
+            stages[-1] = Stage(spec.kind, compose(stages[-1].value, value))
+        else:
+            stages.append(Stage(spec.kind, value))
+    return Program(chain, stages)
+
+
+def tone_chain(apply_sepia: bool, text: str | None) -> Chain:
+    """The chain for the ``sepia`` option (which runs first) plus *text*."""
+    return (("sepia", ()),) * bool(apply_sepia) + parse_chain(text)
+
+
+def _apply_stages(img: Image.Image, stages: list[Stage]) -> Image.Image:
+    """Run mixed *stages* chunk by chunk: one pass over the pixels.
+
+    Channels are kept as separate planes.  A table feeding a matrix is looked
+    up straight into float64, which replaces the conversion the matrix needs
+    anyway; the matrix arithmetic and truncation are those of :mod:`tone`.
+    """
+    ops = []  # (table dtype or None, table or matrix)
+    for i, stage in enumerate(stages):
+        if stage.kind == "lut":
+            feeds_matrix = i + 1 < len(stages)
+            ops.append((np.float64 if feeds_matrix else np.uint8, stage.value))
+        else:
+            ops.append((None, np.asarray(stage.value, dtype=np.float64)))
+    ops = [(dtype, value if dtype is None else [np.asarray(row, dtype) for row in value])
+           for dtype, value in ops]
+
+    src = np.asarray(img)
+    height, width = src.shape[:2]
+    out = np.empty_like(src)
+    rows = max(1, CHUNK_PIXELS // max(1, width))
+    for y0 in range(0, height, rows):
+        planes = [src[y0:y0 + rows, :, k] for k in range(3)]
+        for dtype, value in ops:
+            if dtype is not None:
+                planes = [np.take(value[k], plane) for k, plane in enumerate(planes)]
+                continue
+            if planes[0].dtype != np.float64:
+                planes = [plane.astype(np.float64) for plane in planes]
+            r, g, b = planes
+            planes, term = [], np.empty_like(r)
+            for k in range(3):
+                # ((m0 * r + m1 * g) + m2 * b) + m3, in place, in tone's order
+                v = np.multiply(r, value[k, 0])
+                v += np.multiply(g, value[k, 1], out=term)
+                v += np.multiply(b, value[k, 2], out=term)
+                v += value[k, 3]
+                np.clip(v, 0, 255, out=v)
+                planes.append(v.astype(np.uint8))  # truncates
+        for k in range(3):
+            out[y0:y0 + rows, :, k] = planes[k]
+    return Image.fromarray(out)
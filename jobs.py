@@ -0,0 +1,222 @@
+"""Asynchronous processing jobs backed by a local spool directory.
+
+Each job is up to three files in the spool:
+
+* ``<id>.json`` – metadata: status (queued / running / done / failed),
+  timestamps, options and any error message;
+* ``<id>.in`` – the upload, if it was spooled with the job, until the job
+  has run (so the worker reads it from disk instead of being sent its bytes);
+* ``<id>.out`` – the encoded result, once the job is done.
+
+All writes are atomic (temp file + rename), so every web worker on the host
+can answer status and result requests for jobs submitted to any other.  The
+work itself is done by :func:`run_job` inside a worker-pool process; no
+external broker is involved.  Finished jobs expire after ``ttl`` seconds.
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import IO
+
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+FINAL_STATES = {"done", "failed"}
+
+
+class JobSpool:
+    """Create, inspect and expire jobs stored under *directory*."""
+
+    def __init__(self, directory: str, ttl: float) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self._last_cleanup = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # ----- paths -----
+    def _meta_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def result_path(self, job_id: str) -> str:
+        """Filesystem path of the job's encoded output."""
+        return os.path.join(self.directory, f"{job_id}.out")
+
+    def input_path(self, job_id: str) -> str:
+        """Filesystem path of the job's spooled upload."""
+        return input_path(self.directory, job_id)
+
+    # ----- lifecycle -----
+    def create(self, filename: str, options: dict, upload: IO[bytes] | None = None) -> dict:
+        """Register a new queued job and return its metadata.
+
+        The seekable *upload*, if given, is copied from its start into
+        :meth:`input_path` in chunks.
+        """
+        self.maybe_cleanup()
+        meta = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "filename": filename,
+            "options": options,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "error": None,
+        }
+        if upload is not None:
+            position = upload.tell()
+            upload.seek(0)
+            try:
+                _atomic_write(self.directory, f"{meta['id']}.in", upload)
+            finally:
+                upload.seek(position)
+        write_meta(self.directory, meta)
+        return meta
+
+    def read(self, job_id: str) -> dict | None:
+        """Return the job's metadata, or None if it is unknown or expired."""
+        if not _JOB_ID.match(job_id):
+            return None
+        try:
+            with open(self._meta_path(job_id)) as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if self._expired(meta, time.time()):
+            self._remove(job_id)
+            return None
+        return meta
+
+    def fail(self, job_id: str, error: str) -> None:
+        """Mark a job failed unless it already reached a final state."""
+        meta = self.read(job_id)
+        if meta and meta["status"] not in FINAL_STATES:
+            meta.update(status="failed", error=error, finished=time.time())
+            write_meta(self.directory, meta)
+
+    # ----- expiry -----
+    def _expired(self, meta: dict, now: float) -> bool:
+        finished = meta.get("finished")
+        return finished is not None and now - finished > self.ttl
+
+    def _remove(self, job_id: str) -> None:
+        for path in (self.input_path(job_id), self.result_path(job_id), self._meta_path(job_id)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def maybe_cleanup(self) -> None:
+        """Run :meth:`cleanup` at most every ``ttl / 10`` seconds."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < self.ttl / 10:
+                return
+            self._last_cleanup = now
+        self.cleanup(now)
+
+    def cleanup(self, now: float | None = None) -> int:
+        """Delete expired jobs (and orphaned temp files); return how many."""
+        now = time.time() if now is None else now
+        removed = 0
+        with os.scandir(self.directory) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.name.startswith(".tmp-"):
+                try:
+                    if now - entry.stat().st_mtime > self.ttl:
+                        os.unlink(entry.path)
+                except OSError:
+                    pass
+                continue
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as fh:
+                    meta = json.load(fh)
+            except (OSError, ValueError):
+                continue
+            if self._expired(meta, now):
+                self._remove(meta["id"])
+                removed += 1
+        return removed
+
+
+def input_path(directory: str, job_id: str) -> str:
+    """Filesystem path of the spooled upload of job *job_id* in *directory*."""
+    return os.path.join(directory, f"{job_id}.in")
+
+
+def write_meta(directory: str, meta: dict) -> None:
+    """Atomically (re)write a job's metadata file."""
+    _atomic_write(directory, f"{meta['id']}.json", json.dumps(meta).encode())
+
+
+def _atomic_write(directory: str, name: str, data: bytes | IO[bytes]) -> None:
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            if isinstance(data, bytes):
+                fh.write(data)
+            else:
+                shutil.copyfileobj(data, fh)
+        os.replace(tmp, os.path.join(directory, name))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def run_job(directory: str, meta: dict, data: bytes, render) -> None:
+    """Execute one job; runs inside a worker process.
+
+    *render* is called as ``render(data, meta["options"])`` and must return
+    the encoded bytes; *data* may be the job's :meth:`JobSpool.input_path`,
+    which is removed once the job has run.  Status transitions are written to
+    the spool as they happen, and failures are recorded rather than raised.
+    """
+    meta = dict(meta, status="running", started=time.time())
+    write_meta(directory, meta)
+    try:
+        encoded = render(data, meta["options"])
+        _atomic_write(directory, f"{meta['id']}.out", encoded)
+    except Exception as exc:
+        meta.update(status="failed", error=_describe(exc), finished=time.time())
+    else:
+        meta.update(status="done", bytes=len(encoded), finished=time.time())
+    finally:
+        try:
+            os.unlink(input_path(directory, meta["id"]))
+        except OSError:
+            pass
+    write_meta(directory, meta)
+
+
+def _describe(exc: Exception) -> str:
+    if type(exc).__name__ == "UnidentifiedImageError":
+        return "Cannot identify image file"
+    return str(exc) or type(exc).__name__
+
+
+def public_status(meta: dict) -> dict:
+    """The job metadata as reported to clients, with derived timings."""
+    created, started, finished = meta["created"], meta["started"], meta["finished"]
+    report = {
+        "id": meta["id"],
+        "status": meta["status"],
+        "filename": meta["filename"],
+        "created": created,
+        "started": started,
+        "finished": finished,
+        "queue_seconds": (started or finished or time.time()) - created,
+        "run_seconds": (finished or time.time()) - started if started else None,
+    }
+    if meta.get("error"):
+        report["error"] = meta["error"]
+    if meta.get("bytes") is not None:
+        report["bytes"] = meta["bytes"]
+    return report
@@ -0,0 +1,289 @@
+"""Per-stage request timing and Prometheus-text metrics.
+
+:class:`StageTimer` collects high-resolution (``perf_counter``) durations for
+the stages of one request and renders them as a ``Server-Timing`` header.  The
+shared :data:`NULL_TIMER` records nothing, so instrumented code costs an empty
+``with`` block per stage when metrics are disabled.
+
+:class:`Metrics` holds this process's counters and histograms.  Given a
+*directory*, every process writes a snapshot of its own values there (at most
+once per *flush_interval*, from a background thread, and at exit) and
+:meth:`Metrics.render` sums the snapshots of all processes, so whichever
+Gunicorn worker answers a scrape reports the totals for all of them.  As with
+``prometheus_client``'s multiprocess mode, empty the directory on deploy.
+"""
+import atexit
+import json
+import os
+import tempfile
+import threading
+import uuid
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+# Seconds; the +Inf bucket is implied.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NULL_CONTEXT = nullcontext()
+
+
+class StageTimer:
+    """Wall-clock seconds per named stage, plus pixels processed, for one request."""
+
+    def __init__(self) -> None:
+        self.stages: dict[str, float] = {}
+        self.pixels = 0
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the body of a ``with`` block as stage *name* (accumulating)."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count_pixels(self, pixels: int) -> None:
+        self.pixels += pixels
+
+    def merge(self, other: "StageTimer") -> None:
+        """Fold in the stages recorded by *other* (e.g. in a worker process)."""
+        for name, seconds in other.stages.items():
+            self.add(name, seconds)
+        self.count_pixels(other.pixels)
+
+    @property
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+    def server_timing(self) -> str:
+        """The stages as a ``Server-Timing`` header value (milliseconds)."""
+        return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.stages.items())
+
+
+class _NullTimer(StageTimer):
+    """A timer that records nothing, used when metrics are disabled."""
+
+    def stage(self, name: str):
+        return _NULL_CONTEXT
+
+    def add(self, name: str, seconds: float) -> None:
+        pass
+
+    def count_pixels(self, pixels: int) -> None:
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def _label_key(labels: dict) -> str:
+    """Render labels once, in exposition syntax, for use as a series key."""
+    parts = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{value}"')
+    return ",".join(parts)
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """Counters and histograms for this process, optionally shared via a directory."""
+
+    def __init__(
+        self, enabled: bool = True, directory: str | None = None, flush_interval: float = 1.0
+    ) -> None:
+        self.enabled = enabled
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._meta: dict[str, tuple[str, str, tuple[float, ...] | None]] = {}
+        self._values: dict[str, dict[str, float | list]] = {}
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._flusher: threading.Thread | None = None
+        self._token = uuid.uuid4().hex[:12]
+        self._closed = threading.Event()
+        if directory and enabled:
+            os.makedirs(directory, exist_ok=True)
+        _instances.add(self)
+
+    # ----- definitions -----
+    def counter(self, name: str, help_text: str) -> None:
+        """Declare a counter (*name* should end in ``_total``)."""
+        self._meta[name] = ("counter", help_text, None)
+
+    def histogram(
+        self, name: str, help_text: str, buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        """Declare a histogram with upper bounds *buckets*."""
+        self._meta[name] = ("histogram", help_text, tuple(sorted(buckets)))
+
+    # ----- recording -----
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        """Add *amount* to counter *name*."""
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+        self._mark_dirty()
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record *value* in histogram *name*."""
+        if not self.enabled:
+            return
+        buckets = self._meta[name][2]
+        key = _label_key(labels)
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            data = series.get(key)
+            if data is None:
+                # Per-bucket (non-cumulative) counts, then sum and count.
+                data = series[key] = [0] * len(buckets) + [0.0, 0]
+            index = bisect_left(buckets, value)
+            if index < len(buckets):
+                data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+        self._mark_dirty()
+
+    # ----- exposition -----
+    def render(self) -> str:
+        """All metrics, summed over every process, in Prometheus text format."""
+        values = self._collect()
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(values.get(name, {}).items()):
+                if kind == "counter":
+                    lines.append(f"{name}{{{key}}} {_format(value)}" if key else f"{name} {_format(value)}")
+                    continue
+                prefix = f"{key}," if key else ""
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {_format(value[-1])}')
+                labels = f"{{{key}}}" if key else ""
+                lines.append(f"{name}_sum{labels} {_format(value[-2])}")
+                lines.append(f"{name}_count{labels} {_format(value[-1])}")
+        return "\n".join(lines) + "\n"
+
+    def _collect(self) -> dict:
+        if not self.directory:
+            with self._lock:
+                return json.loads(json.dumps(self._values))
+        self._flush_if_dirty()
+        merged: dict[str, dict] = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as fh:
+                    snapshot = json.load(fh)
+            except (OSError, ValueError):
+                continue  # removed or half-written by an older version
+            for name, series in snapshot.items():
+                target = merged.setdefault(name, {})
+                for key, value in series.items():
+                    if key not in target:
+                        target[key] = value
+                    elif isinstance(value, list):
+                        target[key] = [a + b for a, b in zip(target[key], value)]
+                    else:
+                        target[key] += value
+        return merged
+
+    # ----- multi-process snapshots -----
+    def flush(self) -> None:
+        """Write this process's values to ``<directory>/<pid>-<token>.json``."""
+        if not self.directory:
+            return
+        with self._lock:
+            self._dirty.clear()
+            snapshot = json.dumps(self._values)
+        path = os.path.join(self.directory, f"{os.getpid()}-{self._token}.json")
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as fh:
+                fh.write(snapshot)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def close(self) -> None:
+        """Write any unflushed values and stop the background flusher."""
+        self._closed.set()
+        try:
+            self._flush_if_dirty()
+        finally:
+            self._dirty.set()  # wake the flusher so that it exits
+
+    def _flush_if_dirty(self) -> None:
+        if self._dirty.is_set():
+            self.flush()
+
+    def _mark_dirty(self) -> None:
+        if not self.directory:
+            return
+        self._dirty.set()
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(
+                        target=self._flush_loop, name="metrics-flush", daemon=True
+                    )
+                    self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._dirty.wait()
+            if self._closed.wait(self.flush_interval):
+                return
+            try:
+                self.flush()
+            except OSError:
+                pass  # try again after the next change
+
+    def _after_fork(self) -> None:
+        """Start a forked child with empty values under its own snapshot file."""
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._flusher = None
+        closed, self._closed = self._closed.is_set(), threading.Event()
+        if closed:
+            self._closed.set()
+        self._values = {}
+        self._token = uuid.uuid4().hex[:12]
+
+
+# Live instances, flushed at exit and reset in a forked child by hooks
+# registered once, so that rebuilding Metrics does not pile them up.
+_instances: "weakref.WeakSet[Metrics]" = weakref.WeakSet()
+
+
+def _flush_all() -> None:
+    for metrics in list(_instances):
+        if metrics.enabled:
+            metrics._flush_if_dirty()
+
+
+def _after_fork_in_child() -> None:
+    for metrics in list(_instances):
+        metrics._after_fork()
+
+
+atexit.register(_flush_all)
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,206 @@
+"""Planned operation graph for :func:`app.process_image_data`.
+
+Rather than always running copy → resize → grayscale → sepia, the planner
+looks at the source mode, the target size and the requested filters and emits
+the cheapest equivalent sequence of steps:
+
+* the defensive ``copy()`` is dropped whenever another step already produces
+  a new image, or when the caller owns the input;
+* grayscale (a channel-reducing op) runs *before* resizing RGB sources, so the
+  resampler works on one band instead of three;
+* grayscale on an ``L`` source is elided, and sepia on a grayscale image is a
+  single lookup-table pass (:func:`tone.gray_luts`) with no RGB intermediate;
+* sepia and any other tone filters run as one step, compiled into at most a
+  lookup table and a colour matrix per run of filters (see :mod:`filters`);
+* grayscale output stays in ``L`` all the way to the encoder;
+* with a *tile_budget*, images too big for one strip run the whole plan as a
+  single strip-wise step (see :mod:`tiles`) with bit-identical output.
+
+Reordering grayscale and LANCZOS is not bit-exact (overshoot is clipped per
+channel instead of on the luma), so plans are held to ``REORDER_TOLERANCE``:
+the mean absolute per-channel error (0-255) against the fixed-order pipeline.
+
+Every plan can describe itself with :meth:`Plan.explain`, and
+:meth:`Plan.run` times each step on an optional :class:`metrics.StageTimer`.
+"""
+from typing import Callable, NamedTuple
+
+from PIL import Image, ImageOps
+
+from filters import compile_chain, tone_chain
+from metrics import NULL_TIMER, StageTimer
+from tiles import SEPARABLE_MODES, map_strips, resize_strips, strip_rows
+from tone import SEPIA_WARM, apply_color_matrix
+
+REORDER_TOLERANCE = 1.0
+
+# Modes for which grayscale-then-resize matches resize-then-grayscale within
+# tolerance.  P resizes with NEAREST and RGBA resamples premultiplied alpha,
+# so both keep the original order.
+GRAY_FIRST_MODES = {"RGB"}
+
+
+class Step(NamedTuple):
+    """One planned operation: a name, a callable and a human description."""
+
+    name: str
+    apply: Callable[[Image.Image], Image.Image]
+    detail: str
+
+
+class Plan:
+    """An ordered list of steps plus notes on what the planner decided."""
+
+    def __init__(self, source: str, steps: list[Step], notes: list[str]) -> None:
+        self.source = source
+        self.steps = steps
+        self.notes = notes
+
+    def run(self, img: Image.Image, timer: StageTimer = NULL_TIMER) -> Image.Image:
+        """Execute the plan on *img* and return the result.
+
+        Each step is timed on *timer* under its own name.
+        """
+        for step in self.steps:
+            with timer.stage(step.name):
+                img = step.apply(img)
+        return img
+
+    @property
+    def names(self) -> list[str]:
+        return [step.name for step in self.steps]
+
+    def explain(self) -> str:
+        """Multi-line description of the plan, for logs and debugging."""
+        lines = [f"plan for {self.source}:"]
+        if not self.steps:
+            lines.append("  (no pixel operations)")
+        for number, step in enumerate(self.steps, 1):
+            lines.append(f"  {number}. {step.name:<10} {step.detail}")
+        lines.extend(f"  - {note}" for note in self.notes)
+        return "\n".join(lines)
+
+
+def plan_operations(
+    size: tuple[int, int],
+    mode: str,
+    new_size: tuple[int, int] | None,
+    *,
+    apply_grayscale: bool = False,
+    apply_sepia: bool = False,
+    filters: str | None = None,
+    box: tuple[float, float, float, float] | None = None,
+    reducing_gap: float | None = None,
+    owned: bool = False,
+    notes: list[str] | None = None,
+    tile_budget: int | None = None,
+) -> Plan:
+    """Plan the operations for a *size*/*mode* image (already decoder-drafted).
+
+    *filters* is a tone-filter chain (see :func:`filters.parse_chain`), run
+    after sepia.  *new_size*, *box* and *reducing_gap* describe the resize
+    (None to keep the size); *owned* says the caller will not use the input again, so it
+    may be returned as-is when no pixel work is needed.  *tile_budget* caps
+    the working memory (in bytes) of each strip when tiling.
+    """
+    notes = list(notes or [])
+    steps: list[Step] = []
+    current = mode
+    w, h = size
+
+    def grayscale() -> Step:
+        return Step("grayscale", ImageOps.grayscale, f"{current} -> L")
+
+    gray_first = apply_grayscale and new_size is not None and mode in GRAY_FIRST_MODES
+    if apply_grayscale and mode == "L":
+        notes.append("grayscale elided: source is already L")
+        apply_grayscale = False
+    elif gray_first:
+        steps.append(grayscale())
+        current = "L"
+        notes.append("grayscale moved before resize: resample 1 band instead of 3")
+
+    resize_mode = current
+    if new_size is not None:
+        resample = "NEAREST" if current in ("1", "P") else "LANCZOS"
+        detail = f"{w}x{h} -> {new_size[0]}x{new_size[1]} {resample}"
+        if reducing_gap:
+            detail += f" reducing_gap={reducing_gap}"
+        steps.append(
+            Step(
+                "resize",
+                lambda img: img.resize(
+                    new_size, Image.Resampling.LANCZOS, box=box, reducing_gap=reducing_gap
+                ),
+                detail,
+            )
+        )
+
+    if apply_grayscale and not gray_first:
+        steps.append(grayscale())
+        current = "L"
+
+    chain = tone_chain(apply_sepia, filters)
+    if chain == (("sepia", ()),):
+        if current == "L":
+            detail = "L -> RGB via 3 lookup tables (no RGB intermediate)"
+        else:
+            detail = f"{current} -> RGB colour matrix"
+        steps.append(Step("sepia", lambda img: apply_color_matrix(img, SEPIA_WARM), detail))
+        current = "RGB"
+    elif chain:
+        program = compile_chain(chain)
+        output = program.output_mode(current)
+        if current == "L":
+            detail = f"L -> {output} via lookup tables: {program.describe()}"
+        else:
+            detail = f"{current} -> {output}: {program.describe()}"
+        steps.append(Step("filters", program.apply, detail))
+        current = output
+
+    if tile_budget and steps and strip_rows(w, tile_budget) < h:
+        rows = strip_rows(w, tile_budget)
+        steps = [_tiled(steps, resize_mode, new_size, box, reducing_gap, tile_budget)]
+        notes.append(f"tiled: strips of {rows} rows within a {tile_budget} byte budget")
+
+    if not steps and not owned:
+        steps.append(Step("copy", Image.Image.copy, "defensive copy of a caller-owned image"))
+    elif not steps:
+        notes.append("copy skipped: input is owned and unchanged")
+
+    return Plan(f"{w}x{h} {mode} -> {current}", steps, notes)
+
+
+def _tiled(
+    steps: list[Step],
+    resize_mode: str,
+    new_size: tuple[int, int] | None,
+    box: tuple[float, float, float, float] | None,
+    reducing_gap: float | None,
+    budget: int,
+) -> Step:
+    """Fuse *steps* into one strip-wise step with the same output."""
+    names = [step.name for step in steps]
+    detail = " + ".join(names) + " in strips"
+    if "resize" not in names:
+        ops = [step.apply for step in steps]
+        return Step("tiled", lambda img: map_strips(img, ops, budget), detail)
+
+    split = names.index("resize")
+    pre = [step.apply for step in steps[:split]]
+    post = [step.apply for step in steps[split + 1:]]
+    if resize_mode in SEPARABLE_MODES:
+        return Step(
+            "tiled",
+            lambda img: resize_strips(img, new_size, box, reducing_gap, pre, post, budget),
+            detail,
+        )
+
+    # NEAREST needs no intermediate; only the operations after it are tiled.
+    resize = steps[split].apply
+
+    def nearest_then_strips(img: Image.Image) -> Image.Image:
+        img = resize(map_strips(img, pre, budget) if pre else img)
+        return map_strips(img, post, budget) if post else img
+
+    return Step("tiled", nearest_then_strips, detail + " (NEAREST resize whole)")
@@ -0,0 +1,118 @@
+"""Opt-in cProfile capture for slow requests.
+
+A request is profiled when it carries the configured secret in the
+``X-Profile`` header, or when it is picked by the sampling rate.  The profile
+is taken in the worker process that does the decode/process/encode (see
+:func:`profile_call`) and shipped back with the result; the web process then
+keeps it if the request was explicitly asked for, or if it was slower than
+the threshold.
+
+Dumps live in a bounded directory (:class:`ProfileStore`): each is a
+standard ``.prof`` file, loadable with ``pstats`` or snakeviz, next to a JSON
+record of the image dimensions, mode, options, stage timings and the hottest
+functions.
+"""
+import cProfile
+import hmac
+import json
+import marshal
+import os
+import random
+import re
+import tempfile
+import time
+import uuid
+
+_DUMP_ID = re.compile(r"^\d{8}T\d{6}-[0-9a-f]{8}$")
+
+
+def profile_trigger(header_value: str | None, secret: str | None, sample_rate: float) -> str | None:
+    """Why this request should be profiled: ``"header"``, ``"sample"`` or None."""
+    if secret and header_value and hmac.compare_digest(header_value.encode(), secret.encode()):
+        return "header"
+    if sample_rate > 0 and random.random() < sample_rate:
+        return "sample"
+    return None
+
+
+def profile_call(fn, /, *args, **kwargs):
+    """Run ``fn(*args, **kwargs)`` under cProfile; return ``(result, stats)``.
+
+    *stats* is the marshalled ``pstats`` data (the ``.prof`` file format).
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(fn, *args, **kwargs)
+    profiler.create_stats()
+    return result, marshal.dumps(profiler.stats)
+
+
+def hottest(stats: bytes, limit: int = 10) -> list[dict]:
+    """The *limit* functions with the most own (exclusive) time in *stats*."""
+    rows = sorted(marshal.loads(stats).items(), key=lambda item: item[1][2], reverse=True)
+    return [
+        {
+            "function": f"{name} ({os.path.basename(filename)}:{line})",
+            "calls": calls,
+            "own_ms": round(own * 1000, 3),
+            "cumulative_ms": round(cumulative * 1000, 3),
+        }
+        for (filename, line, name), (_, calls, own, cumulative, _) in rows[:limit]
+    ]
+
+
+class ProfileStore:
+    """Keeps the newest *max_dumps* profiles (``<id>.prof`` + ``<id>.json``)."""
+
+    def __init__(self, directory: str, max_dumps: int) -> None:
+        self.directory = directory
+        self.max_dumps = max_dumps
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, dump_id: str) -> str | None:
+        """The ``.prof`` file for *dump_id*, or None if it is unknown."""
+        if not _DUMP_ID.match(dump_id):
+            return None
+        path = os.path.join(self.directory, f"{dump_id}.prof")
+        return path if os.path.exists(path) else None
+
+    def save(self, stats: bytes, meta: dict) -> str:
+        """Store a dump and its metadata; return the new dump id."""
+        dump_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        record = {"id": dump_id, "created": time.time(), **meta, "hottest": hottest(stats)}
+        self._write(f"{dump_id}.prof", stats)
+        self._write(f"{dump_id}.json", json.dumps(record).encode())  # last: marks it complete
+        self._prune()
+        return dump_id
+
+    def list(self) -> list[dict]:
+        """Metadata of every stored dump, newest first."""
+        records = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as fh:
+                    records.append(json.load(fh))
+            except (OSError, ValueError):
+                continue  # pruned meanwhile
+        return records
+
+    def _write(self, name: str, data: bytes) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, os.path.join(self.directory, name))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _prune(self) -> None:
+        ids = sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith(".json"))
+        for dump_id in ids[: max(0, len(ids) - self.max_dumps)]:
+            for suffix in (".json", ".prof"):
+                try:
+                    os.unlink(os.path.join(self.directory, dump_id + suffix))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,333 @@
+"""Zero-copy hand-over of decoded pixels to worker processes.
+
+Submitting a decoded ``Image`` to a worker process pickles it: Pillow packs
+its pixels into a bytes object, the pickle is written through a pipe and the
+worker unpacks it into a new image.  For a 100 MP photo that is several
+copies of 300-400 MB, which costs as much as the render itself.
+
+:func:`share` instead copies the pixels once, in Pillow's own in-memory
+layout (a fixed number of bytes per pixel, so RGB takes 4, as RGBX), into a
+memory-mapped file and yields a small picklable :class:`SharedImage`.  The
+file lives in *directory*, by default on the RAM-backed ``/dev/shm`` so no
+disk is involved.  In the worker, :func:`call_with_image` maps that file as
+a read-only image with the public :func:`PIL.Image.frombuffer`, which maps
+L, P, RGBX, RGBA, CMYK and 16-bit images without copying them; processing
+reads the pixels straight out of the shared pages.  RGB images are mapped
+as RGBX and converted once in the worker, which is still one copy instead
+of several.  Other modes (1, LA, I, F, ...) are not shared.
+
+:class:`SharedPixels` keeps the files of recently rendered images, so an
+image rendered again, at another size or format, is not copied again.
+
+Lifecycle: a file belongs to the process that shared it.  :func:`share`
+removes it when the ``with share(...)`` block exits, however it exits: the
+worker finished or failed, the pool refused or cancelled the task, or the
+caller stopped waiting; :class:`SharedPixels` removes it when it is evicted
+and no task holds it, or at exit.  A worker that is still reading keeps its
+mapping (POSIX semantics); a task that starts after removal fails with
+:class:`FileNotFoundError`.  The worker always unmaps, also when processing
+raises.  Files left behind by a process that died are removed by
+:func:`remove_stale`, which :func:`app.create_app` runs at startup.  Space
+for the pixels is reserved up front, so a full ``/dev/shm`` (64 MB by
+default in Docker containers) raises :class:`OSError` instead of crashing
+the process on first write.
+"""
+import mmap
+import os
+import re
+import tempfile
+import threading
+import traceback
+import weakref
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import NamedTuple
+
+from PIL import Image
+
+# The layout each shareable mode is stored in: modes Image.frombuffer maps in
+# place, and RGB, which Pillow keeps in memory as RGBX.
+_LAYOUTS = {
+    "L": "L", "P": "P", "RGB": "RGBX", "RGBX": "RGBX", "RGBA": "RGBA", "CMYK": "CMYK",
+    "I;16": "I;16", "I;16L": "I;16L", "I;16B": "I;16B",
+}
+_PIXEL_BYTES = {"L": 1, "P": 1, "I;16": 2, "I;16L": 2, "I;16B": 2}  # 4 for the rest
+SHAREABLE_MODES = frozenset(_LAYOUTS)
+_STRIP_BYTES = 4 * 1024 * 1024  # converted at a time while writing RGB as RGBX
+
+_PREFIX = "pixels-"
+_STALE = re.compile(rf"^{_PREFIX}(\d+)-")
+
+
+class SharedImage(NamedTuple):
+    """Where a shared image's pixels are and how to read them."""
+
+    path: str
+    mode: str
+    size: tuple[int, int]
+    stride: int  # bytes per row
+    palette: tuple[str, bytes] | None  # (rawmode, data) of a P or PA image
+    info: dict
+
+
+def can_share(img: Image.Image) -> bool:
+    """True if *img*'s mode has a fixed pixel size :func:`share` can lay out."""
+    return img.mode in SHAREABLE_MODES
+
+
+@contextmanager
+def share(img: Image.Image, directory: str) -> Iterator[SharedImage]:
+    """Copy *img*'s pixels into a new memory-mapped file in *directory* and
+    yield its :class:`SharedImage`; the file is removed on exit.
+
+    Raises :class:`ValueError` for a mode outside :data:`SHAREABLE_MODES`
+    and :class:`OSError` if *directory* has no room for the pixels.
+    """
+    shared = _write(img, directory)
+    try:
+        yield shared
+    finally:
+        _unlink(shared.path)
+
+
+class _Entry:
+    """One shared file of :class:`SharedPixels` and the tasks using it."""
+
+    __slots__ = ("shared", "size", "leases")
+
+    def __init__(self, shared: SharedImage) -> None:
+        self.shared = shared
+        self.size = os.path.getsize(shared.path)
+        self.leases = 0
+
+
+class SharedPixels:
+    """Shared files of recently rendered images, reused by later renders.
+
+    An LRU keyed by image id and bounded by *max_bytes* of files; a file in
+    use by a task is kept even over budget and removed once released.  The
+    images must not change under their key.  A forked child starts empty
+    (the files belong to its parent).
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+        self._finalizer = weakref.finalize(self, _unlink_entries, self._entries, self._pid)
+
+    @contextmanager
+    def lease(self, key: str, img: Image.Image) -> Iterator[SharedImage]:
+        """Yield the :class:`SharedImage` of *img*, sharing it under *key*
+        unless that is already done; the file stays until the block exits.
+
+        Raises like :func:`share`; a full *directory* is first made room in
+        by removing the files no task is using.
+        """
+        with self._lock:
+            self._check_pid()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.leases += 1
+                self.hits += 1
+        if entry is None:
+            entry = self._add(key, img)
+        try:
+            yield entry.shared
+        finally:
+            with self._lock:
+                entry.leases -= 1
+                self._evict(self.max_bytes)
+
+    def _add(self, key: str, img: Image.Image) -> _Entry:
+        try:
+            shared = _write(img, self.directory)
+        except OSError:
+            with self._lock:
+                self._evict(0)
+            shared = _write(img, self.directory)
+        with self._lock:
+            self._check_pid()
+            entry = self._entries.get(key)
+            if entry is not None:  # shared meanwhile by another thread
+                _unlink(shared.path)
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                entry = self._entries[key] = _Entry(shared)
+                self._bytes += entry.size
+                self.misses += 1
+            entry.leases += 1
+            self._evict(self.max_bytes)
+        return entry
+
+    def _evict(self, budget: int) -> None:
+        """Remove the oldest files no task is using until *budget* bytes are
+        left; caller holds the lock."""
+        for key in [k for k, e in self._entries.items() if e.leases == 0]:
+            if self._bytes <= budget:
+                break
+            entry = self._entries.pop(key)
+            self._bytes -= entry.size
+            _unlink(entry.shared.path)
+
+    def _check_pid(self) -> None:
+        """Forget the parent's files in a forked child; caller holds the lock."""
+        if self._pid != os.getpid():
+            self._entries.clear()
+            self._bytes = 0
+            self._pid = os.getpid()
+            self._finalizer.detach()
+            self._finalizer = weakref.finalize(self, _unlink_entries, self._entries, self._pid)
+
+    def close(self) -> None:
+        """Remove every file (tasks using one keep their mapping)."""
+        with self._lock:
+            self._check_pid()
+            _unlink_entries(self._entries, self._pid)
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Return occupancy and hit counters."""
+        with self._lock:
+            return {
+                "shared_entries": len(self._entries),
+                "shared_bytes": self._bytes,
+                "max_shared_bytes": self.max_bytes,
+                "share_hits": self.hits,
+                "share_misses": self.misses,
+            }
+
+
+def call_with_image(shared: SharedImage, fn: Callable, *args, **kwargs):
+    """Map *shared*'s pixels read-only and return ``fn(image, *args, **kwargs)``
+    (in a worker process).  Only RGB pixels are copied, from RGBX.
+
+    The image is valid only during the call: *fn* must not return it or keep
+    a reference to it.  Writing to it makes Pillow copy it first.
+    """
+    with open(shared.path, "rb") as fh:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        img = _map(mapped, shared)
+        if img.mode != shared.mode:
+            img = img.convert(shared.mode)
+        if shared.palette is not None:
+            img.putpalette(shared.palette[1], shared.palette[0])
+        img.info.update(shared.info)
+        try:
+            return fn(img, *args, **kwargs)
+        except BaseException as exc:
+            # The traceback's frames would otherwise keep the image mapped.
+            traceback.clear_frames(exc.__traceback__)
+            raise
+        finally:
+            del img
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            pass  # *fn* kept the image; it is unmapped when that is collected
+
+
+def remove_stale(directory: str) -> int:
+    """Remove the files of processes that are no longer running; return how many."""
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        match = _STALE.match(name)
+        if match is None or _alive(int(match.group(1))):
+            continue
+        try:
+            os.unlink(os.path.join(directory, name))
+            removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+def _write(img: Image.Image, directory: str) -> SharedImage:
+    """Copy *img*'s pixels into a new file in *directory*; see :func:`share`."""
+    if not can_share(img):
+        raise ValueError(f"cannot share {img.mode} images")
+    img.load()
+    width, height = img.size
+    layout = _LAYOUTS[img.mode]
+    stride = width * _PIXEL_BYTES.get(layout, 4)
+    palette = None
+    if img.mode == "P" and img.palette is not None:
+        palette = (img.palette.mode, bytes(img.getpalette(img.palette.mode)))
+    shared = SharedImage("", img.mode, img.size, stride, palette, dict(img.info))
+
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix=f"{_PREFIX}{os.getpid()}-")
+    try:
+        with os.fdopen(fd, "r+b") as fh:
+            _reserve(fh.fileno(), max(1, stride * height))
+            with mmap.mmap(fh.fileno(), 0) as mapped:
+                target = _map(mapped, shared)
+                target.readonly = 0  # write through to the file
+                if img.mode == layout:
+                    target.paste(img)
+                else:  # in strips, so the converted copy stays small
+                    rows = max(1, _STRIP_BYTES // stride)
+                    for top in range(0, height, rows):
+                        box = (0, top, width, min(height, top + rows))
+                        target.paste(img.crop(box).convert(layout), box[:2])
+                del target  # release the map before it is closed
+    except BaseException:
+        _unlink(path)
+        raise
+    return shared._replace(path=path)
+
+
+def _map(buffer, shared: SharedImage) -> Image.Image:
+    """A read-only image over *buffer* in *shared*'s layout (RGB as RGBX)."""
+    layout = _LAYOUTS[shared.mode]
+    return Image.frombuffer(layout, shared.size, buffer, "raw", layout, shared.stride, 1)
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass  # already gone, or still open on Windows (see remove_stale)
+
+
+def _unlink_entries(entries: dict, pid: int) -> None:
+    """Remove the files of :class:`SharedPixels` *entries* if this process shared them."""
+    if os.getpid() != pid:
+        return
+    for entry in list(entries.values()):
+        _unlink(entry.shared.path)
+    entries.clear()
+
+
+def _reserve(fd: int, size: int) -> None:
+    """Allocate *size* bytes for *fd*, failing now rather than on first write."""
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fd, 0, size)
+    else:  # macOS, Windows
+        os.ftruncate(fd, size)
+
+
+def _alive(pid: int) -> bool:
+    if os.name == "nt":
+        return True  # os.kill would terminate it
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # exists, owned by someone else
+    return True
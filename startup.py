@@ -0,0 +1,61 @@
+"""Process start-up: Pillow set-up and optional diagnostics.
+
+New web workers are started on bursts of traffic, so whatever a process does
+before it can answer its first request adds to tail latency.  Importing
+:mod:`app` therefore has no side effects beyond defining the application;
+:func:`app.create_app` does the rest once, through the helpers here.
+
+Pillow keeps a registry of format plugins.  Left alone it imports five
+plugins on the first ``Image.open`` and then, the first time it meets a
+format not among them (saving WEBP, or any unreadable upload), all of the
+forty-odd it ships.  :func:`configure_pillow` runs that first step
+(``Image.preinit()``) up front and adds the plugins for the other formats we
+read and write; anything else still triggers the full scan, so other formats
+keep working, only more slowly the first time.
+``benchmarks/bench_startup.py`` measures the difference.
+"""
+import importlib
+import logging
+import os
+import sys
+import warnings
+from collections.abc import Iterable
+
+from PIL import Image
+
+# Pillow plugin module per format name.
+PILLOW_PLUGINS = {
+    "BMP": "BmpImagePlugin",
+    "GIF": "GifImagePlugin",
+    "JPEG": "JpegImagePlugin",
+    "PNG": "PngImagePlugin",
+    "TIFF": "TiffImagePlugin",
+    "WEBP": "WebPImagePlugin",
+}
+
+
+def load_plugins(formats: Iterable[str]) -> None:
+    """Run Pillow's pre-initialisation now and register the plugins for
+    *formats* it does not cover, leaving the full plugin scan
+    (``Image.init()``) as a fallback for anything else."""
+    Image.preinit()
+    for fmt in formats:
+        importlib.import_module(f"PIL.{PILLOW_PLUGINS[fmt]}")
+
+
+def configure_pillow(max_pixels: int | None, formats: Iterable[str]) -> None:
+    """Apply the pixel budget to every decode in this process (0 or None:
+    no limit), turn Pillow's decompression-bomb warning into an error and
+    load the plugins for *formats*."""
+    Image.MAX_IMAGE_PIXELS = max_pixels or None
+    # Pillow only warns past the limit (and raises at twice it); make it an error.
+    warnings.simplefilter("error", Image.DecompressionBombWarning)
+    load_plugins(formats)
+
+
+def log_diagnostics(logger: logging.Logger, static_folder: str | None, template_folder: str | None) -> None:
+    """Log the interpreter and where static files and templates are expected."""
+    logger.info("Python version: %s", sys.version)
+    logger.info("Current working directory: %s", os.getcwd())
+    for name, folder in (("Static", static_folder), ("Templates", template_folder)):
+        logger.info("%s folder %s exists: %s", name, folder, bool(folder) and os.path.isdir(folder))
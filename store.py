@@ -0,0 +1,130 @@
+"""Upload-once image store.
+
+Originals are stored on local disk under their SHA-256 (so uploading the same
+bytes twice is free and ids are stable across workers).  Reads go through a
+read-only memory map, and decoded ``Image`` objects are kept in an LRU bounded
+by their in-memory size, so repeated renders of a popular image skip both
+the network transfer and the decode.
+"""
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import IO
+
+from PIL import Image
+
+from cache import HASH_CHUNK_BYTES, hash_stream
+
+_IMAGE_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+def decoded_size(img: Image.Image) -> int:
+    """Approximate bytes Pillow holds for *img* (multi-band modes use 4 B/px)."""
+    bands = len(img.getbands())
+    return img.width * img.height * (1 if bands == 1 else 4)
+
+
+class ImageStore:
+    """Content-addressed originals on disk plus an LRU of decoded images."""
+
+    def __init__(self, directory: str, max_decoded_bytes: int) -> None:
+        self.directory = directory
+        self.max_decoded_bytes = max_decoded_bytes
+        self._decoded: OrderedDict[str, Image.Image] = OrderedDict()
+        self._decoded_bytes = 0
+        self._lock = threading.Lock()
+        self.decode_hits = 0
+        self.decode_misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, image_id: str) -> str:
+        """Filesystem path of the original for *image_id*."""
+        return os.path.join(self.directory, image_id[:2], image_id)
+
+    def exists(self, image_id: str) -> bool:
+        """True if *image_id* is well-formed and stored."""
+        return bool(_IMAGE_ID.match(image_id)) and os.path.exists(self.path(image_id))
+
+    def put(self, data: bytes | IO[bytes]) -> tuple[str, bool]:
+        """Store *data* (bytes, or a seekable stream copied from its start in
+        chunks); return ``(image_id, created)``."""
+        if isinstance(data, bytes):
+            image_id = hashlib.sha256(data).hexdigest()
+        else:
+            image_id = hash_stream(data).hexdigest()
+        path = self.path(image_id)
+        if os.path.exists(path):
+            return image_id, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                if isinstance(data, bytes):
+                    fh.write(data)
+                else:
+                    position = data.tell()
+                    data.seek(0)
+                    shutil.copyfileobj(data, fh, HASH_CHUNK_BYTES)
+                    data.seek(position)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return image_id, True
+
+    def open(self, image_id: str) -> Image.Image:
+        """Return the decoded original (shared; callers must not mutate it).
+
+        Only the first frame of an animation is decoded; its ``n_frames`` is
+        known, and the rest is read from :meth:`path`.
+
+        Raises KeyError if *image_id* is not in the store.
+        """
+        with self._lock:
+            img = self._decoded.get(image_id)
+            if img is not None:
+                self._decoded.move_to_end(image_id)
+                self.decode_hits += 1
+                return img
+
+        if not self.exists(image_id):
+            raise KeyError(image_id)
+        with open(self.path(image_id), "rb") as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                img = Image.open(mapped)
+                getattr(img, "n_frames", 1)  # counted now: later seeks need the map
+                img.load()
+                img.fp = None  # the map is closed below; the pixels are in memory
+
+        with self._lock:
+            self.decode_misses += 1
+            self._remember(image_id, img)
+        return img
+
+    def _remember(self, image_id: str, img: Image.Image) -> None:
+        """Insert into the decoded LRU; caller holds the lock."""
+        size = decoded_size(img)
+        if size > self.max_decoded_bytes or image_id in self._decoded:
+            return
+        self._decoded[image_id] = img
+        self._decoded_bytes += size
+        while self._decoded_bytes > self.max_decoded_bytes:
+            _, evicted = self._decoded.popitem(last=False)
+            self._decoded_bytes -= decoded_size(evicted)
+
+    def stats(self) -> dict:
+        """Return decoded-LRU occupancy and hit counters."""
+        with self._lock:
+            return {
+                "decoded_entries": len(self._decoded),
+                "decoded_bytes": self._decoded_bytes,
+                "max_decoded_bytes": self.max_decoded_bytes,
+                "decode_hits": self.decode_hits,
+                "decode_misses": self.decode_misses,
+            }
@@ -0,0 +1,96 @@
+"""Response bodies that avoid buffering or copying encoded images.
+
+* :func:`buffer_response` serves a result that already exists in memory (a
+  cache hit, a stored render) by handing the ``bytes`` object itself to the
+  WSGI server as the only body chunk, rather than wrapping it in a
+  ``BytesIO`` that is read back out and copied in small blocks.  For GET and
+  HEAD it honours ``Range``/``If-Range``; a partial response copies only the
+  requested slice.
+* :func:`follow_file` streams a file while a worker process is still writing
+  it, so the first encoded bytes leave before encoding has finished and the
+  web process never holds more than one chunk.  With no ``Content-Length``
+  the server falls back to chunked transfer encoding.
+
+Both name their download with :func:`set_download_name`, which encodes it
+the way ``send_file`` does so any upload's filename makes a valid header.
+"""
+import time
+import unicodedata
+from collections.abc import Iterator
+from concurrent.futures import Future
+from urllib.parse import quote
+
+from flask import Response
+from werkzeug.datastructures import Headers
+
+CHUNK_SIZE = 64 * 1024
+POLL_SECONDS = 0.005
+
+
+def buffer_response(
+    data: bytes,
+    mimetype: str,
+    *,
+    environ: dict | None = None,
+    download_name: str | None = None,
+    etag: str | None = None,
+) -> Response:
+    """A response whose body is *data* itself (no copy).
+
+    With the request *environ*, conditional and range requests are answered
+    (``304``, ``206``, ``416``) as ``send_file`` would.
+    """
+    response = Response([data], mimetype=mimetype)
+    response.content_length = len(data)
+    if download_name:
+        set_download_name(response.headers, download_name)
+    if etag:
+        response.set_etag(etag)
+    if environ is not None:
+        response.accept_ranges = "bytes"  # Werkzeug only advertises it on a 206
+        response = response.make_conditional(environ, accept_ranges=True, complete_length=len(data))
+    return response
+
+
+def set_download_name(headers: Headers, download_name: str) -> None:
+    """Set ``Content-Disposition: attachment`` for *download_name*, as
+    ``send_file`` does: a non-ASCII name gets an ASCII ``filename`` fallback
+    and the full name as RFC 2231 ``filename*``, so the header stays latin-1.
+    """
+    try:
+        download_name.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        quoted = quote(download_name, safe="!#$&+-.^_`|~")  # RFC 5987 attr-char
+        names = {"filename": simple, "filename*": f"UTF-8''{quoted}"}
+    else:
+        names = {"filename": download_name}
+    headers.set("Content-Disposition", "attachment", **names)
+
+
+def follow_file(
+    path: str, future: Future, chunk_size: int = CHUNK_SIZE, poll: float = POLL_SECONDS
+) -> Iterator[bytes]:
+    """Yield *path* as it grows until *future* (its writer) has finished.
+
+    The file is opened now, so a missing one raises :class:`FileNotFoundError`
+    here rather than once the response has started.  If the writer failed,
+    its exception is raised after the last byte, so the server aborts the
+    response instead of ending a truncated body cleanly.
+    """
+    return _follow(open(path, "rb"), future, chunk_size, poll)
+
+
+def _follow(fh, future: Future, chunk_size: int, poll: float) -> Iterator[bytes]:
+    with fh:
+        while True:
+            finished = future.done()  # checked first: nothing written before it can be missed
+            block = fh.read(chunk_size)
+            if block:
+                yield block
+            elif finished:
+                break
+            else:
+                time.sleep(poll)
+    future.result()  # re-raise the writer's failure, if any
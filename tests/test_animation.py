@@ -0,0 +1,105 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+from animation import (AnimationTooLarge, Frame, check_budget, is_animated, iter_frames,
+                       write_gif)
+from metrics import StageTimer
+
+
+def moving_square(n=6, size=(64, 48), transparent=False):
+    """Frames of a square moving over a two-colour background."""
+    frames = []
+    for i in range(n):
+        img = Image.new('RGBA' if transparent else 'RGB', size,
+                        (0, 0, 0, 0) if transparent else (20, 90, 200))
+        draw = ImageDraw.Draw(img)
+        if not transparent:
+            draw.rectangle((0, size[1] // 2, size[0], size[1]), fill=(240, 240, 220))
+        draw.rectangle((i * 6, 8, i * 6 + 15, 23), fill=(230, 30, 30, 255))
+        frames.append(img)
+    return frames
+
+
+def gif_bytes(frames, **params):
+    out = io.BytesIO()
+    frames[0].save(out, format='GIF', save_all=True, append_images=frames[1:], **params)
+    return out.getvalue()
+
+
+def written(frames, loop=0, **kwargs):
+    out = io.BytesIO()
+    count = write_gif(frames, out, loop, **kwargs)
+    return count, out.getvalue()
+
+
+def displayed(data):
+    img = Image.open(io.BytesIO(data))
+    background = Image.new('RGBA', img.size, (255, 0, 255, 255))  # hidden colours don't count
+    return [Image.alpha_composite(background, frame.image.convert('RGBA')).tobytes()
+            for frame in iter_frames(img)]
+
+
+# --- Tests ---
+@pytest.mark.parametrize('transparent', [False, True])
+def test_round_trip_matches_pillow(transparent):
+    source = gif_bytes(moving_square(transparent=transparent), duration=[40, 50, 60, 70, 80, 90],
+                       loop=0, disposal=2 if transparent else 1)
+    img = Image.open(io.BytesIO(source))
+    count, data = written(iter_frames(img), img.info.get('loop'))
+    assert count == 6
+    assert displayed(data) == displayed(source)
+    out = Image.open(io.BytesIO(data))
+    assert out.info['loop'] == 0
+    durations = []
+    for index in range(out.n_frames):
+        out.seek(index)
+        durations.append(out.info['duration'])
+    assert durations == [40, 50, 60, 70, 80, 90]
+
+
+def test_unchanged_regions_are_cropped_and_the_palette_shared():
+    frames = [Frame(img, 40, 1) for img in moving_square()]
+    _, data = written(frames)
+    out = Image.open(io.BytesIO(data))
+    out.seek(1)
+    assert out.tile[0][1] != (0, 0, 64, 48)  # only the moved square
+    assert 'transparency' not in out.info
+    assert len(data) < len(gif_bytes([f.image for f in frames], duration=40, loop=0))
+
+
+def test_a_new_scene_gets_a_palette():
+    frames = [Frame(img, 40, 1) for img in moving_square(3)]
+    frames.append(Frame(Image.radial_gradient('L').convert('RGB').resize((64, 48)), 40, 1))
+    out = io.BytesIO()
+    timer = StageTimer()
+    write_gif(frames, out, 0, timer=timer)
+    assert 'encode' in timer.stages
+    shown = displayed(out.getvalue())
+    assert len(shown) == 4
+    assert shown[3] != shown[2]
+
+
+def test_grayscale_frames_use_the_implicit_table():
+    frames = [Frame(Image.linear_gradient('L').resize((32, 32)).rotate(i * 90), 30, 1) for i in range(3)]
+    count, data = written(frames)
+    assert count == 3
+    out = Image.open(io.BytesIO(data))
+    out.seek(2)
+    assert out.convert('L').tobytes() == frames[2].image.tobytes()
+
+
+def test_budget_and_detection():
+    img = Image.open(io.BytesIO(gif_bytes(moving_square(4), duration=40)))
+    assert is_animated(img)
+    assert not is_animated(Image.new('RGB', (4, 4)))
+    check_budget(img, None)
+    check_budget(img, 4 * 64 * 48)
+    with pytest.raises(AnimationTooLarge) as exc:
+        check_budget(img, 4 * 64 * 48 - 1)
+    assert str(exc.value) == 'Animation is too large (4 frames of 64x48); the limit is 12287 frame pixels'
+
+
+def test_empty_input_writes_nothing():
+    assert written([]) == (0, b'')
@@ -1,8 +1,10 @@
 import pytest
-from app import app, process_image_data, allowed_file # Import Flask app and functions
-from PIL import Image, ImageChops
+from app import app, process_image_data, allowed_file, result_cache, build_variants, DOWNSCALE_TOLERANCE, VARIANT_TOLERANCE # Import Flask app and functions
+from PIL import Image, ImageChops, ImageFilter, ImageStat
 import io
+import json
 import os
+import time
 
 # --- Fixtures ---
 @pytest.fixture
@@ -93,6 +95,56 @@ def test_process_image_data_combined_ops():
     assert processed.size == (100, 50)
     assert processed.mode == 'L'
 
+# --- Reduce-on-decode fast path ---
+def create_photo_like_jpeg(size=(1200, 900)):
+    """JPEG with fractal detail, a gradient and soft noise (stand-in for a photo)."""
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 100)
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(1))
+    byte_arr = io.BytesIO()
+    Image.merge('RGB', (detail, gradient, noise)).save(byte_arr, format='JPEG', quality=90)
+    return byte_arr.getvalue()
+
+def mean_abs_diff(a, b):
+    return max(ImageStat.Stat(ImageChops.difference(a, b)).mean)
+
+def test_reduce_on_decode_uses_jpeg_draft():
+    data = create_photo_like_jpeg()
+    img = Image.open(io.BytesIO(data))
+    processed = process_image_data(img, 'width', 100, 100, False, False)
+    assert processed.size == (100, 75)
+    assert img.size == (300, 225) # decoded at 1/4 scale, >= REDUCING_GAP x target
+
+@pytest.mark.parametrize("resize_option, width, percentage", [
+    ('width', 100, 100),
+    ('width', 150, 100),
+    ('percent', None, 10),
+])
+def test_reduce_on_decode_within_tolerance(resize_option, width, percentage):
+    data = create_photo_like_jpeg()
+    fast = process_image_data(Image.open(io.BytesIO(data)), resize_option, width, percentage, False, False)
+    exact = process_image_data(Image.open(io.BytesIO(data)), resize_option, width, percentage, False, False,
+                               reduce_on_decode=False)
+    assert fast.size == exact.size
+    assert mean_abs_diff(fast, exact) <= DOWNSCALE_TOLERANCE
+
+def test_reduce_on_decode_skipped_for_small_downscale():
+    data = create_photo_like_jpeg()
+    img = Image.open(io.BytesIO(data))
+    processed = process_image_data(img, 'width', 600, 100, False, False)
+    assert img.size == (1200, 900) # under REDUCING_GAP: full decode, identical output
+    exact = process_image_data(Image.open(io.BytesIO(data)), 'width', 600, 100, False, False,
+                               reduce_on_decode=False)
+    assert ImageChops.difference(processed, exact).getbbox() is None
+
+def test_reduce_on_decode_non_jpeg():
+    src = Image.open(io.BytesIO(create_photo_like_jpeg()))
+    byte_arr = io.BytesIO()
+    src.save(byte_arr, format='PNG')
+    fast = process_image_data(Image.open(io.BytesIO(byte_arr.getvalue())), 'width', 100, 100, False, False)
+    exact = process_image_data(src, 'width', 100, 100, False, False, reduce_on_decode=False)
+    assert mean_abs_diff(fast, exact) <= DOWNSCALE_TOLERANCE
+
 # --- Test Flask Routes (Integration Tests) ---
 def test_index_route(client):
     """Test if the index page loads."""
@@ -135,6 +187,281 @@ def test_process_image_invalid_file_type(client):
     response = client.get(response.location)
     assert b"Invalid file type" in response.data
 
+def test_process_image_result_cache(client):
+    """Identical upload + options is served from the cache with a stable ETag."""
+    result_cache.clear()
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '5', 'format': 'PNG'}
+    first = client.post('/process', data=data, content_type='multipart/form-data')
+    assert first.headers['X-Cache'] == 'MISS'
+
+    data = {'file': (create_sample_image(), 'other.png'), 'resize_option': 'width', 'width': '5',
+            'percentage': '30', 'format': 'PNG'} # percentage is irrelevant in width mode
+    second = client.post('/process', data=data, content_type='multipart/form-data')
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert second.data == first.data
+
+    stats = client.get('/cache/stats').get_json()
+    assert stats['hits'] == 1 and stats['misses'] == 1
+
+def test_process_image_if_none_match(client):
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'none', 'format': 'PNG'}
+    etag = client.post('/process', data=data, content_type='multipart/form-data').headers['ETag']
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'none', 'format': 'PNG'}
+    response = client.post('/process', data=data, content_type='multipart/form-data',
+                           headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+def test_process_image_negotiates_format(client):
+    browser = 'text/html,image/avif,image/webp,*/*;q=0.8'
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'none'}
+    response = client.post('/process', data=data, content_type='multipart/form-data',
+                           headers={'Accept': browser})
+    assert response.mimetype == 'image/webp'
+    assert 'Accept' in response.headers['Vary']
+    assert Image.open(io.BytesIO(response.data)).format == 'WEBP'
+
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'none', 'format': 'auto'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert response.mimetype == 'image/jpeg'  # no Accept header
+
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'none', 'format': 'PNG'}
+    response = client.post('/process', data=data, content_type='multipart/form-data',
+                           headers={'Accept': browser})
+    assert response.mimetype == 'image/png'  # an explicit format wins
+    assert 'Vary' not in response.headers
+
+def test_process_image_encoding_profiles(client):
+    result_cache.clear()
+    sizes = {}
+    for encoding in ('fast', 'smallest', 'bogus'):
+        data = {'file': (io.BytesIO(create_photo_like_jpeg((400, 300))), 'photo.jpg'),
+                'resize_option': 'none', 'format': 'JPEG', 'encoding': encoding}
+        response = client.post('/process', data=data, content_type='multipart/form-data')
+        assert response.headers['X-Cache'] == 'MISS'
+        sizes[encoding] = len(response.data)
+    assert sizes['smallest'] < sizes['bogus'] < sizes['fast']  # bogus falls back to balanced
+
+def test_process_image_streamed(client, tmp_path, monkeypatch):
+    """Large outputs are streamed (chunked) while encoding, then cached."""
+    result_cache.clear()
+    monkeypatch.setitem(app.config, 'STREAM_MIN_PIXELS', 50)
+    monkeypatch.setitem(app.config, 'STREAM_SPOOL_DIR', str(tmp_path))
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'none', 'sepia': 'on', 'format': 'PNG'}
+    first = client.post('/process', data=data, content_type='multipart/form-data', buffered=True)
+    assert first.status_code == 200
+    assert first.headers['X-Cache'] == 'MISS'
+    assert 'Content-Length' not in first.headers
+    assert first.headers['Content-Disposition'].startswith('attachment')
+    assert Image.open(io.BytesIO(first.data)).size == (10, 10)
+    assert os.listdir(tmp_path) == [] # the spool file was adopted by the cache
+
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'none', 'sepia': 'on', 'format': 'PNG'}
+    second = client.post('/process', data=data, content_type='multipart/form-data')
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.headers['Content-Length'] == str(len(first.data))
+    assert second.data == first.data
+
+    # Small outputs (5x5 < 50 pixels) are still answered from a buffer.
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '5'}
+    small = client.post('/process', data=data, content_type='multipart/form-data')
+    assert small.headers['X-Cache'] == 'MISS' and 'Content-Length' in small.headers
+
+@pytest.mark.parametrize('stream_min_pixels', [0, 50])
+def test_process_image_non_ascii_filename(client, tmp_path, monkeypatch, stream_min_pixels):
+    """Buffered and streamed downloads encode the name as send_file does."""
+    result_cache.clear()
+    monkeypatch.setitem(app.config, 'STREAM_MIN_PIXELS', stream_min_pixels)
+    monkeypatch.setitem(app.config, 'STREAM_SPOOL_DIR', str(tmp_path))
+    data = {'file': (create_sample_image(), 'фото.png'), 'resize_option': 'none', 'format': 'PNG'}
+    response = client.post('/process', data=data, content_type='multipart/form-data', buffered=True)
+    assert response.status_code == 200
+    disposition = response.headers['Content-Disposition']
+    disposition.encode('latin-1')
+    assert "filename*=UTF-8''%D1%84%D0%BE%D1%82%D0%BE_" in disposition
+
+def test_process_image_streamed_bad_upload(client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'STREAM_MIN_PIXELS', 1)
+    monkeypatch.setitem(app.config, 'STREAM_SPOOL_DIR', str(tmp_path))
+    data = {'file': (io.BytesIO(b'junk'), 'test.png'), 'resize_option': 'none'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert os.listdir(tmp_path) == []
+
+def test_process_image_busy(client, monkeypatch):
+    """A saturated worker pool sheds load with 503 + Retry-After."""
+    import app as app_module
+    from workers import WorkerPool
+    pool = WorkerPool(1, max_queue=0)
+    monkeypatch.setattr(app_module, 'worker_pool', pool)
+    result_cache.clear()
+    try:
+        pool.submit(time.sleep, 0.5)
+        data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '3'}
+        response = client.post('/process', data=data, content_type='multipart/form-data')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        assert client.get('/workers/stats').get_json()['rejected'] == 1
+    finally:
+        pool.shutdown()
+
+def test_process_image_coalesces_identical_requests(monkeypatch):
+    """Identical misses in flight together are rendered once and shared."""
+    import threading
+    import app as app_module
+    from coalesce import Coalescer
+    from workers import WorkerPool
+    real_render = app_module.render_image_timed
+    started = threading.Barrier(4)
+
+    def slow_render(*args, **kwargs):
+        result = real_render(*args, **kwargs)
+        time.sleep(0.3)  # the spool file exists but the render is not done yet
+        return result
+
+    pool = WorkerPool(0, max_queue=8)
+    monkeypatch.setattr(app_module, 'worker_pool', pool)
+    monkeypatch.setattr(app_module, 'render_image_timed', slow_render)
+    monkeypatch.setattr(app_module, 'coalescer', Coalescer(None, timeout=10))
+    result_cache.clear()
+    responses = []
+
+    def post():
+        data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '4', 'format': 'PNG'}
+        with app.test_client() as client:
+            started.wait()
+            responses.append(client.post('/process', data=data, content_type='multipart/form-data'))
+
+    threads = [threading.Thread(target=post) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(r.headers['X-Cache'] for r in responses) == ['COALESCED'] * 3 + ['MISS']
+    assert len({r.data for r in responses}) == 1
+    assert {r.headers['ETag'] for r in responses} == {responses[0].headers['ETag']}
+    with app.test_client() as client:
+        stats = client.get('/coalesce/stats').get_json()
+    assert stats['computed'] == 1 and stats['saved'] == stats['shared_threads'] == 3
+
+def test_process_image_coalesces_streamed_requests(tmp_path, monkeypatch):
+    """Identical large misses follow the first one's spool file: one render."""
+    import threading
+    import app as app_module
+    from coalesce import Coalescer
+    from workers import WorkerPool
+    real_render = app_module.render_image_timed
+    started = threading.Barrier(4)
+    renders = []
+
+    def slow_render(*args, **kwargs):
+        renders.append(1)
+        result = real_render(*args, **kwargs)
+        time.sleep(0.3)  # the spool file exists but the render is not done yet
+        return result
+
+    monkeypatch.setattr(app_module, 'worker_pool', WorkerPool(0, max_queue=8))
+    monkeypatch.setattr(app_module, 'render_image_timed', slow_render)
+    monkeypatch.setattr(app_module, 'coalescer', Coalescer(None, timeout=10))
+    monkeypatch.setitem(app.config, 'STREAM_MIN_PIXELS', 50)
+    monkeypatch.setitem(app.config, 'STREAM_SPOOL_DIR', str(tmp_path))
+    result_cache.clear()
+    responses = []
+
+    def post():
+        data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'none', 'format': 'PNG'}
+        with app.test_client() as client:
+            started.wait()
+            responses.append(client.post('/process', data=data, content_type='multipart/form-data',
+                                         buffered=True))
+
+    threads = [threading.Thread(target=post) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(renders) == 1
+    assert sorted(r.headers['X-Cache'] for r in responses) == ['COALESCED'] * 3 + ['MISS']
+    assert all('Content-Length' not in r.headers for r in responses)  # all streamed
+    assert len({r.data for r in responses}) == 1
+    assert Image.open(io.BytesIO(responses[0].data)).size == (10, 10)
+    assert os.listdir(tmp_path) == []  # adopted by the cache
+    with app.test_client() as client:
+        stats = client.get('/coalesce/stats').get_json()
+    assert stats['computed'] == 1 and stats['shared_threads'] == 3 and stats['in_flight'] == 0
+
+def test_process_image_client_budget(client, monkeypatch):
+    """Clients whose estimated work exceeds their budget get 429 + Retry-After."""
+    import app as app_module
+    from costs import ClientBudget
+    budget = ClientBudget(seconds=1.0, window=3600)
+    monkeypatch.setattr(app_module, 'client_budget', budget)
+    monkeypatch.setattr(app_module.cost_model, 'estimate', lambda features: 0.6)
+    result_cache.clear()
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '5'}
+    assert client.post('/process', data=data, content_type='multipart/form-data').status_code == 200
+    # Renders are settled at their measured time, so spend the rest directly.
+    assert budget.charge('127.0.0.1', 0.9) == 0
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '6'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    # Cache hits cost nothing and are still served.
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '5'}
+    assert client.post('/process', data=data, content_type='multipart/form-data').status_code == 200
+    assert client.get('/costs/stats').get_json()['budget_rejected'] == 1
+
+def test_process_image_over_whole_budget(client, monkeypatch):
+    """A render estimated above the whole budget is refused even from a fresh client."""
+    import app as app_module
+    from costs import ClientBudget
+    monkeypatch.setattr(app_module, 'client_budget', ClientBudget(seconds=1.0, window=3600))
+    monkeypatch.setattr(app_module.cost_model, 'estimate', lambda features: 2.0)
+    result_cache.clear()
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '5'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert response.status_code == 413
+    assert 'Retry-After' not in response.headers
+
+def test_client_budget_covers_every_rendering_endpoint(client, job_spool, image_store, monkeypatch):
+    """/process/batch, /process/variants, /jobs and stored renders draw on the same budget."""
+    import app as app_module
+    from costs import ClientBudget
+    monkeypatch.setattr(app_module.cost_model, 'estimate', lambda features: 0.6)
+    result_cache.clear()
+    stored = client.post('/images', data={'file': (create_sample_image(), 'test.png')},
+                         content_type='multipart/form-data').get_json()
+
+    def upload(**fields):
+        return dict(fields, file=(create_sample_image(), 'test.png'))
+    requests = [
+        lambda width: client.post('/process/batch', data={'files': [(create_sample_image(), 'test.png')],
+                                                          'resize_option': 'none'},
+                                  content_type='multipart/form-data'),
+        lambda width: client.post('/process/variants', data=upload(widths=str(width)),
+                            content_type='multipart/form-data'),
+        lambda width: client.post('/jobs', data=upload(resize_option='none'),
+                            content_type='multipart/form-data'),
+        lambda width: client.get(stored['render_url'] + f'?w={width}'),
+    ]
+    for send in requests:
+        budget = ClientBudget(seconds=1.0, window=3600)
+        monkeypatch.setattr(app_module, 'client_budget', budget)
+        assert send(3).status_code in (200, 202)
+        response = send(4)
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+        assert budget.rejected == 1
+
+def test_cost_model_calibrates_from_renders(client):
+    import app as app_module
+    before = app_module.cost_model.observations
+    result_cache.clear()
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '7'}
+    client.post('/process', data=data, content_type='multipart/form-data')
+    assert client.get('/costs/stats').get_json()['observations'] == before + 1
+
 # Add more tests for edge cases: invalid width, percentage > 500, etc.
 def test_process_image_invalid_width(client, sample_image_bytes):
     data = {
@@ -184,4 +511,513 @@ def test_process_image_percent_edge_cases(client):
     # --- Without validation, it would process: ---
     assert response.status_code == 200
     img = Image.open(io.BytesIO(response.data))
-    assert img.size == (50, 50) # 501% of 10x10 -> 50x50
\ No newline at end of file
+    assert img.size == (50, 50) # 501% of 10x10 -> 50x50
+# --- Batch endpoint ---
+def read_zip(data):
+    import zipfile
+    return zipfile.ZipFile(io.BytesIO(data))
+
+def test_process_batch(client, sample_image_large_bytes):
+    data = {
+        'files': [
+            (create_sample_image(), 'a.png'),
+            (sample_image_large_bytes, 'b.jpg'),
+            (io.BytesIO(b'not an image'), 'c.txt'),
+            (io.BytesIO(b'not an image'), 'd.png'),
+        ],
+        'resize_option': 'width',
+        'width': '4',
+        'format': 'PNG',
+        'options': '[{}, {"resize_option": "percent", "percentage": 50, "format": "JPEG", "grayscale": true}]',
+    }
+    response = client.post('/process/batch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+
+    archive = read_zip(response.data)
+    manifest = json.loads(archive.read('manifest.json'))
+    assert [entry['input'] for entry in manifest] == ['a.png', 'b.jpg', 'c.txt', 'd.png']
+    assert Image.open(io.BytesIO(archive.read(manifest[0]['output']))).size == (4, 4)
+    b_img = Image.open(io.BytesIO(archive.read(manifest[1]['output'])))
+    assert (b_img.format, b_img.size, b_img.mode) == ('JPEG', (50, 25), 'L')
+    assert manifest[2]['error'] == 'Invalid file type'
+    assert manifest[3]['error'] == 'Cannot identify image file'
+
+def test_process_batch_no_files(client):
+    response = client.post('/process/batch', data={}, content_type='multipart/form-data')
+    assert response.status_code == 400
+
+def test_process_batch_bad_options(client):
+    data = {'files': [(create_sample_image(), 'a.png')], 'resize_option': 'width', 'width': '0'}
+    response = client.post('/process/batch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Invalid input for dimensions'
+
+# --- Async jobs ---
+@pytest.fixture
+def job_spool(tmp_path, monkeypatch):
+    import app as app_module
+    from jobs import JobSpool
+    spool = JobSpool(str(tmp_path), ttl=60)
+    monkeypatch.setattr(app_module, 'job_spool', spool)
+    return spool
+
+def wait_for_job(client, status_url):
+    for _ in range(100):
+        status = client.get(status_url).get_json()
+        if status['status'] in ('done', 'failed'):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f'job did not finish: {status}')
+
+def test_job_submit_poll_fetch(client, job_spool):
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '4', 'format': 'PNG'}
+    response = client.post('/jobs', data=data, content_type='multipart/form-data')
+    assert response.status_code == 202
+    job = response.get_json()
+    assert response.headers['Location'] == job['status_url']
+
+    status = wait_for_job(client, job['status_url'])
+    assert status['status'] == 'done'
+    assert status['run_seconds'] >= 0
+
+    result = client.get(job['result_url'])
+    assert result.status_code == 200
+    assert result.mimetype == 'image/png'
+    assert Image.open(io.BytesIO(result.data)).size == (4, 4)
+    result.close()
+
+def corrupt_png():
+    """A PNG whose chunks and checksums are intact but whose pixel data is not."""
+    import struct
+    import zlib
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    ihdr = struct.pack('>IIBBBBB', 20, 20, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IDAT', b'garbage' * 10) + chunk(b'IEND', b'')
+
+def test_job_failure(client, job_spool):
+    # Junk and truncated bodies are refused up front; corrupt pixel data fails in the job.
+    data = {'file': (io.BytesIO(b'not an image'), 'test.png'), 'resize_option': 'none'}
+    response = client.post('/jobs', data=data, content_type='multipart/form-data')
+    assert (response.status_code, response.get_json()['error']) == (400, 'Cannot identify image file')
+
+    truncated = create_photo_like_jpeg((200, 150))[:2000]
+    data = {'file': (io.BytesIO(truncated), 'test.jpg'), 'resize_option': 'none'}
+    response = client.post('/jobs', data=data, content_type='multipart/form-data')
+    assert (response.status_code, response.get_json()['error']) == (400, 'Cannot identify image file')
+
+    data = {'file': (io.BytesIO(corrupt_png()), 'test.png'), 'resize_option': 'none'}
+    job = client.post('/jobs', data=data, content_type='multipart/form-data').get_json()
+    status = wait_for_job(client, job['status_url'])
+    assert status['status'] == 'failed'
+    assert client.get(job['result_url']).status_code == 422
+
+def test_job_not_ready_and_unknown(client, job_spool):
+    meta = job_spool.create('test.png', {'format': 'PNG'})
+    response = client.get(f"/jobs/{meta['id']}/result")
+    assert response.status_code == 409
+    assert 'Retry-After' in response.headers
+    assert client.get('/jobs/' + '0' * 32).status_code == 404
+
+def test_job_bad_request(client, job_spool):
+    response = client.post('/jobs', data={}, content_type='multipart/form-data')
+    assert response.status_code == 400
+
+# --- Image store ---
+@pytest.fixture
+def image_store(tmp_path, monkeypatch):
+    import app as app_module
+    from store import ImageStore
+    store = ImageStore(str(tmp_path), max_decoded_bytes=1024 * 1024)
+    monkeypatch.setattr(app_module, 'image_store', store)
+    return store
+
+def test_image_store_upload_and_render(client, image_store):
+    response = client.post('/images', data={'file': (create_sample_image(), 'test.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 201
+    stored = response.get_json()
+    assert (stored['width'], stored['height'], stored['format']) == (10, 10, 'PNG')
+    again = client.post('/images', data={'file': (create_sample_image(), 'again.png')},
+                        content_type='multipart/form-data')
+    assert again.status_code == 200
+    assert again.get_json()['id'] == stored['id']
+
+    response = client.get(stored['render_url'] + '?w=5&grayscale=1&format=PNG')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert 'immutable' in response.headers['Cache-Control']
+    img = Image.open(io.BytesIO(response.data))
+    assert (img.size, img.mode) == ((5, 5), 'L')
+
+    response = client.get(stored['render_url'] + '?percent=50&format=JPEG')
+    assert Image.open(io.BytesIO(response.data)).size == (5, 5)
+    response = client.get(stored['render_url'])
+    assert Image.open(io.BytesIO(response.data)).size == (10, 10)
+    assert image_store.stats()['decode_misses'] == 1
+
+    response = client.get(stored['render_url'] + '?encoding=fast', headers={'Accept': 'image/webp'})
+    assert response.mimetype == 'image/webp'
+    assert 'Accept' in response.headers['Vary']
+
+def test_image_store_conditional_render(client, image_store):
+    stored = client.post('/images', data={'file': (create_sample_image(), 'test.png')},
+                         content_type='multipart/form-data').get_json()
+    first = client.get(stored['render_url'] + '?w=3')
+    response = client.get(stored['render_url'] + '?w=3', headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == first.headers['ETag']
+
+def test_image_store_range_render(client, image_store):
+    stored = client.post('/images', data={'file': (create_sample_image(), 'test.png')},
+                         content_type='multipart/form-data').get_json()
+    full = client.get(stored['render_url'] + '?format=PNG')
+    assert full.headers['Accept-Ranges'] == 'bytes'
+    response = client.get(stored['render_url'] + '?format=PNG', headers={'Range': 'bytes=8-'})
+    assert response.status_code == 206
+    assert response.data == full.data[8:]
+    assert 'immutable' in response.headers['Cache-Control']
+
+def test_image_store_errors(client, image_store):
+    response = client.post('/images', data={'file': (io.BytesIO(b'junk'), 'test.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert client.get('/images/' + '0' * 64 + '/render').status_code == 404
+    stored = client.post('/images', data={'file': (create_sample_image(), 'test.png')},
+                         content_type='multipart/form-data').get_json()
+    assert client.get(stored['render_url'] + '?w=0').status_code == 400
+
+def test_image_store_render_filters(client, image_store):
+    stored = client.post('/images', data={'file': (create_sample_image(), 'test.png')},
+                         content_type='multipart/form-data').get_json()
+    response = client.get(stored['render_url'] + '?format=PNG&filters=invert')
+    assert Image.open(io.BytesIO(response.data)).getpixel((0, 0)) == (0, 255, 255)
+    same = client.get(stored['render_url'] + '?format=PNG&filters=Invert,brightness:1')
+    assert same.headers['ETag'] == response.headers['ETag']  # same signature, same key
+    response = client.get(stored['render_url'] + '?filters=blur')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Unknown filter: blur'
+
+def test_image_store_render_shares_pixels_with_workers(client, image_store, tmp_path, monkeypatch):
+    """Workers map the decoded original from SHARED_PIXELS_DIR, written once per image."""
+    import app as app_module
+    from sharedimage import SharedPixels
+    from workers import WorkerPool
+    pixels = SharedPixels(str(tmp_path / 'pixels'), 1 << 20)
+    monkeypatch.setattr(app_module, 'shared_pixels', pixels)
+    stored = client.post('/images', data={'file': (create_sample_image(), 'test.png')},
+                         content_type='multipart/form-data').get_json()
+    result_cache.clear()
+    response = client.get(stored['render_url'] + '?w=5&sepia=1&format=PNG')
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.data)).size == (5, 5)
+    response = client.get(stored['render_url'] + '?w=4&format=JPEG')
+    assert Image.open(io.BytesIO(response.data)).size == (4, 4)
+    stats = client.get('/images/stats').get_json()
+    assert (stats['share_misses'], stats['share_hits'], stats['shared_entries']) == (1, 1, 1)
+    assert len(os.listdir(pixels.directory)) == 1
+
+    pool = WorkerPool(1, max_queue=0)
+    monkeypatch.setattr(app_module, 'worker_pool', pool)
+    try:
+        pool.submit(time.sleep, 0.5)
+        response = client.get(stored['render_url'] + '?w=3')
+        assert response.status_code == 503
+        assert pixels.stats()['share_hits'] == 2 and len(os.listdir(pixels.directory)) == 1
+    finally:
+        pool.shutdown()
+    pixels.close()
+    assert os.listdir(pixels.directory) == []
+
+# --- Upload limits ---
+def test_upload_too_large(client, image_store, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 100)
+    response = client.post('/images', data={'file': (create_sample_image(), 'test.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 413
+    assert 'limit is 100 bytes' in response.get_json()['error']
+    response = client.post('/process', data={'file': (create_sample_image(), 'test.png')},
+                           content_type='multipart/form-data', follow_redirects=True)
+    assert b'Upload too large' in response.data
+
+def test_truncated_upload_is_refused(client, image_store):
+    """A body cut short behind a valid header is a 400, like any unreadable file."""
+    img = Image.effect_noise((64, 64), 50).convert('RGB')
+    out = io.BytesIO()
+    img.save(out, format='PNG')
+    truncated = out.getvalue()[:-200]
+    response = client.post('/images', data={'file': (io.BytesIO(truncated), 'test.png')},
+                           content_type='multipart/form-data')
+    assert (response.status_code, response.get_json()['error']) == (400, 'Cannot identify image file')
+    response = client.post('/process/variants', data={'file': (io.BytesIO(truncated), 'test.png'),
+                                                      'widths': '10'},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    response = client.post('/process', data={'file': (io.BytesIO(truncated), 'test.png')},
+                           content_type='multipart/form-data', follow_redirects=True)
+    assert b'Cannot identify image file' in response.data
+
+def test_upload_pixel_budget_and_format(client, image_store, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_IMAGE_PIXELS', 99)
+    response = client.post('/images', data={'file': (create_sample_image(), 'test.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 413 # 10x10 > 99 pixels, refused from the header
+    response = client.post('/process', data={'file': (create_sample_image(), 'test.png')},
+                           content_type='multipart/form-data', follow_redirects=True)
+    assert b'Image is too large (10x10)' in response.data
+
+    bmp = io.BytesIO()
+    Image.new('RGB', (4, 4)).save(bmp, format='BMP')
+    bmp.seek(0)
+    response = client.post('/images', data={'file': (bmp, 'disguised.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 415
+
+def test_upload_spooled_to_disk(client, monkeypatch, tmp_path):
+    """Spooled uploads reach workers as paths and are never read whole by the app."""
+    import app as app_module
+    from workers import WorkerPool
+    monkeypatch.setitem(app.config, 'UPLOAD_SPOOL_BYTES', 16) # every upload goes to a file
+    monkeypatch.setitem(app.config, 'UPLOAD_SPOOL_DIR', str(tmp_path))
+    real_render = app_module.render_image_timed
+    sources = []
+
+    def recording_render(source, *args, **kwargs):
+        sources.append(source)
+        return real_render(source, *args, **kwargs)
+    monkeypatch.setattr(app_module, 'worker_pool', WorkerPool(0, max_queue=8))  # in-thread
+    monkeypatch.setattr(app_module, 'render_image_timed', recording_render)
+    result_cache.clear()
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '5', 'format': 'PNG'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.data)).size == (5, 5)
+    assert len(sources) == 1 and os.path.dirname(sources[0]) == str(tmp_path)
+    assert os.listdir(tmp_path) == []  # removed with the request
+
+def test_batch_and_jobs_keep_spooled_uploads(client, job_spool, monkeypatch, tmp_path):
+    spool_dir = tmp_path / 'uploads'
+    spool_dir.mkdir()
+    monkeypatch.setitem(app.config, 'UPLOAD_SPOOL_BYTES', 16)
+    monkeypatch.setitem(app.config, 'UPLOAD_SPOOL_DIR', str(spool_dir))
+    data = {'files': [(create_sample_image(), 'a.png'), (create_sample_image(), 'b.png')],
+            'resize_option': 'width', 'width': '4', 'format': 'PNG'}
+    response = client.post('/process/batch', data=data, content_type='multipart/form-data')
+    archive = read_zip(response.data)
+    response.close()
+    assert Image.open(io.BytesIO(archive.read('0001_b.png'))).size == (4, 4)
+    assert os.listdir(spool_dir) == []
+
+    data = {'file': (create_sample_image(), 'test.png'), 'resize_option': 'width', 'width': '3', 'format': 'PNG'}
+    job = client.post('/jobs', data=data, content_type='multipart/form-data').get_json()
+    assert wait_for_job(client, job['status_url'])['status'] == 'done'
+    assert Image.open(io.BytesIO(client.get(job['result_url']).data)).size == (3, 3)
+    assert not os.path.exists(job_spool.input_path(job['id']))
+    assert os.listdir(spool_dir) == []
+
+# --- Animated GIFs ---
+def create_animated_gif(frames=5, size=(40, 30)):
+    images = []
+    for i in range(frames):
+        img = Image.new('RGB', size, (30, 60, 200))
+        img.paste((220, 40, 40), (i * 5, 5, i * 5 + 10, 15))
+        images.append(img)
+    out = io.BytesIO()
+    images[0].save(out, format='GIF', save_all=True, append_images=images[1:],
+                   duration=[100, 120, 140, 160, 180][:frames], loop=0)
+    out.seek(0)
+    return out
+
+def test_process_animated_gif_keeps_frames(client):
+    result_cache.clear()
+    data = {'file': (create_animated_gif(), 'anim.gif'), 'resize_option': 'width', 'width': '20',
+            'sepia': 'on', 'format': 'GIF'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    img = Image.open(io.BytesIO(response.data))
+    assert (img.n_frames, img.size, img.info['loop']) == (5, (20, 15), 0)
+    durations = []
+    for index in range(img.n_frames):
+        img.seek(index)
+        durations.append(img.info['duration'])
+    assert durations == [100, 120, 140, 160, 180]
+
+    data = {'file': (create_animated_gif(), 'anim.gif'), 'resize_option': 'none', 'format': 'PNG'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert getattr(Image.open(io.BytesIO(response.data)), 'n_frames', 1) == 1  # first frame only
+
+def test_animation_budget(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_ANIMATION_PIXELS', 4 * 40 * 30)
+    data = {'file': (create_animated_gif(), 'anim.gif'), 'resize_option': 'none', 'format': 'GIF'}
+    response = client.post('/process', data=data, content_type='multipart/form-data',
+                           follow_redirects=True)
+    assert b'Animation is too large (5 frames of 40x30)' in response.data
+
+def test_stored_animated_gif_keeps_frames(client, image_store, monkeypatch):
+    stored = client.post('/images', data={'file': (create_animated_gif(), 'anim.gif')},
+                         content_type='multipart/form-data').get_json()
+    result_cache.clear()
+    response = client.get(stored['render_url'] + '?w=20&format=GIF')
+    assert response.status_code == 200
+    img = Image.open(io.BytesIO(response.data))
+    assert (img.n_frames, img.size) == (5, (20, 15))
+    response = client.get(stored['render_url'] + '?format=PNG')
+    assert getattr(Image.open(io.BytesIO(response.data)), 'n_frames', 1) == 1
+
+    result_cache.clear()
+    monkeypatch.setitem(app.config, 'MAX_ANIMATION_PIXELS', 4 * 40 * 30)  # lowered since upload
+    response = client.get(stored['render_url'] + '?w=10&format=GIF')
+    assert response.status_code == 413
+    assert response.get_json()['error'].startswith('Animation is too large (5 frames of 40x30)')
+
+def test_variants_animated_gif_keep_frames(client):
+    import zipfile
+    data = {'file': (create_animated_gif(), 'anim.gif'), 'widths': '10,20', 'format': 'GIF'}
+    response = client.post('/process/variants', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    frames = {}
+    for name in archive.namelist():
+        img = Image.open(io.BytesIO(archive.read(name)))
+        frames[name] = (img.n_frames, img.size)
+    assert frames == {'anim_20w.gif': (5, (20, 15)), 'anim_10w.gif': (5, (10, 7))}
+
+# --- Responsive variants ---
+@pytest.mark.parametrize("grayscale, sepia", [(False, False), (True, False), (False, True), (True, True)])
+def test_build_variants_within_tolerance(grayscale, sepia):
+    data = create_photo_like_jpeg()
+    widths = [1500, 600, 400, 300, 150, 64]
+    variants = build_variants(Image.open(io.BytesIO(data)), widths + [300], grayscale, sepia)
+    assert [w for w, _ in variants] == widths # deduplicated, largest first
+    for width, variant in variants:
+        independent = process_image_data(Image.open(io.BytesIO(data)), 'width', width, 100, grayscale, sepia)
+        assert (variant.size, variant.mode) == (independent.size, independent.mode)
+        assert mean_abs_diff(variant, independent) <= VARIANT_TOLERANCE
+
+def test_process_variants_zip(client):
+    data = {'file': (create_sample_image(), 'photo.png'), 'widths': '8, 4,2', 'format': 'PNG', 'grayscale': 'true'}
+    response = client.post('/process/variants', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    archive = read_zip(response.data)
+    assert archive.namelist() == ['photo_8w.png', 'photo_4w.png', 'photo_2w.png']
+    img = Image.open(io.BytesIO(archive.read('photo_2w.png')))
+    assert (img.size, img.mode) == ((2, 2), 'L')
+
+@pytest.mark.parametrize('name, disposition', [
+    ('фото.png', "attachment; filename=_variants.zip; filename*=UTF-8''%D1%84%D0%BE%D1%82%D0%BE_variants.zip"),
+    ('my photo; v2.png', 'attachment; filename="my photo; v2_variants.zip"'),
+])
+def test_process_variants_download_name(client, name, disposition):
+    data = {'file': (create_sample_image(), name), 'widths': '4', 'format': 'PNG'}
+    response = client.post('/process/variants', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'] == disposition
+    disposition.encode('latin-1')
+
+def test_process_variants_filters(client):
+    data = {'file': (create_sample_image(), 'photo.png'), 'widths': '8,4', 'format': 'PNG',
+            'filters': 'tint:0000ff:1'}
+    response = client.post('/process/variants', data=data, content_type='multipart/form-data')
+    img = Image.open(io.BytesIO(read_zip(response.data).read('photo_8w.png')))
+    assert img.getpixel((0, 0))[:2] == (0, 0)
+    data.update(file=(create_sample_image(), 'photo.png'), filters='gamma:99')
+    response = client.post('/process/variants', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+
+def test_process_filters_palette_gif(client):
+    source = io.BytesIO()
+    Image.new('RGB', (10, 10), (200, 120, 40)).convert('P').save(source, format='GIF')
+    source.seek(0)
+    data = {'file': (source, 'palette.gif'), 'resize_option': 'none', 'filters': 'contrast:2',
+            'format': 'PNG'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    img = Image.open(io.BytesIO(response.data))
+    assert img.mode == 'RGB' and img.getpixel((0, 0))[0] > 200  # not all black
+
+def test_process_variants_multipart(client):
+    data = {'file': (create_sample_image(), 'photo.png'), 'widths': '6,3', 'format': 'PNG'}
+    response = client.post('/process/variants', data=data, content_type='multipart/form-data',
+                           headers={'Accept': 'multipart/mixed'})
+    assert response.status_code == 200
+    assert response.mimetype == 'multipart/mixed'
+    boundary = response.mimetype_params['boundary'].encode()
+    parts = response.data.split(b'--' + boundary)[1:-1]
+    assert len(parts) == 2
+    headers, body = parts[1].split(b'\r\n\r\n', 1)
+    assert b'filename="photo_3w.png"' in headers
+    assert Image.open(io.BytesIO(body[:-2])).size == (3, 3)
+
+@pytest.mark.parametrize("widths", ['', 'abc', '0,100', ','.join(str(w) for w in range(1, 20))])
+def test_process_variants_bad_widths(client, widths):
+    data = {'file': (create_sample_image(), 'photo.png'), 'widths': widths}
+    response = client.post('/process/variants', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+
+# --- Metrics ---
+def test_process_server_timing_and_metrics(client):
+    data = {'file': (create_sample_image(), 'timed.png'), 'resize_option': 'width', 'width': '7', 'format': 'PNG'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    stages = [part.split(';')[0] for part in response.headers['Server-Timing'].split(', ')]
+    for stage in ('upload', 'cache', 'open', 'decode', 'resize', 'encode', 'send_file', 'total'):
+        assert stage in stages
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE imageprocessor_stage_seconds histogram' in text
+    assert 'imageprocessor_stage_seconds_count{stage="resize"}' in text
+    assert 'imageprocessor_requests_total{cache="miss"}' in text
+    assert 'imageprocessor_pixels_processed_total ' in text
+    assert 'imageprocessor_bytes_out_total ' in text
+
+def test_metrics_disabled(client, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module.metrics, 'enabled', False)
+    data = {'file': (create_sample_image(), 'untimed.png'), 'resize_option': 'width', 'width': '6', 'format': 'PNG'}
+    response = client.post('/process', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert 'Server-Timing' not in response.headers
+    assert client.get('/metrics').status_code == 404
+
+# --- Profiling ---
+@pytest.fixture
+def profile_store(tmp_path, monkeypatch):
+    import app as app_module
+    from profiling import ProfileStore
+    store = ProfileStore(str(tmp_path), max_dumps=5)
+    monkeypatch.setattr(app_module, 'profile_store', store)
+    monkeypatch.setitem(app.config, 'PROFILE_SECRET', 's3cret')
+    monkeypatch.setitem(app.config, 'PROFILE_SAMPLE_RATE', 0.0)
+    return store
+
+def test_profile_on_request(client, profile_store):
+    data = {'file': (create_sample_image(), 'prof.png'), 'resize_option': 'width', 'width': '3', 'sepia': 'on', 'format': 'PNG'}
+    response = client.post('/process', data=data, content_type='multipart/form-data', headers={'X-Profile': 's3cret'})
+    assert response.status_code == 200
+
+    listing = client.get('/admin/profiles', headers={'X-Profile': 's3cret'}).get_json()['profiles']
+    assert len(listing) == 1
+    dump = listing[0]
+    assert (dump['width'], dump['height'], dump['mode'], dump['format']) == (10, 10, 'RGB', 'PNG')
+    assert dump['options']['sepia'] is True and dump['trigger'] == 'header'
+    assert 'sepia' in dump['stages_ms'] and dump['hottest']
+
+    download = client.get(f"/admin/profiles/{dump['id']}", headers={'X-Profile': 's3cret'})
+    assert download.status_code == 200
+    assert download.headers['Content-Disposition'].endswith('.prof')
+
+def test_profile_sampling_respects_threshold(client, profile_store, monkeypatch):
+    monkeypatch.setitem(app.config, 'PROFILE_SAMPLE_RATE', 1.0)
+    monkeypatch.setitem(app.config, 'PROFILE_THRESHOLD_MS', 60_000)
+    data = {'file': (create_sample_image(), 'fast.png'), 'resize_option': 'width', 'width': '2', 'format': 'PNG'}
+    assert client.post('/process', data=data, content_type='multipart/form-data').status_code == 200
+    assert profile_store.list() == []
+
+def test_profile_admin_access(client, profile_store, monkeypatch):
+    assert client.get('/admin/profiles').status_code == 403
+    assert client.get('/admin/profiles', headers={'X-Profile': 'nope'}).status_code == 403
+    assert client.get('/admin/profiles/20240101T000000-deadbeef', headers={'X-Profile': 's3cret'}).status_code == 404
+    monkeypatch.setitem(app.config, 'PROFILE_SECRET', None)
+    assert client.get('/admin/profiles', headers={'X-Profile': 's3cret'}).status_code == 404
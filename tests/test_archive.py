@@ -0,0 +1,22 @@
+import io
+import zipfile
+
+from archive import stream_zip
+
+
+def test_stream_zip_yields_per_member():
+    entries = [('a.bin', b'a' * 100), ('b.bin', b'b' * 50)]
+    chunks = list(stream_zip(iter(entries)))
+    assert len(chunks) == 3 # one per member, then the central directory
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+    assert archive.testzip() is None
+    assert archive.read('a.bin') == b'a' * 100
+    assert archive.read('b.bin') == b'b' * 50
+
+
+def test_stream_zip_is_lazy():
+    def entries():
+        yield 'first', b'1'
+        raise AssertionError('consumed too eagerly')
+
+    assert next(stream_zip(entries()))
@@ -0,0 +1,189 @@
+import asyncio
+import io
+import threading
+
+from PIL import Image
+from werkzeug.test import EnvironBuilder
+
+import asgi
+from app import app, result_cache
+from asgi import AsgiApp
+
+
+def png_bytes(size=(10, 10)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def http_scope(method, path, headers=(), query=b''):
+    return {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path, 'root_path': '',
+        'query_string': query, 'headers': [(k.lower().encode(), v.encode()) for k, v in headers],
+        'client': ('127.0.0.1', 50000), 'server': ('127.0.0.1', 8000),
+    }
+
+
+async def call(application, method, path, body=b'', headers=(), chunk=1024, pause=0.0,
+               disconnect_after=None):
+    """Send one request through *application*; return ``(status, headers, body)``.
+
+    The body arrives in *chunk*-byte messages, *pause* seconds apart; with
+    *disconnect_after*, the client goes away after that many.
+    """
+    pieces = [body[i:i + chunk] for i in range(0, len(body), chunk)] or [b'']
+    if disconnect_after is not None:
+        pieces = pieces[:disconnect_after] + [None]
+    sent = []
+
+    async def receive():
+        if pause:
+            await asyncio.sleep(pause)
+        piece = pieces.pop(0)
+        if piece is None:
+            return {'type': 'http.disconnect'}
+        return {'type': 'http.request', 'body': piece, 'more_body': bool(pieces)}
+
+    async def send(message):
+        sent.append(message)
+
+    await application(http_scope(method, path, headers), receive, send)
+    if not sent:
+        return None
+    start, *bodies = sent
+    assert bodies[-1]['more_body'] is False
+    return (start['status'], {k.decode(): v.decode() for k, v in start['headers']},
+            b''.join(m['body'] for m in bodies))
+
+
+def form_request(fields):
+    environ = EnvironBuilder(method='POST', data=fields).get_environ()
+    data = environ['wsgi.input'].read()
+    return data, (('Content-Type', environ['CONTENT_TYPE']), ('Content-Length', str(len(data))))
+
+
+def wrap(wsgi_app=app, threads=2, max_body=lambda: None):
+    return AsgiApp(wsgi_app, threads, spool_bytes=1024, max_body=max_body)
+
+
+# --- Tests ---
+def test_process_matches_wsgi():
+    app.config['TESTING'] = True
+    fields = {'file': (io.BytesIO(png_bytes()), 'test.png'), 'resize_option': 'width',
+              'width': '5', 'grayscale': 'on', 'format': 'PNG'}
+    result_cache.clear()
+    expected = app.test_client().post('/process', data=dict(fields, file=(io.BytesIO(png_bytes()), 'test.png')))
+    data, headers = form_request(dict(fields, file=(io.BytesIO(png_bytes()), 'test.png')))
+    result_cache.clear()
+    status, got, body = asyncio.run(call(wrap(), 'POST', '/process', data, headers))
+    assert status == 200
+    assert body == expected.data
+    assert got['content-type'] == expected.headers['Content-Type'] == 'image/png'
+    assert got['etag'] == expected.headers['ETag'] and got['x-cache'] == 'MISS'
+    assert Image.open(io.BytesIO(body)).size == (5, 5)
+
+
+def test_slow_upload_holds_no_thread():
+    calls = []
+
+    def wsgi_app(environ, start_response):
+        calls.append((environ['PATH_INFO'], environ['wsgi.input'].read()))
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'].encode()]
+
+    application = wrap(wsgi_app, threads=1)
+
+    async def run():
+        slow = asyncio.create_task(
+            call(application, 'POST', '/slow', b'x' * 2000, chunk=100, pause=0.02))
+        fast = await call(application, 'GET', '/fast')
+        assert not slow.done()  # still uploading; the only thread was free
+        return fast, await slow
+
+    fast, slow = asyncio.run(run())
+    assert fast == (200, {'content-type': 'text/plain'}, b'/fast')
+    assert slow[2] == b'/slow'
+    assert calls == [('/fast', b''), ('/slow', b'x' * 2000)]  # dispatched once complete
+
+
+def test_chunked_upload_gets_its_length():
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [])
+        return [environ['CONTENT_LENGTH'].encode()]
+
+    # No Content-Length header: the body's length is only known once received.
+    assert asyncio.run(call(wrap(wsgi_app), 'POST', '/', b'y' * 3000))[2] == b'3000'
+
+
+def test_body_over_limit_is_refused_unread(monkeypatch):
+    app.config['TESTING'] = True
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 100)
+    application = wrap(max_body=lambda: app.config['MAX_CONTENT_LENGTH'])
+    data, headers = form_request({'file': (io.BytesIO(png_bytes()), 'test.png')})
+    for sent_headers in (headers, headers[:1]):  # declared, and chunked
+        status, got, _ = asyncio.run(call(application, 'POST', '/process', data, sent_headers))
+        assert status == 302 and got['location'] == '/'  # flashed, as under WSGI
+    status, _, body = asyncio.run(call(application, 'POST', '/process/batch', data, headers))
+    assert status == 413 and b'Upload too large' in body
+
+
+def test_disconnect_during_upload_skips_the_app():
+    calls = []
+    application = wrap(lambda environ, start_response: calls.append(environ) or [])
+    assert asyncio.run(call(application, 'POST', '/', b'z' * 500, chunk=100, disconnect_after=3)) is None
+    assert calls == []
+
+
+def test_generated_body_is_sent_in_pieces_and_closed():
+    closed = threading.Event()
+
+    class Body:
+        def __iter__(self):
+            yield b'a' * (asgi.CHUNK_SIZE + 10)
+            yield b'b'
+
+        def close(self):
+            closed.set()
+
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [('X-Test', 'yes')])
+        return Body()
+
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(wrap(wsgi_app)(http_scope('GET', '/'), receive, send))
+    assert sent[0]['headers'] == [(b'x-test', b'yes')]
+    assert [len(m['body']) for m in sent[1:]] == [asgi.CHUNK_SIZE, 10, 1, 0]
+    assert closed.is_set()
+
+
+def test_write_callable_output_comes_first():
+    def wsgi_app(environ, start_response):
+        write = start_response('200 OK', [])
+        write(b'head ')
+        write(b'more ')
+        return [b'tail']
+
+    status, _, body = asyncio.run(call(wrap(wsgi_app), 'GET', '/'))
+    assert (status, body) == (200, b'head more tail')
+
+
+def test_lifespan():
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(wrap()({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
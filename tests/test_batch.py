@@ -0,0 +1,128 @@
+import io
+import os
+import sqlite3
+
+import pytest
+from PIL import Image
+
+from app import normalize_options
+from batch import MANIFEST_NAME, Progress, input_bases, iter_images, main, run_batch
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """An input tree: three images over two levels, plus files to ignore."""
+    root = tmp_path / 'in'
+    (root / 'sub').mkdir(parents=True)
+    Image.new('RGB', (40, 30), 'red').save(root / 'a.jpg')
+    Image.new('RGB', (20, 20), 'blue').save(root / 'sub' / 'b.png')
+    Image.new('RGB', (10, 10), 'green').save(root / 'sub' / 'c.GIF')
+    (root / 'notes.txt').write_text('not an image')
+    (root / '.hidden.jpg').write_bytes(b'')
+    return root
+
+
+def outputs(directory):
+    return sorted(os.path.relpath(os.path.join(d, f), directory)
+                  for d, _, files in os.walk(directory) for f in files if f != MANIFEST_NAME)
+
+
+def quiet():
+    return Progress(out=io.StringIO(), interval=0)
+
+
+# --- Tests ---
+def test_iter_images_is_lazy_and_filters(tree, tmp_path):
+    found = iter_images(str(tree))
+    assert next(found)[0].endswith(('a.jpg', 'b.png', 'c.GIF'))
+    names = sorted(os.path.basename(path) for path, _ in iter_images(str(tree)))
+    assert names == ['a.jpg', 'b.png', 'c.GIF']
+    assert [p for p, _ in iter_images(str(tree), exclude=str(tree / 'sub'))] == [str(tree / 'a.jpg')]
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_run_batch_processes_tree(tree, tmp_path, workers):
+    out = tmp_path / 'out'
+    options = normalize_options('width', 10, 100, True, False, 'PNG')
+    progress = run_batch([str(tree)], str(out), options, workers, progress=quiet())
+    assert (progress.done, progress.failed, progress.skipped) == (3, 0, 0)
+    assert outputs(out) == ['a.png', 'sub/b.png', 'sub/c.png']
+    img = Image.open(out / 'a.png')
+    assert (img.size, img.mode) == ((10, 7), 'L')
+    assert progress.pixels == 40 * 30 + 20 * 20 + 10 * 10
+
+
+def test_run_batch_resumes_from_manifest(tree, tmp_path):
+    out = tmp_path / 'out'
+    options = normalize_options('percent', None, 50, False, False, 'JPEG')
+    run_batch([str(tree)], str(out), options, 0, progress=quiet())
+    again = run_batch([str(tree)], str(out), options, 0, progress=quiet())
+    assert (again.done, again.skipped) == (0, 3)
+
+    Image.new('RGB', (40, 30), 'white').save(tree / 'a.jpg')  # changed since
+    os.utime(tree / 'a.jpg', ns=(0, 0))
+    again = run_batch([str(tree)], str(out), options, 0, progress=quiet())
+    assert (again.done, again.skipped) == (1, 2)
+
+    other = normalize_options('percent', None, 25, False, False, 'JPEG')  # new options redo all
+    assert run_batch([str(tree)], str(out), other, 0, progress=quiet()).done == 3
+    forced = run_batch([str(tree)], str(out), other, 0, force=True, progress=quiet())
+    assert (forced.done, forced.skipped) == (3, 0)
+
+
+def test_run_batch_keeps_inputs_with_the_same_names_apart(tmp_path):
+    for root, color in (('a', 'red'), ('b', 'blue')):
+        (tmp_path / root).mkdir()
+        Image.new('RGB', (8, 8), color).save(tmp_path / root / 'x.png')
+    out = tmp_path / 'out'
+    inputs = [str(tmp_path / 'a') + os.sep, str(tmp_path / 'b')]
+    options = normalize_options('none', None, 100, False, False, 'PNG')
+    assert run_batch(inputs, str(out), options, 0, progress=quiet()).done == 2
+    assert outputs(out) == ['a/x.png', 'b/x.png']
+    assert Image.open(out / 'b' / 'x.png').getpixel((0, 0)) == (0, 0, 255)
+    again = run_batch(inputs, str(out), options, 0, progress=quiet())
+    assert (again.done, again.skipped) == (0, 2)
+
+
+def test_input_bases_refuses_clashing_inputs(tmp_path):
+    for path in ('x/photos', 'y/photos', 'z'):
+        (tmp_path / path).mkdir(parents=True)
+    (tmp_path / 'z' / 'a.png').write_bytes(b'')
+    (tmp_path / 'z' / 'b.png').write_bytes(b'')
+    z = str(tmp_path / 'z')
+    files = [z + '/a.png', z + '/b.png']
+    assert input_bases(files) == [(path, str(tmp_path)) for path in files]
+    with pytest.raises(ValueError, match='would both write to photos'):
+        input_bases([str(tmp_path / 'x/photos'), str(tmp_path / 'y/photos')])
+    with pytest.raises(ValueError, match='would both write to z'):
+        input_bases([z + '/a.png', z])
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / 'x/photos'), str(tmp_path / 'y/photos'), '-o', str(tmp_path / 'out')])
+    assert not (tmp_path / 'out').exists()
+
+
+def test_run_batch_records_and_retries_failures(tree, tmp_path):
+    (tree / 'broken.png').write_bytes(b'\x89PNG\r\n\x1a\ntruncated')
+    out = tmp_path / 'out'
+    errors = io.StringIO()
+    options = normalize_options('none', None, 100, False, False, 'JPEG')
+    progress = run_batch([str(tree)], str(out), options, 0, progress=quiet(), errors=errors)
+    assert (progress.done, progress.failed) == (3, 1)
+    assert 'broken.png: Cannot identify image file' in errors.getvalue()
+    assert not any(name.startswith('.tmp-') for name in os.listdir(out))
+    with sqlite3.connect(out / MANIFEST_NAME) as db:
+        assert db.execute("SELECT status FROM files WHERE name = 'broken.png'").fetchone() == ('failed',)
+    again = run_batch([str(tree)], str(out), options, 0, progress=quiet(), errors=io.StringIO())
+    assert (again.skipped, again.failed) == (3, 1)
+
+
+def test_main(tree, tmp_path, capsys):
+    out = tmp_path / 'out'
+    assert main([str(tree / 'a.jpg'), '-o', str(out), '--width', '8', '--format', 'webp',
+                 '--workers', '0', '--progress', '0']) == 0
+    assert outputs(out) == ['a.webp']
+    assert '1 done, 0 skipped, 0 failed' in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tree), '-o', str(out), '--width', '0'])
+    with pytest.raises(SystemExit):
+        main([str(tree), '-o', str(out), '--filters', 'blur'])
@@ -0,0 +1,61 @@
+import os
+
+from cache import ResultCache, make_key
+
+
+def test_make_key_depends_on_data_and_options():
+    opts = {'format': 'PNG', 'grayscale': False}
+    assert make_key(b'abc', opts) == make_key(b'abc', dict(reversed(list(opts.items()))))
+    assert make_key(b'abc', opts) != make_key(b'abd', opts)
+    assert make_key(b'abc', opts) != make_key(b'abc', {**opts, 'grayscale': True})
+
+
+def test_make_key_hashes_streams_in_chunks(monkeypatch):
+    import io
+    import cache
+    monkeypatch.setattr(cache, 'HASH_CHUNK_BYTES', 2)
+    stream = io.BytesIO(b'abcde')
+    stream.seek(3)
+    assert make_key(stream, {}) == make_key(b'abcde', {})
+    assert stream.tell() == 3
+
+
+def test_memory_lru_evicts_by_bytes():
+    cache = ResultCache(max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234' # 'a' is now most recent
+    cache.put('c', b'1234') # 12 bytes > 10: evict least recent ('b')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.get('c') == b'1234'
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 3 and stats['misses'] == 1
+    assert stats['bytes'] == 8
+
+
+def test_oversized_entry_not_cached():
+    cache = ResultCache(max_bytes=4)
+    cache.put('a', b'12345')
+    assert cache.get('a') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_disk_tier_shared_between_instances(tmp_path):
+    writer = ResultCache(max_bytes=1024, disk_dir=str(tmp_path))
+    reader = ResultCache(max_bytes=1024, disk_dir=str(tmp_path))
+    writer.put('k', b'payload')
+    assert reader.get('k') == b'payload'
+    assert reader.stats()['disk_hits'] == 1
+    assert reader.get('k') == b'payload' # promoted to memory
+    assert reader.stats()['disk_hits'] == 1
+
+
+def test_disk_tier_prunes_least_recently_used(tmp_path):
+    cache = ResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=25)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.put(key, b'x' * 10)
+        os.utime(tmp_path / key, (i, i)) # deterministic access order
+    assert sorted(os.listdir(tmp_path)) == ['b', 'c']
+    assert cache.stats()['disk_evictions'] == 1
@@ -0,0 +1,176 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+import coalesce
+from coalesce import Coalescer
+
+
+def run_together(calls):
+    """Start every call in *calls* at once; return their results (or errors)."""
+    results = [None] * len(calls)
+    barrier = threading.Barrier(len(calls))
+
+    def run(i, call):
+        barrier.wait()
+        try:
+            results[i] = call()
+        except Exception as exc:
+            results[i] = exc
+
+    threads = [threading.Thread(target=run, args=(i, call)) for i, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def slow(result, seconds=0.2, calls=None):
+    def compute():
+        if calls is not None:
+            calls.append(result)
+        time.sleep(seconds)
+        return result
+    return compute
+
+
+# --- Tests ---
+def test_threads_share_one_computation():
+    coalescer = Coalescer(None, timeout=5)
+    calls = []
+    results = run_together([lambda: coalescer.run('k', slow(b'out', calls=calls))] * 5)
+    assert calls == [b'out']
+    assert sorted(shared for _, shared in results) == [False] + [True] * 4
+    assert {result for result, _ in results} == {b'out'}
+    stats = coalescer.stats()
+    assert stats['computed'] == 1 and stats['saved'] == stats['shared_threads'] == 4
+    assert stats['in_flight'] == 0
+
+
+def test_different_keys_and_later_calls_compute():
+    coalescer = Coalescer(None, timeout=5)
+    results = run_together([lambda: coalescer.run('a', slow(b'a')),
+                            lambda: coalescer.run('b', slow(b'b'))])
+    assert results == [(b'a', False), (b'b', False)]
+    assert coalescer.run('a', slow(b'again', 0)) == (b'again', False)  # no longer in flight
+    assert coalescer.stats()['computed'] == 3
+
+
+def test_leader_error_is_shared():
+    coalescer = Coalescer(None, timeout=5)
+    calls = []
+
+    def fail():
+        calls.append(1)
+        time.sleep(0.2)
+        raise ValueError('bad image')
+
+    results = run_together([lambda: coalescer.run('k', fail)] * 3)
+    assert len(calls) == 1
+    assert all(isinstance(r, ValueError) for r in results)
+    assert coalescer.run('k', slow(b'ok', 0)) == (b'ok', False)
+
+
+def test_duplicates_stop_waiting_after_timeout():
+    coalescer = Coalescer(None, timeout=0.05)
+    results = run_together([lambda: coalescer.run('k', slow(b'out', 0.3))] * 2)
+    assert results == [(b'out', False)] * 2
+    assert coalescer.stats()['timeouts'] == 1
+
+
+def test_streams_are_shared_until_ended():
+    coalescer = Coalescer(None, timeout=5)
+    calls = []
+    results = run_together([lambda: coalescer.stream('k', slow('spool', calls=calls))] * 3)
+    assert calls == ['spool']
+    assert sorted(results) == [('spool', False), ('spool', True), ('spool', True)]
+    assert coalescer.stream('k', slow('other', 0)) == ('spool', True)  # still being written
+    coalescer.end_stream('k')
+    assert coalescer.stream('k', slow('next', 0)) == ('next', False)
+    assert coalescer.stats()['in_flight'] == 1
+
+
+def test_failed_stream_start_is_not_shared():
+    coalescer = Coalescer(None, timeout=5)
+
+    def fail():
+        time.sleep(0.2)
+        raise ValueError('pool full')
+
+    results = run_together([lambda: coalescer.stream('k', fail),
+                            lambda: (time.sleep(0.05), coalescer.stream('k', slow('own', 0)))[1]])
+    assert isinstance(results[0], ValueError)
+    assert results[1] == ('own', False)  # started its own after the leader failed
+    assert coalescer.stats()['in_flight'] == 0
+
+
+def test_zero_timeout_disables():
+    coalescer = Coalescer(None, timeout=0)
+    calls = []
+    run_together([lambda: coalescer.run('k', slow(b'out', 0.1, calls))] * 3)
+    assert len(calls) == 3 and not coalescer.stats()['enabled']
+
+
+@pytest.mark.skipif(coalesce.fcntl is None, reason='needs fcntl')
+def test_processes_share_through_directory(tmp_path):
+    # flock locks taken through separate opens conflict even within one
+    # process, so two coalescers stand in for two worker processes.
+    first, second = Coalescer(str(tmp_path), timeout=5), Coalescer(str(tmp_path), timeout=5)
+    calls = []
+    results = run_together([lambda: first.run('k', slow(b'out', calls=calls)),
+                            lambda: second.run('k', slow(b'out', calls=calls))])
+    assert calls == [b'out']
+    assert sorted(results) == [(b'out', False), (b'out', True)]
+    assert first.stats()['shared_processes'] + second.stats()['shared_processes'] == 1
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('.tmp-')]
+    # The result file is for the waiters of that flight, not a cache.
+    assert second.run('k', slow(b'again', 0)) == (b'again', False)
+
+
+@pytest.mark.skipif(coalesce.fcntl is None, reason='needs fcntl')
+def test_failed_leader_process_leaves_no_result(tmp_path):
+    first, second = Coalescer(str(tmp_path), timeout=5), Coalescer(str(tmp_path), timeout=5)
+
+    def fail():
+        time.sleep(0.2)
+        raise ValueError('bad image')
+
+    results = run_together([lambda: first.run('k', fail),
+                            lambda: second.run('k', fail)])
+    assert all(isinstance(r, ValueError) for r in results)  # each computed itself
+    assert not os.path.exists(tmp_path / 'k')
+
+
+@pytest.mark.skipif(coalesce.fcntl is None, reason='needs fcntl')
+def test_forked_children_do_not_keep_locks(tmp_path):
+    # The image worker pool forks its workers lazily, i.e. during a render.
+    first, second = Coalescer(str(tmp_path), timeout=5), Coalescer(str(tmp_path), timeout=0.5)
+    children = []
+
+    def compute():
+        children.append(multiprocessing.get_context('fork').Process(target=time.sleep, args=(2,)))
+        children[0].start()
+        return b'out'
+
+    try:
+        assert first.run('k', compute) == (b'out', False)
+        assert second.run('k', slow(b'again', 0)) == (b'again', False)
+        assert second.stats()['timeouts'] == 0
+    finally:
+        children[0].terminate()
+        children[0].join()
+
+
+@pytest.mark.skipif(coalesce.fcntl is None, reason='needs fcntl')
+def test_old_files_are_pruned(tmp_path):
+    coalescer = Coalescer(str(tmp_path), timeout=5, linger=60)
+    for name in ('old', 'old.lock', 'old.wait'):
+        (tmp_path / name).write_bytes(b'x')
+        os.utime(tmp_path / name, (time.time() - 120,) * 2)
+    coalescer._last_prune = 0
+    coalescer.run('new', slow(b'out', 0))
+    assert os.listdir(tmp_path) == ['new.lock']
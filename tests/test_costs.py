@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from costs import ClientBudget, CostModel, RenderFeatures
+
+
+def features(source_format='JPEG', source_pixels=1_000_000, output_pixels=None, grayscale=False,
+             sepia=False, output_format='JPEG', decoded_pixels=None):
+    output_pixels = source_pixels if output_pixels is None else output_pixels
+    decoded_pixels = source_pixels if decoded_pixels is None else decoded_pixels
+    return RenderFeatures(source_format, source_pixels, decoded_pixels, output_pixels,
+                          output_pixels != source_pixels, grayscale, sepia, output_format)
+
+
+def test_estimate_orders_by_pixels_filters_and_format():
+    model = CostModel()
+    thumbnail = model.estimate(features(source_pixels=12_000_000, decoded_pixels=750_000, output_pixels=40_000))
+    full_jpeg = model.estimate(features(source_pixels=12_000_000))
+    sepia_png = model.estimate(features('PNG', 50_000_000, sepia=True, output_format='PNG'))
+    assert thumbnail < full_jpeg < sepia_png
+    assert 10 < sepia_png < 60 # tens of seconds for a 50 MP sepia PNG
+    assert model.estimate(features(sepia=True)) > model.estimate(features(grayscale=True))
+    lut = model.estimate(features()._replace(filters='lut'))
+    assert model.estimate(features()) < lut < model.estimate(features()._replace(filters='mixed'))
+
+
+def test_observe_calibrates_the_matching_stage():
+    model = CostModel()
+    f = features('PNG', 4_000_000, output_format='PNG')
+    before = model.estimate(f)
+    for _ in range(30): # this host encodes PNG 3x slower than the prior says
+        prior_encode = 550e-9 * 4_000_000
+        model.observe(f, {'open': 0.0, 'decode': 55e-9 * 4_000_000, 'encode': 3 * prior_encode})
+    assert model.estimate(f) == pytest.approx(before + 2 * prior_encode, rel=0.01)
+    assert model.stats()['scales']['encode:PNG:balanced:False'] == pytest.approx(3, rel=0.01)
+    # Other output formats are unaffected.
+    assert model.estimate(features(source_pixels=4_000_000)) == CostModel().estimate(features(source_pixels=4_000_000))
+
+
+def test_tiny_stages_are_not_learned():
+    model = CostModel()
+    model.observe(features(source_pixels=100), {'decode': 1.0, 'encode': 1.0})
+    assert model.stats()['scales'] == {}
+
+
+def test_animation_frames_scale_the_estimate():
+    model = CostModel()
+    still = features('GIF', 300_000, output_format='GIF')
+    animated = still._replace(frames=60) # shared palette: cheaper per frame than a still
+    assert 10 * model.estimate(still) < model.estimate(animated) < 60 * model.estimate(still)
+
+
+def test_client_budget():
+    budget = ClientBudget(seconds=2.0, window=2.0) # 1 s of work per second
+    assert budget.charge('a', 1.5) == 0
+    assert budget.charge('a', 1.0) == pytest.approx(0.5, abs=0.05) # 0.5 left, needs 1
+    assert budget.charge('b', 1.0) == 0 # separate bucket
+    budget.settle('a', 1.5, 0.5) # the render was cheaper than estimated
+    assert budget.charge('a', 1.0) == 0
+    assert budget.rejected == 1
+
+
+def test_client_budget_refuses_work_over_the_whole_budget():
+    budget = ClientBudget(seconds=1.0, window=0.1)
+    assert budget.charge('a', 5.0) == float('inf') # even with a full bucket
+    assert budget.charge('a', 1.0) == 0 # nothing was taken
+    assert budget.charge('a', 0.5) > 0.04 # refilling at 10 s/s
+    time.sleep(0.1)
+    assert budget.charge('a', 0.5) == 0
+    assert budget.rejected == 2
+
+
+def test_client_budget_disabled():
+    budget = ClientBudget(seconds=0, window=60)
+    assert budget.charge('a', 1e9) == 0
@@ -0,0 +1,65 @@
+import io
+
+import pytest
+from PIL import Image, ImageFilter
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from encoding import OUTPUT_FORMATS, PROFILES, encoder_settings, negotiate_format, save_image
+
+
+def photo_like(size=(320, 240)):
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 100)
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(1))
+    return Image.merge("RGB", (detail, Image.linear_gradient("L").resize(size), noise))
+
+
+def encode(img, fmt, profile):
+    out = io.BytesIO()
+    save_image(img, fmt, out, profile)
+    return out.getvalue()
+
+
+# --- Tests ---
+@pytest.mark.parametrize("fmt", OUTPUT_FORMATS)
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "P"])
+def test_every_profile_encodes_every_mode(fmt, mode):
+    img = photo_like().convert(mode)
+    for profile in PROFILES:
+        decoded = Image.open(io.BytesIO(encode(img, fmt, profile)))
+        assert (decoded.format, decoded.size) == (fmt, img.size)
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "PNG", "WEBP"])
+def test_smallest_is_smaller_than_fast(fmt):
+    img = photo_like()
+    assert len(encode(img, fmt, "smallest")) < len(encode(img, fmt, "fast"))
+
+
+def test_profiles_set_encoder_options():
+    assert encoder_settings("JPEG", "smallest")["progressive"] is True
+    assert encoder_settings("PNG", "fast") == {"compress_level": 1}
+    assert encoder_settings("GIF", "fast")["quantize"] == Image.Quantize.FASTOCTREE
+    settings = encoder_settings("WEBP", "balanced")
+    settings["method"] = 0  # a copy, not the profile itself
+    assert encoder_settings("WEBP", "balanced")["method"] == 4
+
+
+def test_progressive_jpeg_for_smallest():
+    img = Image.open(io.BytesIO(encode(photo_like(), "JPEG", "smallest")))
+    assert img.info.get("progressive")
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, "JPEG"),
+    ("*/*", "JPEG"),
+    ("image/*", "JPEG"),
+    ("text/html", "JPEG"),
+    ("image/png", "PNG"),
+    ("image/gif, image/webp;q=0.5", "GIF"),
+    ("text/html,application/xhtml+xml,image/avif,image/webp,*/*;q=0.8", "WEBP"),
+    ("image/webp;q=0, */*", "JPEG"),
+])
+def test_negotiate_format(header, expected):
+    accept = parse_accept_header(header, MIMEAccept) if header else None
+    assert negotiate_format(accept) == expected
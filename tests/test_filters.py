@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+import filters
+from filters import chain_signature, compile_chain, parse_chain, tone_chain
+from tone import SEPIA_WARM, apply_color_matrix
+
+
+def photo_like(size=(120, 90)):
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 100)
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(1))
+    return Image.merge('RGB', (detail, gradient, noise))
+
+
+def one_by_one(img, chain):
+    """Run each filter of *chain* as its own pass, the way compiling avoids."""
+    for item in chain:
+        img = compile_chain((item,)).apply(img)
+    return img
+
+
+def max_diff(a, b):
+    return int(np.abs(np.asarray(a, dtype=int) - np.asarray(b, dtype=int)).max())
+
+
+# --- Tests ---
+def test_parse_chain_normalizes():
+    chain = parse_chain(' Brightness:1.20, gamma:1 ,tint:#FF8800:0.3,,invert ')
+    assert chain == (('brightness', (1.2,)), ('tint', ('ff8800', 0.3)), ('invert', ()))
+    assert chain_signature(chain) == 'brightness:1.2,tint:ff8800:0.3,invert'
+    assert parse_chain(chain_signature(chain)) == chain
+    assert parse_chain('brightness:1,tint:00ff00:0') == parse_chain('') == parse_chain(None) == ()
+    assert tone_chain(True, 'invert') == (('sepia', ()), ('invert', ()))
+
+
+@pytest.mark.parametrize('text, message', [
+    ('blur', 'Unknown filter: blur'),
+    ('brightness:x', "Invalid filter brightness: 'x' is not a number"),
+    ('gamma:0', 'Invalid filter gamma: must be between 0.05 and 20'),
+    ('contrast:nan', 'Invalid filter contrast: must be between 0 and 10'),
+    ('tint:red', 'Invalid filter tint: colour must be 6 hex digits, e.g. ff8800'),
+    ('invert:1', 'Invalid filter invert: takes no arguments'),
+    (','.join(['invert'] * 17), 'Too many filters; the limit is 16'),
+])
+def test_parse_chain_errors(text, message):
+    with pytest.raises(ValueError) as exc:
+        parse_chain(text)
+    assert str(exc.value) == message
+
+
+def test_compile_folds_runs_and_is_memoized():
+    chain = parse_chain('brightness:1.2,contrast:1.1,gamma:0.8,tint:336699,sepia,invert')
+    program = compile_chain(chain)
+    assert [stage.kind for stage in program.stages] == ['lut', 'matrix', 'lut']
+    assert program.kind == 'mixed'
+    assert program.describe().endswith('-> lookup table + colour matrix + lookup table, one pass')
+    assert compile_chain(parse_chain(chain_signature(chain))) is program
+
+
+@pytest.mark.parametrize('text', [
+    'brightness:1.3,contrast:1.4,gamma:0.7,invert',
+    'gamma:1.5,tint:ff8800:0.4,brightness:0.9',
+    'sepia,invert,tint:00ff00,contrast:2',
+])
+def test_compiled_chain_matches_filter_by_filter(text, monkeypatch):
+    monkeypatch.setattr(filters, 'CHUNK_PIXELS', 1000)  # several chunks
+    img = photo_like()
+    chain = parse_chain(text)
+    assert compile_chain(chain).apply(img).tobytes() == one_by_one(img, chain).tobytes()
+
+
+def test_matrices_multiply_out_with_one_clip():
+    img = photo_like()
+    chain = parse_chain('tint:ff8800:0.3,sepia')
+    assert len(compile_chain(chain).stages) == 1
+    assert max_diff(compile_chain(chain).apply(img), one_by_one(img, chain)) <= 2
+
+
+def test_sepia_alone_is_the_tone_engine():
+    img = photo_like()
+    for source in (img, img.convert('L')):
+        out = compile_chain(tone_chain(True, '')).apply(source)
+        assert out.tobytes() == apply_color_matrix(source, SEPIA_WARM).tobytes()
+
+
+def test_grayscale_input_uses_lookup_tables():
+    gray = photo_like().convert('L')
+    chain = parse_chain('contrast:1.5,gamma:2')
+    out = compile_chain(chain).apply(gray)
+    assert out.mode == compile_chain(chain).output_mode('L') == 'L'
+    assert out.tobytes() == compile_chain(chain).apply(gray.convert('RGB')).getchannel(0).tobytes()
+
+    chain = parse_chain('brightness:1.2,tint:ff8800')
+    out = compile_chain(chain).apply(gray)
+    assert out.mode == compile_chain(chain).output_mode('L') == 'RGB'
+    assert out.tobytes() == compile_chain(chain).apply(gray.convert('RGB')).tobytes()
+
+
+def test_lookup_tables_keep_alpha():
+    img = photo_like()
+    img.putalpha(Image.linear_gradient('L').resize(img.size))
+    out = compile_chain(parse_chain('invert')).apply(img)
+    assert out.mode == 'RGBA'
+    assert out.getchannel('A').tobytes() == img.getchannel('A').tobytes()
+    assert out.getpixel((5, 5))[:3] == tuple(255 - v for v in img.getpixel((5, 5))[:3])
+
+
+@pytest.mark.parametrize('mode', ['P', 'LA', 'CMYK'])
+@pytest.mark.parametrize('text', ['contrast:2', 'sepia', 'brightness:1.2,tint:ff8800'])
+def test_other_modes_are_filtered_as_rgb(mode, text):
+    img = photo_like().convert(mode)
+    program = compile_chain(parse_chain(text))
+    out = program.apply(img)
+    assert out.mode == program.output_mode(mode) == 'RGB'
+    assert out.tobytes() == program.apply(img.convert('RGB')).tobytes()
+    assert out.getextrema() != ((0, 0),) * 3
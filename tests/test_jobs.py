@@ -0,0 +1,72 @@
+import json
+import os
+import time
+
+from jobs import JobSpool, public_status, run_job
+
+
+def render_upper(data, options):
+    return data.upper()
+
+
+def render_file(path, options):
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
+def render_broken(data, options):
+    raise ValueError('boom')
+
+
+def test_job_lifecycle(tmp_path):
+    spool = JobSpool(str(tmp_path), ttl=60)
+    meta = spool.create('a.png', {'format': 'PNG'})
+    assert spool.read(meta['id'])['status'] == 'queued'
+
+    run_job(spool.directory, meta, b'abc', render_upper)
+    done = spool.read(meta['id'])
+    assert done['status'] == 'done'
+    with open(spool.result_path(meta['id']), 'rb') as fh:
+        assert fh.read() == b'ABC'
+    report = public_status(done)
+    assert report['bytes'] == 3
+    assert report['queue_seconds'] >= 0 and report['run_seconds'] >= 0
+
+
+def test_job_failure_is_recorded(tmp_path):
+    spool = JobSpool(str(tmp_path), ttl=60)
+    meta = spool.create('a.png', {})
+    run_job(spool.directory, meta, b'abc', render_broken)
+    failed = spool.read(meta['id'])
+    assert (failed['status'], failed['error']) == ('failed', 'boom')
+    spool.fail(meta['id'], 'ignored') # final states are not overwritten
+    assert spool.read(meta['id'])['error'] == 'boom'
+
+
+def test_job_input_is_spooled_until_run(tmp_path):
+    import io
+    spool = JobSpool(str(tmp_path), ttl=60)
+    meta = spool.create('a.png', {}, io.BytesIO(b'abc'))
+    with open(spool.input_path(meta['id']), 'rb') as fh:
+        assert fh.read() == b'abc'
+    run_job(spool.directory, meta, spool.input_path(meta['id']), render_file)
+    assert not os.path.exists(spool.input_path(meta['id']))
+    with open(spool.result_path(meta['id']), 'rb') as fh:
+        assert fh.read() == b'abc'
+
+
+def test_expired_jobs_are_removed(tmp_path):
+    spool = JobSpool(str(tmp_path), ttl=60)
+    meta = spool.create('a.png', {})
+    run_job(spool.directory, meta, b'abc', render_upper)
+    assert spool.cleanup(now=time.time() + 30) == 0
+    assert spool.cleanup(now=time.time() + 120) == 1
+    assert os.listdir(tmp_path) == []
+    assert spool.read(meta['id']) is None
+
+
+def test_read_rejects_bad_ids(tmp_path):
+    spool = JobSpool(str(tmp_path), ttl=60)
+    (tmp_path / 'x.json').write_text(json.dumps({'id': 'x'}))
+    assert spool.read('x') is None
+    assert spool.read('../etc/passwd') is None
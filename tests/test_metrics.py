@@ -0,0 +1,80 @@
+import time
+
+from metrics import NULL_TIMER, Metrics, StageTimer
+
+
+def test_stage_timer_accumulates_and_merges():
+    timer = StageTimer()
+    with timer.stage('decode'):
+        time.sleep(0.001)
+    timer.add('decode', 0.5)
+    other = StageTimer()
+    other.add('encode', 0.25)
+    other.count_pixels(100)
+    timer.merge(other)
+    assert timer.stages['decode'] > 0.5
+    assert timer.pixels == 100
+    assert timer.server_timing().startswith('decode;dur=')
+    assert 'encode;dur=250.000' in timer.server_timing()
+
+
+def test_null_timer_records_nothing():
+    with NULL_TIMER.stage('decode'):
+        pass
+    NULL_TIMER.add('encode', 1.0)
+    NULL_TIMER.count_pixels(10)
+    assert NULL_TIMER.stages == {} and NULL_TIMER.pixels == 0
+
+
+def test_histogram_and_counter_exposition():
+    metrics = Metrics()
+    metrics.histogram('t_seconds', 'Latency.', buckets=(0.1, 1.0))
+    metrics.counter('t_bytes_total', 'Bytes.')
+    metrics.observe('t_seconds', 0.05, stage='decode')
+    metrics.observe('t_seconds', 0.5, stage='decode')
+    metrics.observe('t_seconds', 5.0, stage='decode')
+    metrics.inc('t_bytes_total', 10)
+    text = metrics.render()
+    assert '# TYPE t_seconds histogram' in text
+    assert 't_seconds_bucket{stage="decode",le="0.1"} 1' in text
+    assert 't_seconds_bucket{stage="decode",le="1.0"} 2' in text
+    assert 't_seconds_bucket{stage="decode",le="+Inf"} 3' in text
+    assert 't_seconds_sum{stage="decode"} 5.55' in text
+    assert 't_seconds_count{stage="decode"} 3' in text
+    assert 't_bytes_total 10' in text
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    metrics.counter('t_total', 'Things.')
+    metrics.inc('t_total')
+    assert '\nt_total ' not in metrics.render()
+
+
+def test_directory_aggregates_processes(tmp_path):
+    # Two instances sharing a directory stand in for two worker processes.
+    workers = [Metrics(directory=str(tmp_path)) for _ in range(2)]
+    for metrics in workers:
+        metrics.counter('t_total', 'Things.')
+        metrics.histogram('t_seconds', 'Latency.', buckets=(1.0,))
+    workers[0].inc('t_total', 2)
+    workers[0].observe('t_seconds', 0.5)
+    workers[1].inc('t_total', 3)
+    workers[1].observe('t_seconds', 2.0)
+    workers[1].flush()
+    text = workers[0].render() # flushes its own values, then sums every snapshot
+    assert 't_total 5' in text
+    assert 't_seconds_bucket{le="1.0"} 1' in text
+    assert 't_seconds_count 2' in text
+    assert len(list(tmp_path.glob('*.json'))) == 2
+
+
+def test_close_flushes_and_stops_the_flusher(tmp_path):
+    metrics = Metrics(directory=str(tmp_path), flush_interval=60)
+    metrics.counter('t_total', 'Things.')
+    metrics.inc('t_total')
+    flusher = metrics._flusher
+    metrics.close()
+    flusher.join(timeout=5)
+    assert not flusher.is_alive()
+    assert [path.read_text() for path in tmp_path.glob('*.json')] == ['{"t_total": {"": 1}}']
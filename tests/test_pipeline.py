@@ -0,0 +1,108 @@
+import io
+
+import pytest
+from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageStat
+
+from app import apply_sepia_filter, plan_processing, process_image_data
+from pipeline import REORDER_TOLERANCE, plan_operations
+
+
+def photo_like(mode='RGB', size=(300, 200)):
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 100)
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(1))
+    img = Image.merge('RGB', (detail, gradient, noise))
+    if mode == 'RGBA':
+        img.putalpha(gradient)
+    elif mode == 'P':
+        img = img.quantize(64)
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    return img
+
+
+def fixed_order(img, new_size, grayscale, sepia):
+    """The pre-planner pipeline: copy, resize, grayscale, sepia."""
+    out = img.copy()
+    if new_size:
+        out = out.resize(new_size, Image.Resampling.LANCZOS)
+    if grayscale:
+        out = ImageOps.grayscale(out)
+    if sepia:
+        out = apply_sepia_filter(out)
+    return out
+
+
+@pytest.mark.parametrize('mode, new_size, grayscale, sepia, expected', [
+    ('RGB', (100, 66), True, False, ['grayscale', 'resize']),
+    ('RGB', (100, 66), True, True, ['grayscale', 'resize', 'sepia']),
+    ('RGB', (100, 66), False, True, ['resize', 'sepia']),
+    ('RGB', None, True, True, ['grayscale', 'sepia']),
+    ('P', (100, 66), True, False, ['resize', 'grayscale']),
+    ('RGBA', (100, 66), True, False, ['resize', 'grayscale']),
+    ('L', (100, 66), True, True, ['resize', 'sepia']),
+    ('RGB', None, False, False, ['copy']),
+])
+def test_plan_shapes(mode, new_size, grayscale, sepia, expected):
+    plan = plan_operations((300, 200), mode, new_size, apply_grayscale=grayscale, apply_sepia=sepia)
+    assert plan.names == expected
+
+
+def test_owned_noop_plan_skips_copy():
+    img = photo_like()
+    plan = plan_operations(img.size, img.mode, None, owned=True)
+    assert plan.names == []
+    assert plan.run(img) is img
+
+
+def test_grayscale_sepia_is_fused_lut_pass():
+    plan = plan_operations((300, 200), 'RGB', None, apply_grayscale=True, apply_sepia=True)
+    assert 'lookup tables' in plan.steps[-1].detail
+    img = photo_like()
+    assert plan.run(img).tobytes() == fixed_order(img, None, True, True).tobytes()
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'P', 'L'])
+@pytest.mark.parametrize('new_size', [None, (120, 80), (450, 300)])
+@pytest.mark.parametrize('grayscale, sepia', [(False, False), (True, False), (False, True), (True, True)])
+def test_plan_matches_fixed_order(mode, new_size, grayscale, sepia):
+    img = photo_like(mode)
+    resize_option = 'width' if new_size else 'none'
+    width = new_size[0] if new_size else None
+    planned = process_image_data(img, resize_option, width, 100, grayscale, sepia)
+    expected = fixed_order(img, new_size, grayscale, sepia)
+    assert (planned.size, planned.mode) == (expected.size, expected.mode)
+    assert max(ImageStat.Stat(ImageChops.difference(planned, expected)).mean) <= REORDER_TOLERANCE
+
+
+def test_explain_mentions_draft_and_steps():
+    byte_arr = io.BytesIO()
+    photo_like(size=(1200, 800)).save(byte_arr, format='JPEG')
+    img = Image.open(io.BytesIO(byte_arr.getvalue()))
+    text = plan_processing(img, 'width', 100, 100, True, True).explain()
+    assert text.splitlines()[0] == 'plan for 300x200 RGB -> RGB:'
+    assert '1. grayscale' in text and '2. resize' in text and '3. sepia' in text
+    assert 'decoder draft: 1200x800 decodes as 300x200' in text
+
+
+def test_tiled_plan_is_one_fused_step():
+    plan = plan_operations((300, 200), 'RGB', (100, 66), apply_grayscale=True, apply_sepia=True,
+                           reducing_gap=3.0, tile_budget=300 * 48 * 10)
+    assert plan.names == ['tiled']
+    assert 'grayscale + resize + sepia' in plan.steps[0].detail
+    assert any(note.startswith('tiled: strips of 10 rows') for note in plan.notes)
+    # An image that fits in one strip keeps the ordinary plan.
+    plan = plan_operations((300, 200), 'RGB', (100, 66), apply_grayscale=True, tile_budget=1 << 30)
+    assert plan.names == ['grayscale', 'resize']
+
+
+def test_filters_run_as_one_step_after_sepia():
+    plan = plan_operations((300, 200), 'RGB', (100, 66), apply_sepia=True, filters='gamma:1.2,invert')
+    assert plan.names == ['resize', 'filters']
+    assert plan.steps[-1].detail == 'RGB -> RGB: sepia + gamma + invert -> colour matrix + lookup table, one pass'
+    plan = plan_operations((300, 200), 'RGB', None, apply_grayscale=True, filters='contrast:1.5')
+    assert plan.names == ['grayscale', 'filters']
+    assert plan.source.endswith('-> L')
+    img = photo_like()
+    planned = process_image_data(img, 'width', 100, 100, False, True, filters='invert')
+    assert planned.tobytes() == ImageOps.invert(fixed_order(img, planned.size, False, True)).tobytes()
@@ -0,0 +1,38 @@
+import marshal
+import pstats
+
+from profiling import ProfileStore, hottest, profile_call, profile_trigger
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+def test_profile_trigger():
+    assert profile_trigger('s3cret', 's3cret', 0) == 'header'
+    assert profile_trigger('wrong', 's3cret', 0) is None
+    assert profile_trigger('s3cret', None, 0) is None # no secret configured: header ignored
+    assert profile_trigger(None, 's3cret', 1.0) == 'sample'
+    assert profile_trigger(None, None, 0) is None
+
+
+def test_profile_call_returns_pstats_data(tmp_path):
+    result, stats = profile_call(busy, 1000)
+    assert result == busy(1000)
+    path = tmp_path / 'dump.prof'
+    path.write_bytes(stats)
+    assert any(func == 'busy' for _, _, func in pstats.Stats(str(path)).stats)
+    assert hottest(stats, limit=3)[0]['calls'] >= 1
+
+
+def test_store_keeps_newest_dumps(tmp_path):
+    store = ProfileStore(str(tmp_path), max_dumps=2)
+    _, stats = profile_call(busy, 10)
+    ids = [store.save(stats, {'width': n}) for n in range(3)]
+    listed = store.list()
+    assert len(listed) == 2
+    assert len(list(tmp_path.glob('*.prof'))) == 2
+    assert {r['id'] for r in listed} <= set(ids)
+    for record in listed:
+        assert marshal.loads(open(store.path(record['id']), 'rb').read())
+    assert store.path('../../etc/passwd') is None
@@ -0,0 +1,193 @@
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import pytest
+from PIL import Image
+
+import sharedimage
+from sharedimage import SharedPixels, call_with_image, can_share, remove_stale, share
+
+
+def noisy(mode, size=(37, 23)):
+    img = Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3))
+    if mode.startswith('I;16'):
+        return Image.frombytes(mode, size, os.urandom(size[0] * size[1] * 2))
+    return img.convert(mode)
+
+
+def describe(img):
+    return img.mode, img.size, img.tobytes(), img.getpalette(), img.info.get('transparency')
+
+
+def read_pixel(img, xy):
+    return img.getpixel(xy)
+
+
+def mapped_paths():
+    with open('/proc/self/maps') as fh:
+        return fh.read()
+
+
+# --- Tests ---
+@pytest.mark.parametrize('mode', ['L', 'P', 'RGB', 'RGBA', 'CMYK', 'I;16'])
+def test_pixels_round_trip(tmp_path, mode):
+    img = noisy(mode)
+    if mode == 'P':
+        img.info['transparency'] = 3
+    with share(img, str(tmp_path)) as shared:
+        assert call_with_image(shared, describe) == describe(img)
+    assert os.listdir(tmp_path) == []
+
+
+def test_worker_maps_the_file_without_copying(tmp_path):
+    img = Image.new('RGBA', (4, 2), (1, 2, 3, 4))
+
+    def check(mapped, path):
+        assert mapped.readonly
+        with open(path, 'r+b') as fh:
+            fh.write(bytes([9, 8, 7, 6]))  # pixel (0, 0)
+        return mapped.getpixel((0, 0))
+
+    with share(img, str(tmp_path)) as shared:
+        assert shared.stride == 16 and os.path.getsize(shared.path) == 32
+        assert call_with_image(shared, check, shared.path) == (9, 8, 7, 6)
+    assert img.getpixel((0, 0)) == (1, 2, 3, 4)
+
+
+def test_rgb_is_stored_as_rgbx_in_strips(tmp_path, monkeypatch):
+    monkeypatch.setattr(sharedimage, '_STRIP_BYTES', 37 * 4 * 5)  # 5 rows at a time
+    img = noisy('RGB')
+    with share(img, str(tmp_path)) as shared:
+        assert shared.mode == 'RGB' and os.path.getsize(shared.path) == 37 * 23 * 4
+        with open(shared.path, 'rb') as fh:
+            assert fh.read() == img.convert('RGBX').tobytes()
+        assert call_with_image(shared, describe) == describe(img)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/maps'), reason='needs /proc')
+def test_worker_unmaps_when_processing_fails(tmp_path):
+    def fail(mapped):  # its frame, held by the traceback, refers to the image
+        raise ValueError('bad options')
+
+    with share(Image.new('L', (8, 8)), str(tmp_path)) as shared:
+        with pytest.raises(ValueError, match='bad options') as caught:
+            call_with_image(shared, fail)
+        assert caught.tb is not None  # still held, yet the pixels are unmapped
+        assert shared.path not in mapped_paths()
+
+
+def test_file_is_removed_on_error(tmp_path):
+    with pytest.raises(RuntimeError):
+        with share(Image.new('RGB', (8, 8)), str(tmp_path)) as shared:
+            raise RuntimeError('pool refused the task')
+    assert os.listdir(tmp_path) == []
+    with pytest.raises(FileNotFoundError):
+        call_with_image(shared, read_pixel, (0, 0))
+
+
+def test_file_is_removed_when_the_caller_stops_waiting(tmp_path):
+    with ProcessPoolExecutor(1) as pool:
+        pool.submit(time.sleep, 0.5)  # the worker is busy
+        with share(Image.new('RGB', (8, 8), 'red'), str(tmp_path)) as shared:
+            late = pool.submit(call_with_image, shared, read_pixel, (0, 0))
+            with pytest.raises(TimeoutError):
+                late.result(timeout=0.05)
+        assert os.listdir(tmp_path) == []
+        with pytest.raises(FileNotFoundError):
+            late.result()
+        with share(Image.new('RGB', (8, 8), 'red'), str(tmp_path)) as shared:
+            assert pool.submit(call_with_image, shared, read_pixel, (0, 0)).result() == (255, 0, 0)
+
+
+@pytest.mark.parametrize('mode', ['1', 'LA', 'I', 'F', 'I;16N'])
+def test_unshareable_mode_is_refused(tmp_path, mode):
+    img = Image.new(mode, (2, 2))
+    assert not can_share(img)
+    with pytest.raises(ValueError, match='cannot share'):
+        with share(img, str(tmp_path)):
+            pass
+
+
+def test_remove_stale(tmp_path):
+    dead = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                          capture_output=True, text=True, check=True).stdout.strip()
+    for name in (f'pixels-{dead}-abc', f'pixels-{os.getpid()}-def', 'other'):
+        (tmp_path / name).write_bytes(b'x')
+    assert remove_stale(str(tmp_path)) == 1
+    assert sorted(os.listdir(tmp_path)) == ['other', f'pixels-{os.getpid()}-def']
+    assert remove_stale(str(tmp_path / 'missing')) == 0
+
+
+def test_full_directory_raises_before_writing(tmp_path, monkeypatch):
+    def full(fd, size):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(sharedimage, '_reserve', full)
+    with pytest.raises(OSError):
+        with share(Image.new('RGB', (8, 8)), str(tmp_path)):
+            pass
+    assert os.listdir(tmp_path) == []
+
+
+def test_shared_pixels_are_reused_until_evicted(tmp_path):
+    pixels = SharedPixels(str(tmp_path), max_bytes=2 * 8 * 8 * 4)
+    red, blue, green = (Image.new('RGB', (8, 8), color) for color in ('red', 'blue', 'green'))
+    with pixels.lease('red', red) as first:
+        pass
+    with pixels.lease('red', red) as again:
+        assert again == first
+        assert call_with_image(again, read_pixel, (0, 0)) == (255, 0, 0)
+    with pixels.lease('blue', blue), pixels.lease('green', green):
+        assert not os.path.exists(first.path)  # the oldest went
+    with pixels.lease('big', Image.new('RGB', (16, 16))) as big:
+        assert os.listdir(tmp_path) == [os.path.basename(big.path)]  # kept over budget while in use
+    assert not os.path.exists(big.path)
+    stats = pixels.stats()
+    assert (stats['share_hits'], stats['share_misses'], stats['shared_entries']) == (1, 4, 0)
+    pixels.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_shared_pixels_make_room_in_a_full_directory(tmp_path, monkeypatch):
+    pixels = SharedPixels(str(tmp_path), max_bytes=1 << 20)
+    with pixels.lease('old', Image.new('L', (8, 8))):
+        pass
+    real_reserve = sharedimage._reserve
+
+    def reserve(fd, size):  # room for one file only
+        if len(os.listdir(tmp_path)) > 1:
+            raise OSError(28, 'No space left on device')
+        real_reserve(fd, size)
+
+    monkeypatch.setattr(sharedimage, '_reserve', reserve)
+    with pixels.lease('new', Image.new('L', (8, 8), 255)) as shared:
+        assert call_with_image(shared, read_pixel, (0, 0)) == 255
+        with pytest.raises(OSError):
+            with pixels.lease('other', Image.new('L', (8, 8))):
+                pass
+    assert pixels.stats()['shared_entries'] == 1
+
+
+def test_shared_pixels_belong_to_their_process(tmp_path):
+    code = f"""
+import os, sys
+sys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r})
+from PIL import Image
+from sharedimage import SharedPixels
+pixels = SharedPixels({str(tmp_path)!r}, 1 << 20)
+with pixels.lease('a', Image.new('L', (8, 8))):
+    pass
+if os.fork() == 0:
+    with pixels.lease('a', Image.new('L', (8, 8))):
+        pass
+    print(pixels.stats()['share_misses'], len(os.listdir({str(tmp_path)!r})), flush=True)
+    sys.exit()
+os.wait()
+print(len(os.listdir({str(tmp_path)!r})))
+"""
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.split() == ['2', '2', '1']  # the child shared its own; exits clean it up
+    assert os.listdir(tmp_path) == []
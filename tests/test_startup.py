@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+
+import app as app_module
+from app import create_app, load_config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(code, **env):
+    """Run *code* in a fresh interpreter from the repo root; return its output."""
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True,
+                            env={**os.environ, **env}, check=True)
+    return result.stdout + result.stderr
+
+
+# --- Tests ---
+def test_import_has_no_side_effects(tmp_path):
+    dirs = {name: str(tmp_path / name.lower())
+            for name in ('JOB_SPOOL_DIR', 'IMAGE_STORE_DIR', 'PROFILE_DIR', 'RESULT_CACHE_DIR')}
+    output = run_python('import os, app; print(sorted(os.listdir(%r)))' % str(tmp_path), **dirs)
+    assert output.strip() == '[]'  # nothing printed, no directory created
+    output = run_python('import os, app; app.create_app(); print(sorted(os.listdir(%r)))' % str(tmp_path), **dirs)
+    assert output.strip() == str(sorted(os.path.basename(d) for d in dirs.values()))
+
+
+def test_diagnostics_behind_flag():
+    code = 'import logging, app; logging.basicConfig(level=logging.INFO); app.create_app()'
+    assert 'Python version' not in run_python(code)
+    assert 'Python version' in run_python(code, STARTUP_DIAGNOSTICS='1')
+
+
+def test_only_needed_plugins_are_loaded():
+    code = '''
+import io, sys
+from PIL import Image
+import app
+app.create_app()
+Image.new('RGB', (8, 8)).save(io.BytesIO(), format='WEBP')
+print(Image._initialized, sorted(m.split('.')[-1] for m in sys.modules if m.endswith('ImagePlugin')))
+Image.new('RGB', (8, 8)).save(io.BytesIO(), format='PCX')  # anything else still works
+print(Image._initialized)
+'''
+    first, second = run_python(code).strip().splitlines()
+    # Image.preinit() adds BMP and PPM to the formats we use.
+    assert first == ("1 ['BmpImagePlugin', 'GifImagePlugin', 'JpegImagePlugin', 'PngImagePlugin', "
+                     "'PpmImagePlugin', 'WebPImagePlugin']")
+    assert second == '2'
+
+
+def test_load_config_reads_environ():
+    config = load_config({'IMAGE_WORKERS': '3', 'METRICS_ENABLED': 'off', 'STARTUP_DIAGNOSTICS': 'yes'})
+    assert config['IMAGE_WORKERS'] == 3
+    assert config['IMAGE_QUEUE_LIMIT'] == 6
+    assert config['METRICS_ENABLED'] is False
+    assert config['STARTUP_DIAGNOSTICS'] is True
+
+
+def test_create_app_once_per_process():
+    assert create_app() is app_module.app
+    pool = app_module.worker_pool
+    assert create_app() is app_module.app and app_module.worker_pool is pool
+
+
+def test_create_app_overrides_rebuild_services():
+    code = '''
+import app
+app.create_app()
+pool = app.worker_pool
+pool.submit(sum, [1]).result()
+dispatcher = pool._dispatcher
+app.create_app({"IMAGE_WORKERS": 0})
+dispatcher.join(timeout=5)
+print(app.worker_pool is pool, app.worker_pool.max_workers)
+print(pool._executor, dispatcher.is_alive())
+try:
+    app.create_app({"ENCODING_PROFILE": "tiny", "IMAGE_WORKERS": 3})
+except ValueError as exc:
+    print(exc)
+print(app.app.config["ENCODING_PROFILE"], app.app.config["IMAGE_WORKERS"])
+'''
+    assert run_python(code).splitlines() == [
+        'False 0', 'None False', 'ENCODING_PROFILE must be one of fast, balanced, smallest',
+        'balanced 0']
@@ -0,0 +1,60 @@
+import io
+
+import pytest
+from PIL import Image
+
+from store import ImageStore, decoded_size
+
+
+def png_bytes(size=(20, 10), color='red'):
+    byte_arr = io.BytesIO()
+    Image.new('RGB', size, color=color).save(byte_arr, format='PNG')
+    return byte_arr.getvalue()
+
+
+def test_put_is_content_addressed(tmp_path):
+    store = ImageStore(str(tmp_path), max_decoded_bytes=10_000)
+    image_id, created = store.put(png_bytes())
+    assert created and len(image_id) == 64
+    assert store.put(png_bytes()) == (image_id, False)
+    assert store.exists(image_id)
+    assert not store.exists('../' + image_id[3:])
+
+
+def test_put_copies_streams(tmp_path):
+    store = ImageStore(str(tmp_path), max_decoded_bytes=10_000)
+    stream = io.BytesIO(png_bytes())
+    stream.seek(5)
+    image_id, created = store.put(stream)
+    assert created and stream.tell() == 5
+    assert store.put(png_bytes()) == (image_id, False)
+    with open(store.path(image_id), 'rb') as fh:
+        assert fh.read() == png_bytes()
+
+
+def test_open_decodes_once(tmp_path):
+    store = ImageStore(str(tmp_path), max_decoded_bytes=10_000)
+    image_id, _ = store.put(png_bytes())
+    first = store.open(image_id)
+    assert first.size == (20, 10)
+    assert store.open(image_id) is first
+    stats = store.stats()
+    assert (stats['decode_misses'], stats['decode_hits']) == (1, 1)
+    assert stats['decoded_bytes'] == decoded_size(first) == 20 * 10 * 4
+
+
+def test_decoded_lru_is_bounded(tmp_path):
+    store = ImageStore(str(tmp_path), max_decoded_bytes=1000) # room for one 20x10 RGB
+    a, _ = store.put(png_bytes(color='red'))
+    b, _ = store.put(png_bytes(color='blue'))
+    store.open(a)
+    store.open(b)
+    assert store.stats()['decoded_entries'] == 1
+    assert store.open(a).getpixel((0, 0)) == (255, 0, 0) # re-decoded from disk
+    assert store.stats()['decode_misses'] == 3
+
+
+def test_open_unknown(tmp_path):
+    store = ImageStore(str(tmp_path), max_decoded_bytes=1000)
+    with pytest.raises(KeyError):
+        store.open('0' * 64)
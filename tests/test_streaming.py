@@ -0,0 +1,76 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+from flask import Flask, request
+
+from streaming import buffer_response, follow_file, set_download_name
+
+
+def test_follow_file_reads_while_written(tmp_path):
+    path = tmp_path / 'out'
+    path.write_bytes(b'')
+    future = Future()
+
+    def writer():
+        with open(path, 'ab') as fh:
+            for chunk in (b'abc', b'def', b'ghi'):
+                fh.write(chunk)
+                fh.flush()
+                time.sleep(0.02)
+        future.set_result(9)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    assert b''.join(follow_file(str(path), future, chunk_size=2)) == b'abcdefghi'
+    thread.join()
+
+
+def test_follow_file_raises_writer_failure(tmp_path):
+    path = tmp_path / 'out'
+    path.write_bytes(b'partial')
+    future = Future()
+    future.set_exception(OSError('disk full'))
+    stream = follow_file(str(path), future)
+    assert next(stream) == b'partial'
+    with pytest.raises(OSError, match='disk full'):
+        next(stream)
+
+
+def test_buffer_response_ranges():
+    app = Flask(__name__)
+    data = bytes(range(256)) * 4
+
+    @app.route('/blob')
+    def blob():
+        return buffer_response(data, 'image/png', environ=request.environ, etag='k',
+                               download_name='x.png')
+
+    client = app.test_client()
+    response = client.get('/blob')
+    assert response.data == data
+    assert response.headers['Content-Length'] == str(len(data))
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'filename=x.png' in response.headers['Content-Disposition']
+
+    response = client.get('/blob', headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.data == data[10:20]
+    assert response.headers['Content-Range'] == f'bytes 10-19/{len(data)}'
+    response = client.get('/blob', headers={'Range': 'bytes=10-19', 'If-Range': '"other"'})
+    assert response.status_code == 200 and response.data == data
+    assert client.get('/blob', headers={'Range': 'bytes=5000-'}).status_code == 416
+    assert client.get('/blob', headers={'If-None-Match': '"k"'}).status_code == 304
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('x.png', 'attachment; filename=x.png'),
+    ('my photo.png', 'attachment; filename="my photo.png"'),
+    ('café.png', "attachment; filename=cafe.png; filename*=UTF-8''caf%C3%A9.png"),
+])
+def test_set_download_name(name, expected):
+    response = Flask(__name__).response_class()
+    set_download_name(response.headers, name)
+    assert response.headers['Content-Disposition'] == expected
+    expected.encode('latin-1')
@@ -0,0 +1,81 @@
+import io
+
+import pytest
+from PIL import Image, ImageFilter, ImageOps
+
+from app import apply_sepia_filter, process_image_data
+from tiles import map_strips, resize_strips, strip_rows
+
+
+def photo_like(mode='RGB', size=(301, 203)):
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 100)
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(1))
+    img = Image.merge('RGB', (detail, gradient, noise))
+    if mode == 'RGBA':
+        img.putalpha(noise)
+    elif mode == 'P':
+        img = img.quantize(64)
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    return img
+
+
+# A budget of a few rows' worth forces many strips on these small images.
+BUDGET = 301 * 48 * 7
+
+
+def test_strip_rows():
+    assert strip_rows(1000, 48 * 1000 * 10) == 10
+    assert strip_rows(10**6, 1) == 1
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L', 'LA'])
+@pytest.mark.parametrize('size, box, gap', [
+    ((100, 67), None, None),
+    ((100, 67), None, 2.0),
+    ((37, 91), (3.5, 2.25, 290.75, 199.0), 3.0),
+    ((640, 431), None, None), # upscale
+    ((301, 120), None, 3.0), # vertical only
+])
+def test_resize_strips_identical_to_resize(mode, size, box, gap):
+    img = photo_like(mode)
+    expected = img.resize(size, Image.Resampling.LANCZOS, box=box, reducing_gap=gap)
+    tiled = resize_strips(img, size, box, gap, [], [], BUDGET)
+    assert tiled.mode == expected.mode
+    assert tiled.tobytes() == expected.tobytes()
+
+
+def test_resize_strips_with_pre_and_post_ops():
+    img = photo_like()
+    expected = apply_sepia_filter(ImageOps.grayscale(img).resize((90, 61), Image.Resampling.LANCZOS, reducing_gap=2.0))
+    tiled = resize_strips(img, (90, 61), None, 2.0, [ImageOps.grayscale], [apply_sepia_filter], BUDGET)
+    assert tiled.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'P', 'L'])
+def test_map_strips_identical(mode):
+    img = photo_like(mode)
+    ops = [ImageOps.grayscale, apply_sepia_filter]
+    assert map_strips(img, ops, BUDGET).tobytes() == apply_sepia_filter(ImageOps.grayscale(img)).tobytes()
+    assert map_strips(img, [apply_sepia_filter], BUDGET).tobytes() == apply_sepia_filter(img).tobytes()
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'P', 'L'])
+@pytest.mark.parametrize('resize_option, width, percentage', [('width', 120, 100), ('percent', None, 150), ('none', None, 100)])
+@pytest.mark.parametrize('grayscale, sepia', [(False, False), (True, False), (False, True), (True, True)])
+def test_tiled_process_image_data_identical(mode, resize_option, width, percentage, grayscale, sepia):
+    img = photo_like(mode)
+    expected = process_image_data(img, resize_option, width, percentage, grayscale, sepia)
+    tiled = process_image_data(img, resize_option, width, percentage, grayscale, sepia, tile_budget=BUDGET)
+    assert tiled.mode == expected.mode
+    assert tiled.tobytes() == expected.tobytes()
+
+
+def test_tiled_jpeg_draft_identical():
+    out = io.BytesIO()
+    photo_like(size=(1600, 1200)).save(out, format='JPEG', quality=90)
+    expected = process_image_data(Image.open(io.BytesIO(out.getvalue())), 'width', 150, 100, True, True)
+    tiled = process_image_data(Image.open(io.BytesIO(out.getvalue())), 'width', 150, 100, True, True,
+                               tile_budget=200 * 48 * 16)
+    assert tiled.tobytes() == expected.tobytes()
@@ -0,0 +1,59 @@
+import pytest
+from PIL import Image
+
+import tone
+from app import apply_sepia_filter
+from tone import SEPIA_WARM, apply_color_matrix
+
+
+# --- Reference: the original per-pixel implementation ---
+def reference_sepia(img):
+    """The pre-vectorisation pixel loop, kept verbatim as the oracle."""
+    img = img.convert("RGB")
+    px = img.load()
+    for y in range(img.height):
+        for x in range(img.width):
+            r, g, b = px[x, y]
+            tr = min(255, int(0.423 * r + 0.769 * g + 0.189 * b))
+            tg = min(255, int(0.349 * r + 0.686 * g + 0.168 * b))
+            tb = min(255, int(0.272 * r + 0.534 * g + 0.131 * b))
+            px[x, y] = (tr, tg, tb)
+    return img
+
+
+def gradient_image():
+    """256x257 image covering every (r, g) pair plus colours whose float64
+    sums land exactly on an integer boundary (where rounding modes diverge)."""
+    img = Image.new("RGB", (256, 257))
+    img.putdata([(x, y, (x * 31 + y * 17) % 256) for y in range(256) for x in range(256)])
+    boundary = [(4, 83, 29), (4, 101, 51), (5, 119, 166), (8, 233, 251), (20, 98, 202)]
+    for x, colour in enumerate(boundary):
+        img.putpixel((x, 256), colour)
+    return img
+
+
+# --- Tests ---
+def test_sepia_matches_reference_pixel_for_pixel():
+    img = gradient_image()
+    assert apply_sepia_filter(img).tobytes() == reference_sepia(img).tobytes()
+
+
+def test_sepia_small_chunks(monkeypatch):
+    """Row-chunking must not change the output."""
+    monkeypatch.setattr(tone, "CHUNK_PIXELS", 1000)
+    img = gradient_image()
+    assert apply_color_matrix(img, SEPIA_WARM).tobytes() == reference_sepia(img).tobytes()
+
+
+@pytest.mark.parametrize("mode", ["L", "RGBA", "P"])
+def test_sepia_other_modes(mode):
+    img = gradient_image().convert(mode)
+    out = apply_sepia_filter(img)
+    assert out.mode == "RGB"
+    assert out.tobytes() == reference_sepia(img).tobytes()
+
+
+def test_color_matrix_saturates():
+    img = Image.new("RGB", (4, 4), (255, 255, 255))
+    out = apply_color_matrix(img, ((2, 0, 0), (0, 1, 0), (-1, 0, 0)))
+    assert out.getpixel((0, 0)) == (255, 255, 0)
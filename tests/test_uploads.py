@@ -0,0 +1,107 @@
+import io
+import os
+import struct
+import zlib
+
+import pytest
+from PIL import Image
+
+from uploads import (
+    UploadRejected, inspect_upload, keep_upload, sniff_format, upload_size, upload_source, verify_upload,
+)
+
+FORMATS = {'PNG', 'JPEG', 'GIF'}
+
+
+def encode(img, fmt):
+    out = io.BytesIO()
+    img.save(out, format=fmt)
+    return out.getvalue()
+
+
+def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def png_header(width, height):
+    """A PNG that claims *width* x *height* but carries no pixel data."""
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IDAT', b'')
+
+
+@pytest.mark.parametrize('fmt', ['PNG', 'JPEG', 'GIF', 'BMP', 'TIFF', 'WEBP'])
+def test_sniff_format(fmt):
+    assert sniff_format(encode(Image.new('RGB', (4, 4)), fmt)[:16]) == fmt
+
+
+def test_sniff_format_unknown():
+    assert sniff_format(b'not an image') is None
+    assert sniff_format(b'') is None
+
+
+def test_inspect_upload_reads_header_only():
+    stream = io.BytesIO(png_header(4000, 3000))
+    info = inspect_upload(stream, FORMATS, max_pixels=20_000_000)
+    assert (info.format, info.width, info.height) == ('PNG', 4000, 3000)
+    assert stream.tell() == 0 # rewound for the real read
+
+
+def test_inspect_upload_rejections():
+    with pytest.raises(UploadRejected) as exc:
+        inspect_upload(io.BytesIO(b'not an image'), FORMATS, None)
+    assert exc.value.status == 400
+    with pytest.raises(UploadRejected) as exc:
+        inspect_upload(io.BytesIO(encode(Image.new('RGB', (4, 4)), 'BMP')), FORMATS, None)
+    assert (exc.value.status, str(exc.value)) == (415, 'BMP images are not supported')
+    with pytest.raises(UploadRejected) as exc:
+        inspect_upload(io.BytesIO(b'\x89PNG\r\n\x1a\ntruncated'), FORMATS, None)
+    assert exc.value.status == 400
+    with pytest.raises(UploadRejected) as exc:
+        inspect_upload(io.BytesIO(png_header(10_000, 6_000)), FORMATS, 50_000_000)
+    assert (exc.value.status, str(exc.value)) == (413, 'Image is too large (10000x6000); the limit is 50000000 pixels')
+    with pytest.raises(UploadRejected) as exc: # far past Pillow's own limit too
+        inspect_upload(io.BytesIO(png_header(100_000, 100_000)), FORMATS, 50_000_000)
+    assert exc.value.status == 413
+
+
+def test_inspect_upload_counts_frames():
+    frames = [Image.new('RGB', (8, 6), (i * 40, 0, 0)) for i in range(3)]
+    out = io.BytesIO()
+    frames[0].save(out, format='GIF', save_all=True, append_images=frames[1:])
+    assert inspect_upload(io.BytesIO(out.getvalue()), FORMATS, None).frames == 3
+    assert inspect_upload(io.BytesIO(out.getvalue()), FORMATS, None, max_frame_pixels=144).frames == 3
+    with pytest.raises(UploadRejected) as exc:
+        inspect_upload(io.BytesIO(out.getvalue()), FORMATS, None, max_frame_pixels=143)
+    assert (exc.value.status, str(exc.value)) == (413, 'Animation is too large (3 frames of 8x6); the limit is 143 frame pixels')
+
+
+@pytest.mark.parametrize('fmt', ['PNG', 'JPEG', 'GIF'])
+def test_verify_upload_refuses_truncated_bodies(fmt):
+    img = Image.effect_noise((64, 48), 50).convert('P' if fmt == 'GIF' else 'RGB')
+    data = encode(img, fmt)
+    stream = io.BytesIO(data)
+    verify_upload(stream, fmt)
+    assert stream.tell() == 0
+    truncated = io.BytesIO(data[:len(data) // 2])
+    assert inspect_upload(truncated, FORMATS, None).format == fmt  # the header is fine
+    with pytest.raises(UploadRejected) as exc:
+        verify_upload(truncated, fmt)
+    assert (exc.value.status, str(exc.value)) == (400, 'Cannot identify image file')
+    assert truncated.tell() == 0
+
+
+def test_upload_source_memory_and_disk(tmp_path):
+    memory = io.BytesIO(b'abcdef')
+    memory.seek(2)
+    assert (upload_source(memory), upload_size(memory), memory.tell()) == (b'abcdef', 6, 2)
+
+    import tempfile
+    with tempfile.NamedTemporaryFile(dir=tmp_path) as spooled:
+        spooled.write(b'abcdef')
+        spooled.seek(0)
+        assert upload_source(spooled) == spooled.name
+        kept = keep_upload(spooled)
+    assert os.listdir(tmp_path) == [os.path.basename(kept)]  # outlives the spooled file
+    with open(kept, 'rb') as fh:
+        assert fh.read() == b'abcdef'
+
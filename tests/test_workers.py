@@ -0,0 +1,131 @@
+import gc
+import os
+import subprocess
+import sys
+import time
+import weakref
+
+import pytest
+
+from workers import PoolSaturated, WorkerPool
+
+
+def test_pool_runs_in_other_processes():
+    pool = WorkerPool(2)
+    try:
+        pids = {pool.submit(os.getpid).result() for _ in range(4)}
+    finally:
+        pool.shutdown()
+    assert os.getpid() not in pids
+
+
+def test_inline_pool():
+    pool = WorkerPool(0)
+    assert pool.submit(os.getpid).result() == os.getpid()
+    with pytest.raises(ZeroDivisionError):
+        pool.submit(divmod, 1, 0).result()
+
+
+def test_pool_recovers_from_dead_worker():
+    pool = WorkerPool(1)
+    try:
+        with pytest.raises(Exception):
+            pool.submit(os._exit, 1).result()
+        assert pool.submit(sum, [1, 2]).result() == 3
+    finally:
+        pool.shutdown()
+
+
+def test_non_blocking_submit_rejects_when_full():
+    pool = WorkerPool(1, max_queue=1)
+    try:
+        running = pool.submit(time.sleep, 0.5)
+        queued = pool.submit(time.sleep, 0)
+        assert pool.saturated
+        with pytest.raises(PoolSaturated):
+            pool.submit(time.sleep, 0, block=False)
+        stats = pool.stats()
+        assert (stats['running'], stats['queued'], stats['rejected']) == (1, 1, 1)
+        assert stats['utilization'] == 1.0
+        running.result(), queued.result()
+        assert pool.submit(sum, [1], block=False).result() == 1
+    finally:
+        pool.shutdown()
+    stats = pool.stats()
+    assert (stats['submitted'], stats['completed'], stats['failed']) == (3, 3, 0)
+    assert 0 < stats['utilization_avg'] <= 1
+
+
+def test_blocking_submit_times_out():
+    pool = WorkerPool(1, max_queue=0)
+    try:
+        pool.submit(time.sleep, 0.5)
+        with pytest.raises(PoolSaturated):
+            pool.submit(time.sleep, 0, timeout=0.05)
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.parametrize('aging, expected', [(0.0, [1, 3, 5]), (1e6, [5, 1, 3])])
+def test_waiting_tasks_run_cheapest_first_with_aging(aging, expected):
+    pool = WorkerPool(1, max_queue=3, aging=aging)
+    try:
+        blocker = pool.submit(time.sleep, 0.3)
+        futures = {}
+        for cost in (5, 1, 3):
+            futures[cost] = pool.submit(time.monotonic, cost=cost)
+            time.sleep(0.01)
+        assert pool.stats()['queued_cost_seconds'] == 9
+        blocker.result()
+        finished = {cost: future.result() for cost, future in futures.items()}
+    finally:
+        pool.shutdown()
+    # aging 0 is pure shortest-job-first; huge aging degenerates to FIFO.
+    assert sorted(finished, key=finished.get) == expected
+
+
+def test_shutdown_cancels_waiting_tasks():
+    pool = WorkerPool(1)
+    pool.submit(time.sleep, 0.2)
+    waiting = pool.submit(sum, [1])
+    pool.shutdown()
+    assert waiting.cancelled()
+    assert pool.submit(sum, [1, 2]).result() == 3
+    pool.shutdown()
+
+
+def test_shutdown_stops_the_dispatcher_and_frees_the_pool():
+    pool = WorkerPool(1)
+    assert pool.submit(sum, [1, 2]).result() == 3
+    dispatcher = pool._dispatcher
+    pool.shutdown()
+    dispatcher.join(timeout=5)
+    assert not dispatcher.is_alive()
+    ref = weakref.ref(pool)
+    del pool, dispatcher
+    gc.collect()
+    assert ref() is None  # no fork hook or thread keeps it alive
+
+
+def test_forked_child_starts_with_a_free_pool():
+    code = f"""
+import os, sys, time
+sys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r})
+from workers import PoolSaturated, WorkerPool
+pool = WorkerPool(1, max_queue=0)
+pool.submit(time.sleep, 1)
+try:
+    pool.submit(sum, [1], block=False)
+except PoolSaturated:
+    pass
+if os.fork() == 0:
+    stats = pool.stats()
+    print(pool.saturated, stats['queued'], stats['submitted'], stats['rejected'], flush=True)
+    print(pool.submit(sum, [1, 2], block=False).result(), flush=True)
+    pool.shutdown()
+    sys.exit()
+os.wait()
+pool.shutdown()
+"""
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.split() == ['False', '0', '0', '0', '3']
@@ -0,0 +1,159 @@
+"""Strip-based execution of a processing plan with bounded working memory.
+
+The untiled pipeline materialises every intermediate at full size: a mode
+conversion, the grayscale image, the colour-matrix engine's arrays.  Here the
+decoded source is read in horizontal strips sized from a byte budget, every
+per-pixel operation runs on one strip at a time, and results are pasted into a
+single preallocated output image, which the encoder then reads.  (Pillow's
+encoders take a complete image, so the output buffer itself cannot be
+streamed.)
+
+LANCZOS resampling is split into Pillow's own two separable passes, each
+tiled along the axis it does not filter: the optional integer ``reduce()`` and
+the horizontal pass run over row strips (aligned to whole reduction blocks),
+and the vertical pass runs over column strips of the horizontal result.  No
+strip ever needs pixels from its neighbours, so no overlap is required and the
+output is bit-identical to ``Image.resize(size, LANCZOS, box, reducing_gap)``.
+Besides the source and the output, the only full-height buffer is that
+horizontal intermediate (output width x source height), which Pillow's
+``resize`` allocates too.
+"""
+import math
+from collections.abc import Callable, Sequence
+
+from PIL import Image
+
+Op = Callable[[Image.Image], Image.Image]
+
+# Generous upper bound on the temporaries one strip pixel can need at once:
+# the crop, a mode conversion and the float64 blocks of :mod:`tone`.
+STRIP_BYTES_PER_PIXEL = 48
+
+# Modes resampled with LANCZOS (P and 1 always use NEAREST), and the
+# premultiplied modes Pillow resamples RGBA and LA in.
+SEPARABLE_MODES = {"L", "RGB", "RGBA", "LA"}
+PREMULTIPLIED = {"RGBA": "RGBa", "LA": "La"}
+LANCZOS_SUPPORT = 3.0
+
+
+def strip_rows(width: int, budget: int) -> int:
+    """Rows of a *width*-pixel image that fit in *budget* bytes (at least 1)."""
+    return max(1, budget // (max(1, width) * STRIP_BYTES_PER_PIXEL))
+
+
+def _apply(img: Image.Image, ops: Sequence[Op]) -> Image.Image:
+    for op in ops:
+        img = op(img)
+    return img
+
+
+def _paste(out: Image.Image | None, size: tuple[int, int], strip: Image.Image, at) -> Image.Image:
+    if out is None:
+        out = Image.new(strip.mode, size)
+        if strip.mode == "P":
+            out.putpalette(strip.palette)
+    out.paste(strip, at)
+    return out
+
+
+def map_strips(img: Image.Image, ops: Sequence[Op], budget: int) -> Image.Image:
+    """Apply per-pixel *ops* to *img* one row strip at a time."""
+    rows = strip_rows(img.width, budget)
+    out = None
+    for y in range(0, img.height, rows):
+        strip = _apply(img.crop((0, y, img.width, min(img.height, y + rows))), ops)
+        out = _paste(out, img.size, strip, (0, y))
+    return out
+
+
+def resize_strips(
+    img: Image.Image,
+    size: tuple[int, int],
+    box: tuple[float, float, float, float] | None,
+    reducing_gap: float | None,
+    pre: Sequence[Op],
+    post: Sequence[Op],
+    budget: int,
+) -> Image.Image:
+    """``post(resize(pre(img)))`` with LANCZOS, computed in strips.
+
+    *pre* and *post* are per-pixel operations; ``pre(img)`` must be in one of
+    ``SEPARABLE_MODES``.  Mirrors ``Image.resize`` exactly, including its
+    premultiplied-alpha handling (which ignores *reducing_gap*).
+    """
+    pre, post = list(pre), list(post)
+    mode = _apply(img.crop((0, 0, 1, 1)), pre).mode
+    if mode not in SEPARABLE_MODES:
+        raise ValueError(f"cannot resample {mode} images in strips")
+    if box is None:
+        box = (0, 0) + img.size
+    if tuple(size) == img.size and tuple(box) == (0, 0) + img.size:
+        return map_strips(img, pre + post, budget)  # Image.resize returns a copy
+    if mode in PREMULTIPLIED:
+        pre.append(lambda strip: strip.convert(PREMULTIPLIED[mode]))
+        post.insert(0, lambda strip: strip.convert(mode))
+        reducing_gap = None
+
+    # Optional integer reduction, exactly as Image.resize picks it.
+    fx = fy = 1
+    region = (0, 0) + img.size
+    if reducing_gap is not None:
+        fx = int((box[2] - box[0]) / size[0] / reducing_gap) or 1
+        fy = int((box[3] - box[1]) / size[1] / reducing_gap) or 1
+        if fx > 1 or fy > 1:
+            region = _safe_box(img.size, size, box)
+            box = (
+                (box[0] - region[0]) / fx,
+                (box[1] - region[1]) / fy,
+                (box[2] - region[0]) / fx,
+                (box[3] - region[1]) / fy,
+            )
+        else:
+            fx = fy = 1
+    src_h = math.ceil((region[3] - region[1]) / fy)
+
+    # Pass 1: row strips -> (reduce) -> horizontal pass, only for the rows the
+    # vertical pass will read.
+    support = LANCZOS_SUPPORT * max(1.0, (box[3] - box[1]) / size[1])
+    first = max(0, int(box[1] - support) - 1)
+    last = min(src_h, math.ceil(box[3] + support) + 1)
+    rows = max(1, strip_rows(region[2] - region[0], budget) // fy)
+    horizontal = None
+    for r0 in range(first, last, rows):
+        r1 = min(last, r0 + rows)
+        y0 = region[1] + r0 * fy
+        strip = _apply(img.crop((region[0], y0, region[2], min(region[3], y0 + (r1 - r0) * fy))), pre)
+        if (fx, fy) != (1, 1):
+            strip = strip.reduce((fx, fy))
+        strip = strip.resize(
+            (size[0], strip.height), Image.Resampling.LANCZOS, box=(box[0], 0, box[2], strip.height)
+        )
+        horizontal = _paste(horizontal, (size[0], src_h), strip, (0, r0))
+
+    # Pass 2: column strips of the horizontal result -> vertical pass -> post.
+    cols = strip_rows(src_h, budget)
+    out = None
+    for x0 in range(0, size[0], cols):
+        x1 = min(size[0], x0 + cols)
+        column = horizontal.crop((x0, 0, x1, src_h))
+        column = column.resize(
+            (x1 - x0, size[1]), Image.Resampling.LANCZOS, box=(0, box[1], x1 - x0, box[3])
+        )
+        out = _paste(out, size, _apply(column, post), (x0, 0))
+    return out
+
+
+def _safe_box(
+    image_size: tuple[int, int], size: tuple[int, int], box: tuple[float, float, float, float]
+) -> tuple[int, int, int, int]:
+    """The source region ``Image.resize`` reduces before resampling *box*."""
+    scale_x = (box[2] - box[0]) / size[0]
+    scale_y = (box[3] - box[1]) / size[1]
+    support_x = (LANCZOS_SUPPORT - 0.5) * scale_x
+    support_y = (LANCZOS_SUPPORT - 0.5) * scale_y
+    return (
+        max(0, int(box[0] - support_x)),
+        max(0, int(box[1] - support_y)),
+        min(image_size[0], math.ceil(box[2] + support_x)),
+        min(image_size[1], math.ceil(box[3] + support_y)),
+    )
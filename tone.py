@@ -0,0 +1,85 @@
+"""Bulk colour-matrix engine for tone filters (sepia and friends).
+
+Every filter here is expressed as a 3x3 matrix applied to each RGB pixel::
+
+    out[k] = clamp(int(m[k][0] * r + m[k][1] * g + m[k][2] * b))
+
+The arithmetic is done in float64 with NumPy, in the same operand order as the
+original per-pixel loop, so results are bit-for-bit identical to it (Pillow's
+own ``convert(matrix=...)`` rounds in float32 and disagrees on ~0.01% of
+colours).
+"""
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Matrices
+# ──────────────────────────────────────────────────────────────────────────────
+Matrix = tuple[tuple[float, float, float], tuple[float, float, float], tuple[float, float, float]]
+
+# Classic Microsoft sepia coefficients, kept for reference.
+SEPIA_CLASSIC: Matrix = (
+    (0.393, 0.769, 0.189),
+    (0.349, 0.686, 0.168),
+    (0.272, 0.534, 0.131),
+)
+
+# Slightly warmer sepia tone by increasing the red component.
+SEPIA_WARM: Matrix = (
+    (0.423, 0.769, 0.189),
+    (0.349, 0.686, 0.168),
+    (0.272, 0.534, 0.131),
+)
+
+# Upper bound on pixels converted per float64 block (~8 MB per channel); keeps
+# peak memory flat no matter how large the image is.
+CHUNK_PIXELS = 1 << 20
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Engine
+# ──────────────────────────────────────────────────────────────────────────────
+def apply_color_matrix(img: Image.Image, matrix: Matrix) -> Image.Image:
+    """Return a new RGB image with *matrix* applied to every pixel of *img*.
+
+    Channel values are truncated towards zero and saturated to ``0..255``,
+    matching ``min(255, int(...))`` for non-negative coefficients.  Grayscale
+    (``L``) input has r == g == b, so it is mapped through one 256-entry table
+    per output channel instead of being promoted to RGB first.
+    """
+    if img.mode == "L":
+        luts = gray_luts(tuple(tuple(row) for row in matrix))
+        return Image.merge("RGB", [img.point(lut) for lut in luts])
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    m = np.asarray(matrix, dtype=np.float64)
+    src = np.asarray(img)  # (h, w, 3) uint8, read-only view
+    height, width = src.shape[:2]
+    out = np.empty_like(src)
+
+    rows = max(1, CHUNK_PIXELS // max(1, width))
+    for y0 in range(0, height, rows):
+        block = src[y0:y0 + rows].astype(np.float64)
+        r, g, b = block[..., 0], block[..., 1], block[..., 2]
+        for k in range(3):
+            v = m[k, 0] * r + m[k, 1] * g + m[k, 2] * b
+            np.clip(v, 0, 255, out=v)
+            out[y0:y0 + rows, :, k] = v  # float -> uint8 truncates
+
+    return Image.fromarray(out)
+
+
+@lru_cache(maxsize=32)
+def gray_luts(matrix: Matrix) -> tuple[tuple[int, ...], ...]:
+    """Per-output-channel lookup tables for *matrix* applied to gray pixels.
+
+    Evaluated with the same float64 expression as the RGB path, so the result
+    is identical to converting ``L`` to RGB and applying the matrix.
+    """
+    return tuple(
+        tuple(max(0, min(255, int(row[0] * y + row[1] * y + row[2] * y))) for y in range(256))
+        for row in matrix
+    )
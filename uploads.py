@@ -0,0 +1,187 @@
+"""Upload intake: disk spooling and header-only validation.
+
+Uploaded files are kept in memory only when the whole request body is under a
+threshold and are written to a named temporary file otherwise
+(:class:`SpooledRequest`), so a large multipart body never has to fit in RAM
+while it is parsed.  :func:`upload_source` then hands workers that file's path
+rather than its contents.
+
+:func:`inspect_upload` then decides whether an upload is worth decoding
+using nothing but its first bytes and image header: the real format comes
+from the file's magic bytes (not its name), and the pixel count (times the
+frame count, for animations) is checked against the budget before any pixel
+data is read.  Refusing a bad or oversized input this way costs microseconds
+instead of a full decode.  :func:`verify_upload` then catches bodies that are
+truncated or corrupt behind a valid header as cheaply as each format allows,
+so they too are refused as unreadable rather than failing in a worker.
+"""
+import io
+import os
+import shutil
+import tempfile
+from typing import IO, NamedTuple
+
+from flask import Request, current_app
+from PIL import Image, UnidentifiedImageError
+
+from animation import AnimationTooLarge, check_budget
+
+# Leading bytes of each format we can name.  Formats that are recognised but
+# not accepted get a 415 rather than a generic "cannot identify".
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+)
+SNIFF_BYTES = 16
+
+# File extensions by the format they name.
+EXTENSION_FORMATS = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG", "gif": "GIF"}
+
+
+class UploadRejected(ValueError):
+    """An upload refused before decoding, with the HTTP *status* to answer."""
+
+    def __init__(self, message: str, status: int = 400) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class UploadInfo(NamedTuple):
+    format: str
+    width: int
+    height: int
+    frames: int = 1
+
+
+def sniff_format(head: bytes) -> str | None:
+    """The format named by the magic bytes at the start of *head*, if any."""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    for signature, name in SIGNATURES:
+        if head.startswith(signature):
+            return name
+    return None
+
+
+def inspect_upload(
+    stream, formats: set[str], max_pixels: int | None, max_frame_pixels: int | None = None
+) -> UploadInfo:
+    """Validate the seekable upload *stream* from its header alone.
+
+    Raises :class:`UploadRejected` (400 unreadable, 415 not one of *formats*,
+    413 more than *max_pixels* pixels, or an animation of more than
+    *max_frame_pixels* frames x pixels).  Counting frames skips over their
+    data without decoding it.  The stream is left where it was.
+    """
+    start = stream.tell()
+    try:
+        fmt = sniff_format(stream.read(SNIFF_BYTES))
+        stream.seek(start)
+        if fmt is None:
+            raise UploadRejected("Cannot identify image file")
+        if fmt not in formats:
+            raise UploadRejected(f"{fmt} images are not supported", 415)
+        try:
+            with Image.open(stream, formats=[fmt]) as img:  # parses the header only
+                width, height = img.size
+                frames = getattr(img, "n_frames", 1)
+                check_budget(img, max_frame_pixels)
+        except AnimationTooLarge as exc:
+            raise UploadRejected(str(exc), 413) from None
+        except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+            width = height = None  # over Pillow's own limit; reported below
+        except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+            raise UploadRejected("Cannot identify image file") from None
+    finally:
+        stream.seek(start)
+    if width is None or (max_pixels and width * height > max_pixels):
+        size = "" if width is None else f" ({width}x{height})"
+        raise UploadRejected(f"Image is too large{size}; the limit is {max_pixels} pixels", 413)
+    return UploadInfo(fmt, width, height, frames)
+
+
+def verify_upload(stream, fmt: str) -> None:
+    """Check that the body of the upload *stream* (vetted by
+    :func:`inspect_upload` as *fmt*) decodes; the stream is left where it was.
+
+    PNG chunks are read and their checksums checked without inflating them,
+    JPEGs are decoded at 1/8 scale (still reading every byte), and other
+    formats decode their first frame.  Raises :class:`UploadRejected` (400).
+    """
+    start = stream.tell()
+    try:
+        with Image.open(stream, formats=[fmt]) as img:
+            if fmt == "PNG":
+                img.verify()
+            else:
+                if fmt == "JPEG":
+                    img.draft(img.mode, (max(1, img.width // 8), max(1, img.height // 8)))
+                img.load()
+    except (OSError, SyntaxError, ValueError, EOFError):
+        raise UploadRejected("Cannot identify image file") from None
+    finally:
+        stream.seek(start)
+
+
+class SpooledRequest(Request):
+    """Keeps uploaded files in memory if the request body is at most
+    ``UPLOAD_SPOOL_BYTES``, and otherwise (or if its length is unknown) in
+    named files in ``UPLOAD_SPOOL_DIR`` (the system temp dir if unset),
+    removed when the request closes."""
+
+    def _get_file_stream(
+        self,
+        total_content_length: int | None,
+        content_type: str | None,
+        filename: str | None = None,
+        content_length: int | None = None,
+    ) -> IO[bytes]:
+        config = current_app.config
+        if total_content_length is not None and total_content_length <= config["UPLOAD_SPOOL_BYTES"]:
+            return io.BytesIO()
+        return tempfile.NamedTemporaryFile(prefix=".upload-", dir=config["UPLOAD_SPOOL_DIR"])
+
+
+def upload_source(stream: IO[bytes]) -> bytes | str:
+    """What a worker should decode for the upload *stream*: the path of the
+    file :class:`SpooledRequest` spooled it to, or its bytes if it is held in
+    memory.  A path is only valid until the request closes."""
+    name = getattr(stream, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        stream.flush()
+        return name
+    position = stream.tell()
+    stream.seek(0)
+    try:
+        return stream.read()
+    finally:
+        stream.seek(position)
+
+
+def keep_upload(stream: IO[bytes]) -> bytes | str:
+    """:func:`upload_source`, but a path stays valid after the request closes:
+    it is a second link to (or, where links are unsupported, a copy of) the
+    spooled file, which the caller must remove."""
+    source = upload_source(stream)
+    if isinstance(source, bytes):
+        return source
+    kept = f"{source}.kept"
+    try:
+        os.link(source, kept)
+    except OSError:
+        shutil.copyfile(source, kept)
+    return kept
+
+
+def upload_size(stream: IO[bytes]) -> int:
+    """Length of the seekable upload *stream*; the stream is left where it was."""
+    position = stream.tell()
+    try:
+        return stream.seek(0, os.SEEK_END)
+    finally:
+        stream.seek(position)
@@ -0,0 +1,275 @@
+"""Bounded process pool for CPU-bound image work.
+
+Decode, resize, filter and encode are pure CPU work that holds the GIL, so
+running them in worker processes keeps one huge image from starving every
+other request thread.  Admission is bounded: at most ``max_workers`` tasks run
+and ``max_queue`` more may wait; beyond that ``submit(block=False)`` raises
+:class:`PoolSaturated` immediately so the caller can shed load instead of
+piling up latency.
+
+Waiting tasks are not handed to the executor in arrival order.  Each carries
+an estimated *cost* (seconds of work, see :mod:`costs`), and whenever a
+worker frees up the cheapest waiting task goes next, so a burst of
+thumbnails is not stuck behind one huge render.  To keep expensive tasks from
+starving, a task's priority improves by *aging* seconds of cost for every
+second it has waited.  Every task ages at the same rate, so its priority key
+``cost + aging * enqueue_time`` never changes and a plain heap is enough.
+Tasks of equal cost, including all tasks submitted without one, run first in,
+first out.
+
+The pool is started lazily on first use and transparently restarted if a
+worker dies.  ``max_workers=0`` runs tasks inline in the calling thread,
+which is handy for debugging and single-core deployments.
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+
+class PoolSaturated(RuntimeError):
+    """Raised when a non-blocking submit finds every worker and queue slot taken."""
+
+
+class WorkerPool:
+    """Lazily started, self-healing, bounded wrapper around ``ProcessPoolExecutor``."""
+
+    def __init__(
+        self, max_workers: int | None = None, max_queue: int | None = None, aging: float = 1.0
+    ) -> None:
+        self.max_workers = (os.cpu_count() or 1) if max_workers is None else max_workers
+        self.max_queue = 2 * max(1, self.max_workers) if max_queue is None else max_queue
+        self.capacity = max(1, self.max_workers) + self.max_queue
+        self.aging = aging
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+        # Waiting tasks: heap of (priority key, sequence, cost, future, fn, args, kwargs).
+        self._waiting: list = []
+        self._sequence = itertools.count()
+        self._dispatching = 0  # tasks handed to the executor and not yet finished
+        self._ready = threading.Condition()
+        self._dispatcher: threading.Thread | None = None
+        _pools.add(self)
+        self._started = time.monotonic()
+        self._pending = 0
+        self._busy_seconds = 0.0  # integral of min(pending, workers) over time
+        self._last_change = self._started
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    # ----- submission -----
+    def submit(
+        self,
+        fn,
+        /,
+        *args,
+        block: bool = True,
+        timeout: float | None = None,
+        cost: float = 0.0,
+        **kwargs,
+    ) -> Future:
+        """Schedule ``fn(*args, **kwargs)`` and return its future.
+
+        *cost* is the task's estimated seconds of work, which orders it among
+        the waiting tasks.  With ``block=False`` (or once *timeout* expires) a
+        full pool raises :class:`PoolSaturated` instead of waiting for a slot.
+        """
+        acquired = self._slots.acquire(timeout=timeout) if block else self._slots.acquire(False)
+        if not acquired:
+            with self._lock:
+                self.rejected += 1
+            raise PoolSaturated(f"all {self.capacity} worker/queue slots are busy")
+
+        self._track(+1)
+        if self.max_workers == 0:
+            future = _run_inline(fn, *args, **kwargs)
+        else:
+            future = Future()
+            with self._ready:
+                key = cost + self.aging * time.monotonic()
+                heapq.heappush(
+                    self._waiting, (key, next(self._sequence), cost, future, fn, args, kwargs)
+                )
+                self._start_dispatcher()
+                self._ready.notify()
+        future.add_done_callback(self._on_done)
+        return future
+
+    @property
+    def saturated(self) -> bool:
+        """True if every worker and queue slot is currently taken."""
+        return self._pending >= self.capacity
+
+    # ----- scheduling -----
+    def _start_dispatcher(self) -> None:
+        """Start the dispatcher thread if needed; caller holds ``_ready``."""
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(
+                target=self._dispatch_loop, name="worker-pool-dispatch", daemon=True
+            )
+            self._dispatcher.start()
+
+    def _dispatch_loop(self) -> None:
+        """Hand the cheapest (aged) waiting task to the executor whenever a worker
+        is free, until :meth:`shutdown` replaces this thread."""
+        me = threading.current_thread()
+        while True:
+            with self._ready:
+                while self._dispatcher is me and (
+                    not self._waiting or self._dispatching >= self.max_workers
+                ):
+                    self._ready.wait()
+                if self._dispatcher is not me:
+                    return
+                _, _, _, future, fn, args, kwargs = heapq.heappop(self._waiting)
+                if not future.set_running_or_notify_cancel():
+                    continue  # cancelled while it waited
+                self._dispatching += 1
+            try:
+                inner = self._submit(fn, *args, **kwargs)
+            except BaseException as exc:
+                self._dispatched_done()
+                future.set_exception(exc)
+                continue
+            inner.add_done_callback(partial(self._relay, future=future))
+
+    def _relay(self, inner: Future, future: Future) -> None:
+        """Copy the executor's outcome onto the caller's future and free the worker."""
+        self._dispatched_done()
+        if inner.cancelled():
+            future.set_exception(CancelledError("the pool was shut down"))
+        elif inner.exception() is not None:
+            future.set_exception(inner.exception())
+        else:
+            future.set_result(inner.result())
+
+    def _dispatched_done(self) -> None:
+        with self._ready:
+            self._dispatching -= 1
+            self._ready.notify()
+
+    def _submit(self, fn, /, *args, **kwargs) -> Future:
+        try:
+            return self._get_executor().submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            self._reset()
+            return self._get_executor().submit(fn, *args, **kwargs)
+
+    def _on_done(self, future: Future) -> None:
+        self._release(failed=future.cancelled() or future.exception() is not None)
+
+    def _release(self, failed: bool) -> None:
+        self._track(-1)
+        with self._lock:
+            self.completed += 1
+            self.failed += failed
+        self._slots.release()
+
+    # ----- observability -----
+    def _track(self, delta: int) -> None:
+        """Adjust the pending count, accruing busy worker-seconds first."""
+        with self._lock:
+            now = time.monotonic()
+            running = min(self._pending, max(1, self.max_workers))
+            self._busy_seconds += running * (now - self._last_change)
+            self._last_change = now
+            self._pending += delta
+            if delta > 0:
+                self.submitted += 1
+
+    def stats(self) -> dict:
+        """Return queue depth, utilisation and lifetime counters."""
+        self._track(0)
+        workers = max(1, self.max_workers)
+        with self._ready:
+            queued_cost = sum(task[2] for task in self._waiting)
+        with self._lock:
+            running = min(self._pending, workers)
+            uptime = self._last_change - self._started
+            return {
+                "queued_cost_seconds": queued_cost,
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": running,
+                "queued": self._pending - running,
+                "utilization": running / workers,
+                "utilization_avg": self._busy_seconds / (workers * uptime) if uptime > 0 else 0.0,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+    # ----- lifecycle -----
+    def shutdown(self, wait: bool = True) -> None:
+        """Cancel waiting tasks and stop the dispatcher thread and the worker
+        processes (they restart on the next submit)."""
+        with self._ready:
+            waiting, self._waiting = self._waiting, []
+            self._dispatcher = None
+            self._ready.notify_all()
+        for task in waiting:
+            task[3].cancel()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _after_fork(self) -> None:
+        """A forked child inherits neither the dispatcher thread nor the workers,
+        nor the parent's tasks: it starts with every slot free and fresh counters."""
+        self._ready = threading.Condition()
+        self._waiting = []
+        self._dispatching = 0
+        self._dispatcher = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._started = time.monotonic()
+        self._pending = 0
+        self._busy_seconds = 0.0
+        self._last_change = self._started
+        self.submitted = self.completed = self.failed = self.rejected = 0
+
+    def _reset(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Live pools, reset in a forked child by one hook for all of them, so that
+# rebuilding a pool neither piles up hooks nor keeps old pools alive.
+_pools: "weakref.WeakSet[WorkerPool]" = weakref.WeakSet()
+
+
+def _after_fork_in_child() -> None:
+    for pool in list(_pools):
+        pool._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _run_inline(fn, /, *args, **kwargs) -> Future:
+    """Run *fn* now and wrap the outcome in a completed future."""
+    future: Future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except BaseException as exc:  # surfaced through future.result()
+        future.set_exception(exc)
+    return future